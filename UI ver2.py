@@ -16,6 +16,9 @@ UI Mockup для DUMP
 """
 
 import sys
+import asyncio
+import argparse
+import threading
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QHBoxLayout, QVBoxLayout,
     QLabel, QPushButton, QFrame, QLineEdit, QScrollArea, 
@@ -23,9 +26,11 @@ from PyQt5.QtWidgets import (
     QTabWidget, QStackedWidget, QCheckBox
 )
 from PyQt5.QtGui import QPixmap, QIcon, QFont, QFontDatabase, QColor, QPainter
-from PyQt5.QtCore import Qt, QSize, QPropertyAnimation, pyqtProperty, QEasingCurve, QRect, QPoint
+from PyQt5.QtCore import Qt, QSize, QPropertyAnimation, pyqtProperty, QEasingCurve, QRect, QPoint, QTimer
 from PyQt5.QtWidgets import QGraphicsDropShadowEffect
 
+from msg_client import MessengerClient
+
 # --- Константы стилей ---
 PRIMARY_COLOR = "#f8a5c2"
 HOVER_COLOR = "#ffc0cb"
@@ -83,6 +88,30 @@ def create_icon_button(path, size=36, icon_size=20):
     style_button(btn, size=size, icon_size=icon_size)
     return btn
 
+class ClientBridge:
+    """MessengerClient в своём потоке с циклом asyncio: окна Qt отдают ему корутины"""
+
+    def __init__(self):
+        self.client = MessengerClient()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coro, timeout=10):
+        """Выполняет корутину в потоке клиента и ждёт результат"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def submit(self, coro):
+        """Отправляет корутину в поток клиента, не дожидаясь результата"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._report)
+
+    @staticmethod
+    def _report(future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"API error: {future.exception()}")
+
+
 class BaseWindow(QWidget):
     """Базовое окно с общими для всех окон элементами"""
 
@@ -120,6 +149,36 @@ class BaseWindow(QWidget):
 
         return sidebar
 
+    def setup_typing_indicator(self, line_edit):
+        """Поле ввода сообщает о наборе текста: typing при вводе, active=False через 3 с тишины.
+        Кадр уходит в typing_sender(active), его задаёт open_chat; без открытого чата ничего не отправляется
+        """
+        self.typing_sender = None
+        self.typing_active = False
+        self.typing_timer = QTimer(self)
+        self.typing_timer.setSingleShot(True)
+        self.typing_timer.setInterval(3000)
+        self.typing_timer.timeout.connect(lambda: self.handle_typing(False))
+        line_edit.textEdited.connect(lambda text: self.handle_typing(bool(text)))
+
+    def handle_typing(self, active):
+        """Кадр typing отправляется только при смене состояния (сервер дополнительно гасит повторы)"""
+        if active:
+            self.typing_timer.start()
+        else:
+            self.typing_timer.stop()
+        if active == self.typing_active:
+            return
+        self.typing_active = active
+        if self.typing_sender is not None:
+            self.typing_sender(active)
+
+    def open_chat(self, bridge, peer_id=None, group_id=None):
+        """Привязывает окно к чату: набор текста уходит через MessengerClient.send_typing"""
+        self.typing_sender = lambda active: bridge.submit(
+            bridge.client.send_typing(peer_id=peer_id, group_id=group_id, active=active)
+        )
+
     def __init__(self, title, use_right_sidebar=True):
         super().__init__()
         self.setWindowTitle(title)
@@ -308,12 +367,13 @@ class ChatWindow(BaseWindow):
         super().setup_ui()
 
         # Поле поиска
-        search = QLineEdit()
-        search.setPlaceholderText("Search...")
-        search.setStyleSheet("""
+        self.search = QLineEdit()
+        self.search.setPlaceholderText("Search...")
+        self.search.setStyleSheet("""
             QLineEdit {background: white; color: #2f2f3a; padding: 6px; border-radius: 6px; margin-top: 12px;}
         """)
-        self.center_layout.addWidget(search)
+        self.search.returnPressed.connect(self.handle_search)
+        self.center_layout.addWidget(self.search)
 
         # Список чатов
         self.scroll = QScrollArea()
@@ -340,6 +400,13 @@ class ChatWindow(BaseWindow):
         if hasattr(self, 'plus_btn'):
             self.plus_btn.move(self.center_frame.width() - 68, self.center_frame.height() - 68)
 
+    def handle_search(self):
+        """Поиск по всем перепискам (search_messages)"""
+        # TODO: Интегрировать с API: MessengerClient.search_messages(query), результаты - search_results
+        query = self.search.text().strip()
+        if query:
+            print(f"Search messages: {query}")
+
     def create_chat_entry(self, username, message, avatar_path, badge=None):
         """Создает элемент списка чатов"""
         btn = QPushButton(f"{username}\n{message}")
@@ -379,8 +446,10 @@ class ChatWindow(BaseWindow):
 
 class Chat(BaseWindow):
     """Окно конкретного чата"""
-    def __init__(self):
+    def __init__(self, bridge=None, peer_id=None):
         super().__init__("DUMP Chat", use_right_sidebar=False)
+        if bridge is not None:
+            self.open_chat(bridge, peer_id=peer_id)
 
     def setup_ui(self):
         self.layout().addWidget(self.create_icon_sidebar())
@@ -407,10 +476,10 @@ class Chat(BaseWindow):
         title.setStyleSheet(f"color: {TEXT_COLOR}; font-weight: bold;")
         layout.addWidget(title)
 
-        search_input = QLineEdit()
-        search_input.setPlaceholderText("Search...")
-        search_input.setFont(self.default_font)
-        search_input.setStyleSheet("""
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Search...")
+        self.search_input.setFont(self.default_font)
+        self.search_input.setStyleSheet("""
             QLineEdit {
              background-color: #2a293a;
              color: white;
@@ -420,7 +489,8 @@ class Chat(BaseWindow):
              border: none;
          }
          """)
-        layout.addWidget(search_input)
+        self.search_input.returnPressed.connect(self.handle_search)
+        layout.addWidget(self.search_input)
 
         # TODO: Здесь можно вставить динамическую подгрузку чатов с API
         for name in ["Helena Hills", "John Doe", "Server Admin"]:
@@ -431,6 +501,13 @@ class Chat(BaseWindow):
         layout.addStretch()
         return sidebar
 
+    def handle_search(self):
+        """Поиск по сообщениям открытого чата (search_messages с peer_id или group_id)"""
+        # TODO: Интегрировать с API: MessengerClient.search_messages(query, peer_id=...), /next - следующая страница
+        query = self.search_input.text().strip()
+        if query:
+            print(f"Search in chat: {query}")
+
     def setup_chat(self):
         # Шапка чата
         header = QFrame()
@@ -495,6 +572,7 @@ class Chat(BaseWindow):
             }
         """)
         # TODO: Добавить обработчик отправки сообщения
+        self.setup_typing_indicator(self.message_input)
         input_layout.addWidget(self.message_input)
 
         for icon in ["mic_on", "clip.png", "emoji.png", "send.png"]:
@@ -730,11 +808,14 @@ class FriendsWindow(BaseWindow):
         self.center_layout.addStretch()
         self.populate_friends()
 
-    def populate_friends(self):
+    def populate_friends(self, online_friends=None, offline_friends=None):
         """Заполняет списки друзей"""
-        # TODO: Заменить на реальные данные из API
-        online_friends = []
-        offline_friends = []
+        # TODO: Интегрировать с API: MessengerClient.get_presence() и кадры presence
+        # (MessengerClient.presence: user_id -> True или last_seen)
+        online_friends = online_friends or []
+        offline_friends = offline_friends or []
+        self.online_list.clear()
+        self.offline_list.clear()
 
         if online_friends:
             for friend in online_friends:
@@ -1460,9 +1541,11 @@ class SettingsWindow(BaseWindow):
 
 class ServerChatWindow(BaseWindow):
     """Окно сервера с каналами и чатом"""
-    def __init__(self):
+    def __init__(self, bridge=None, group_id=None):
         super().__init__("Server", use_right_sidebar=False)
         self.setup_server_ui()
+        if bridge is not None:
+            self.open_chat(bridge, group_id=group_id)
 
     def setup_server_ui(self):
         # Очистка иконок и создание новой раскладки
@@ -1589,6 +1672,7 @@ class ServerChatWindow(BaseWindow):
                 border: none;
             }
         """)
+        self.setup_typing_indicator(self.message_input)
         input_layout.addWidget(self.message_input)
 
         for icon in ["mic_on", "clip.png", "emoji.png", "send.png"]:
@@ -1599,6 +1683,24 @@ class ServerChatWindow(BaseWindow):
 # --- Точка входа ---
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    # подключение к серверу (необязательно): --server ws://... --user ... --password ... --peer id | --group id
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server")
+    parser.add_argument("--user")
+    parser.add_argument("--password")
+    parser.add_argument("--peer", type=int)
+    parser.add_argument("--group", type=int)
+    args, _ = parser.parse_known_args()
+    bridge = None
+    if args.server:
+        bridge = ClientBridge()
+        bridge.run(bridge.client.connect(args.server))
+        if bridge.run(bridge.client.login(args.user, args.password)) < 0:
+            sys.exit("Login failed")
+    if bridge is not None and args.peer is not None:
+        window = Chat(bridge, peer_id=args.peer)
+        window.show()
+        sys.exit(app.exec_())
     # Для тестирования разных окон раскомментируйте нужное:
     #window = Chat()   
     #window = ChatWindow() 
@@ -1609,6 +1711,6 @@ if __name__ == "__main__":
     #window = AuthWindow() 
     #window = ProfileWindow()
     #window = SettingsWindow()
-    window = ServerChatWindow()
+    window = ServerChatWindow(bridge, group_id=args.group)
     window.show()
     sys.exit(app.exec_())
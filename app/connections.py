@@ -0,0 +1,100 @@
+# Реестр активных соединений сервера
+from enum import Enum
+
+
+# Для хранения состояния соединения
+class ConnectionState:
+
+    class ConnectionStateEnum(Enum):
+        Connected = 1
+        Authorized = 2
+
+    __slots__ = ("websocket", "state", "userId", "outbound", "connected_at", "last_activity", "ping_sent",
+                 "exporting")
+
+    def __init__(self, websocket=None, outbound=None):
+        self.websocket = websocket
+        # исходящая очередь соединения (OutboundQueue)
+        self.outbound = outbound
+        self.state: ConnectionState.ConnectionStateEnum = self.ConnectionStateEnum.Connected
+        self.userId: int = -1
+        # пульс (HeartbeatMonitor): время подключения, последнего входящего кадра и отправки ping без ответа
+        self.connected_at: float = 0.0
+        self.last_activity: float = 0.0
+        self.ping_sent: float | None = None
+        # идёт выгрузка истории (export_history); одновременно - не больше одной на соединение
+        self.exporting = False
+
+
+class ConnectionRegistry:
+    """
+    Реестр подключений: у пользователя может быть несколько устройств (сессий).
+    Хранит user_id -> множество сессий и обратный индекс websocket -> сессия,
+    так что регистрация, удаление и поиск работают за O(1).
+    """
+
+    _EMPTY = frozenset()
+
+    def __init__(self):
+        # user_id -> сессии пользователя (по одной на устройство)
+        self._by_user: dict[int, set[ConnectionState]] = {}
+        # websocket -> сессия (в том числе ещё не авторизованная)
+        self._by_socket: dict = {}
+
+    def add(self, state: ConnectionState):
+        """Регистрирует новое подключение (ещё без пользователя)"""
+        self._by_socket[state.websocket] = state
+
+    def authorize(self, state: ConnectionState, user_id: int) -> bool:
+        """
+        Привязывает сессию к пользователю.
+        Возвращает True, если это первое устройство пользователя в сети.
+        """
+        if state.userId >= 0 and state.userId != user_id:
+            self._detach(state)
+        state.userId = user_id
+        state.state = ConnectionState.ConnectionStateEnum.Authorized
+        self._by_socket[state.websocket] = state
+        sessions = self._by_user.get(user_id)
+        if sessions is None:
+            self._by_user[user_id] = {state}
+            return True
+        sessions.add(state)
+        return False
+
+    def remove(self, websocket) -> ConnectionState | None:
+        """Удаляет подключение, возвращает его сессию (или None, если не было)"""
+        state = self._by_socket.pop(websocket, None)
+        if state is not None and state.userId >= 0:
+            self._detach(state)
+        return state
+
+    def _detach(self, state: ConnectionState):
+        sessions = self._by_user.get(state.userId)
+        if sessions is not None:
+            sessions.discard(state)
+            if not sessions:
+                del self._by_user[state.userId]
+
+    def get(self, websocket) -> ConnectionState | None:
+        return self._by_socket.get(websocket)
+
+    def sessions(self, user_id: int):
+        """Все сессии пользователя (пустое множество, если он не в сети)"""
+        return self._by_user.get(user_id, self._EMPTY)
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self._by_user
+
+    def online_users(self):
+        return self._by_user.keys()
+
+    @property
+    def user_count(self) -> int:
+        return len(self._by_user)
+
+    def __len__(self):
+        return len(self._by_socket)
+
+    def __iter__(self):
+        return iter(self._by_socket.values())
@@ -0,0 +1,62 @@
+# Кеш списков контактов: user_id -> готовый JSON-кадр user_contacts
+import os
+from collections import OrderedDict
+
+# сколько списков держать в памяти (самые давно не использованные вытесняются)
+CONTACTS_CACHE_SIZE = int(os.getenv("CONTACTS_CACHE_SIZE", "50000"))
+
+
+class ContactListCache:
+    """
+    Снимок контактов и групп пользователя, уже сериализованный в кадр.
+    ContactCRUD и GroupCRUD сбрасывают снимок после изменения UserContact
+    или состава групп, следующий запрос соберёт его заново.
+    """
+
+    def __init__(self, max_users: int = CONTACTS_CACHE_SIZE):
+        self.max_users = max_users
+        self._frames: OrderedDict[int, str] = OrderedDict()
+        # растёт при каждом сбросе; снимок, собранный во время сброса, в кеш не кладётся
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def get(self, user_id: int) -> str | None:
+        frame = self._frames.get(user_id)
+        if frame is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._frames.move_to_end(user_id)
+        return frame
+
+    def put(self, user_id: int, frame: str, version: int = None):
+        """version - значение self.version до начала сборки снимка"""
+        if version is not None and version != self._version:
+            return
+        self._frames[user_id] = frame
+        self._frames.move_to_end(user_id)
+        while len(self._frames) > self.max_users:
+            self._frames.popitem(last=False)
+
+    def invalidate(self, *user_ids: int):
+        self._version += 1
+        for user_id in user_ids:
+            self._frames.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {"users": len(self._frames), "hits": self.hits, "misses": self.misses}
+
+    def __len__(self):
+        return len(self._frames)
+
+
+# общий кеш процесса, его сбрасывают ContactCRUD и GroupCRUD
+contact_lists_cache = ContactListCache()
+# тот же LRU для наблюдателей: user_id -> кто держит пользователя в одобренных контактах
+# (frozenset вместо кадра); сбрасывает ContactCRUD
+contact_watchers_cache = ContactListCache()
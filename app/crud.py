@@ -1,12 +1,27 @@
-from sqlalchemy import select, insert
-from sqlalchemy.sql.sqltypes import NULLTYPE
+from datetime import datetime, timezone
 
-from .msg_models import User, Group, GroupMember, Message
-from .msg_schemas import UserSchema, GroupSchema
+from sqlalchemy import (
+    select, insert, delete, update, union_all, exists, literal,
+    and_, or_, func, cast, literal_column, table, column, REAL,
+)
+from sqlalchemy.dialects.postgresql import REGCONFIG
+
+from .msg_models import (
+    User, Group, GroupMember, Message, PendingDelivery, UserContact, RelationshipStatus,
+    SEARCH_TS_CONFIG,
+)
+from .msg_schemas import UserSchema, GroupSchema, UserContactsClass, OneContactClass, OneGroupClass
+from .group_cache import group_members_cache
+from .contacts_cache import contact_lists_cache, contact_watchers_cache
 #from .database import get_async_session
 from sqlalchemy.ext.asyncio import AsyncSession
 
 
+# текущее время UTC без часового пояса, как в колонках created_at
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 class UserCRUD:
     @staticmethod
     async def create_user(
@@ -32,20 +47,31 @@ class UserCRUD:
         )
         return result.scalar_one_or_none()  # Возвращает модель User
 
+    @staticmethod
+    # last_seen многих пользователей одним executemany UPDATE по первичному ключу
+    async def set_last_seen(session: AsyncSession, seen: dict[int, datetime]):
+        await session.execute(
+            update(User), [{"id": user_id, "last_seen": moment} for user_id, moment in seen.items()]
+        )
+        await session.commit()
+
 
 class GroupCRUD:
     @staticmethod
     async def create_group(session, name: str, creator_id: int, members: list[int]):
-        async with session.begin():
-            group = Group(name=name, creator_id=creator_id)
-            session.add(group)
-            await session.flush()
+        group = Group(name=name, creator_id=creator_id)
+        session.add(group)
+        await session.flush()
 
-            members = [GroupMember(group_id=group.id, user_id=uid) for uid in members]
-            session.add_all(members)
+        # создатель всегда участник группы
+        member_ids = set(members)
+        member_ids.add(creator_id)
+        session.add_all([GroupMember(group_id=group.id, user_id=uid) for uid in member_ids])
 
-            await session.commit()
-            return group
+        await session.commit()
+        group_members_cache.put(group.id, member_ids)
+        contact_lists_cache.invalidate(*member_ids)
+        return group, member_ids
 
     @staticmethod
     async def get_group(session, group_id: int):
@@ -54,33 +80,361 @@ class GroupCRUD:
         )
         return result.scalar_one_or_none()
 
+    @staticmethod
+    # номера участников группы
+    async def get_member_ids(session: AsyncSession, group_id: int) -> set[int]:
+        result = await session.execute(
+            select(GroupMember.user_id).where(GroupMember.group_id == group_id)
+        )
+        return set(result.scalars())
 
-class MessageCRUD:
     @staticmethod
-    async def create_message(session:AsyncSession, content: str, sender_id: int,
-                             receiver_id: int = None, group_id: int = None):
-        message = Message(
-            content=content,
-            sender_id=sender_id,
-            receiver_id=receiver_id,
-            group_id=group_id,
-            is_group=bool(group_id)
+    # участники группы из кеша, при промахе - из БД
+    async def get_cached_member_ids(session: AsyncSession, group_id: int) -> frozenset[int]:
+        members = group_members_cache.get(group_id)
+        if members is None:
+            version = group_members_cache.version
+            members = group_members_cache.put(
+                group_id, await GroupCRUD.get_member_ids(session, group_id), version
+            )
+        return members
+
+    # add_member/remove_member обновляют кеш только этого процесса; другим узлам
+    # изменение рассылает сервер (MessengerServer.group_membership_changed)
+    @staticmethod
+    async def add_member(session: AsyncSession, group_id: int, user_id: int):
+        session.add(GroupMember(group_id=group_id, user_id=user_id))
+        await session.commit()
+        group_members_cache.add_member(group_id, user_id)
+        contact_lists_cache.invalidate(user_id)
+
+    @staticmethod
+    async def remove_member(session: AsyncSession, group_id: int, user_id: int):
+        await session.execute(
+            delete(GroupMember).where(GroupMember.group_id == group_id, GroupMember.user_id == user_id)
+        )
+        await session.commit()
+        group_members_cache.remove_member(group_id, user_id)
+        contact_lists_cache.invalidate(user_id)
+
+
+class ContactCRUD:
+    @staticmethod
+    # контакты (кроме удалённых) и группы пользователя
+    async def get_contact_list(session: AsyncSession, user_id: int) -> UserContactsClass:
+        cons = UserContactsClass()
+
+        result = await session.execute(
+            select(UserContact.contact_id, UserContact.custom_nickname, UserContact.status, User.username)
+            .join(User, UserContact.contact_id == User.id)
+            .where(UserContact.user_id == user_id, UserContact.status != RelationshipStatus.DELETED)
+        )
+        for row in result:
+            con = OneContactClass()
+            con.user_id = row.contact_id
+            con.user_name = row.username
+            con.custom_nickname = row.custom_nickname
+            con.status = row.status.value
+            cons.contacts.append(con)
+
+        result = await session.execute(
+            select(Group.id, Group.name)
+            .join(GroupMember, GroupMember.group_id == Group.id)
+            .where(GroupMember.user_id == user_id)
         )
+        for row in result:
+            grp = OneGroupClass()
+            grp.group_id = row.id
+            grp.group_name = row.name
+            grp.custom_groupname = None
+            grp.status = "member"
+            cons.groups.append(grp)
+
+        return cons
 
-        session.add(message)
+    @staticmethod
+    # статус контакта contact_id в списке user_id или None
+    async def get_status(session: AsyncSession, user_id: int, contact_id: int) -> RelationshipStatus | None:
+        result = await session.execute(
+            select(UserContact.status).where(UserContact.user_id == user_id, UserContact.contact_id == contact_id)
+        )
+        return result.scalar_one_or_none()
+
+    @staticmethod
+    # добавление контакта или смена статуса (PENDING/APPROVED/BLOCKED/DELETED)
+    async def set_contact(session: AsyncSession, user_id: int, contact_id: int,
+                          status: RelationshipStatus, custom_nickname: str = None) -> UserContact:
+        result = await session.execute(
+            select(UserContact).where(UserContact.user_id == user_id, UserContact.contact_id == contact_id)
+        )
+        contact = result.scalar_one_or_none()
+        if contact is None:
+            contact = UserContact(user_id=user_id, contact_id=contact_id)
+            session.add(contact)
+        contact.status = status
+        if custom_nickname is not None:
+            contact.custom_nickname = custom_nickname
         await session.commit()
-        return message
+        contact_lists_cache.invalidate(user_id)
+        contact_watchers_cache.invalidate(contact_id)
+        return contact
+
+    @staticmethod
+    # наблюдатели: кто держит каждого из user_ids в одобренных контактах (один запрос)
+    async def get_watchers(session: AsyncSession, user_ids) -> dict[int, set[int]]:
+        result = await session.execute(
+            select(UserContact.contact_id, UserContact.user_id)
+            .where(UserContact.contact_id.in_(list(user_ids)),
+                   UserContact.status == RelationshipStatus.APPROVED)
+        )
+        watchers: dict[int, set[int]] = {}
+        for contact_id, user_id in result:
+            watchers.setdefault(contact_id, set()).add(user_id)
+        return watchers
+
+    @staticmethod
+    # одобренные контакты пользователя и когда они были в сети
+    async def get_presence_list(session: AsyncSession, user_id: int) -> list[tuple[int, datetime]]:
+        result = await session.execute(
+            select(UserContact.contact_id, User.last_seen)
+            .join(User, UserContact.contact_id == User.id)
+            .where(UserContact.user_id == user_id, UserContact.status == RelationshipStatus.APPROVED)
+        )
+        return [(row.contact_id, row.last_seen) for row in result]
+
 
+class MessageCRUD:
+    # сообщения записываются только пачками: build_*_message собирает объект,
+    # insert_messages сохраняет пачку (через MessageWriter)
     @staticmethod
-    async def create_private_message(session:AsyncSession, udata, sender_id):
-        message = Message(
+    # новое, ещё не сохранённое личное сообщение;
+    # delivered - получатель в сети и сообщение уйдёт ему сразу
+    def build_private_message(udata, sender_id, delivered: bool = False) -> Message:
+        return Message(
             content=udata['content'],
             sender_id=sender_id,
             receiver_id=udata['receiver_id'],
-            #group_id=,
-            #is_group=bool(group_id)
+            is_group=False,
+            is_delivered=delivered,
+            delivered_at=utcnow() if delivered else None,
+        )
+
+    @staticmethod
+    # новое, ещё не сохранённое сообщение группы
+    def build_group_message(content: str, sender_id: int, group_id: int) -> Message:
+        return Message(
+            content=content,
+            sender_id=sender_id,
+            group_id=group_id,
+            is_group=True,
+            is_delivered=False,
         )
 
-        session.add(message)
+    @staticmethod
+    # пачка сообщений одним INSERT ... RETURNING и одним COMMIT; id заполняются в порядке messages.
+    # offline_ids[i] - участники группы не в сети для messages[i]
+    async def insert_messages(session: AsyncSession, messages: list[Message], offline_ids: list,
+                              commit: bool = True):
+        result = await session.execute(
+            insert(Message).returning(Message.id, Message.created_at, sort_by_parameter_order=True),
+            [
+                {
+                    "content": m.content,
+                    "sender_id": m.sender_id,
+                    "receiver_id": m.receiver_id,
+                    "group_id": m.group_id,
+                    "is_group": bool(m.is_group),
+                    "is_delivered": bool(m.is_delivered),
+                    "delivered_at": m.delivered_at,
+                }
+                for m in messages
+            ]
+        )
+        for message, row in zip(messages, result):
+            message.id, message.created_at = row.id, row.created_at
+
+        pending = [
+            {"user_id": uid, "message_id": message.id}
+            for message, offline in zip(messages, offline_ids)
+            for uid in offline
+        ]
+        if pending:
+            await session.execute(insert(PendingDelivery), pending)
+        if commit:
+            await session.commit()
+
+    @staticmethod
+    # страница недоставленных пользователю сообщений (личных и групповых) по возрастанию id
+    async def get_undelivered(session: AsyncSession, user_id: int, after_id: int, limit: int) -> list[Message]:
+        private = select(Message).where(
+            Message.receiver_id == user_id, ~Message.is_delivered, Message.id > after_id
+        )
+        group = select(Message).join(PendingDelivery, PendingDelivery.message_id == Message.id).where(
+            PendingDelivery.user_id == user_id, Message.id > after_id
+        )
+        stmt = union_all(private, group).order_by("id").limit(limit)
+        result = await session.execute(select(Message).from_statement(stmt))
+        return list(result.scalars())
+
+    @staticmethod
+    # отметка доставки страницы сообщений: один UPDATE и один DELETE на страницу
+    async def mark_delivered(session: AsyncSession, user_id: int, private_ids: list[int], group_ids: list[int]):
+        if private_ids:
+            await session.execute(
+                update(Message)
+                .where(Message.id.in_(private_ids))
+                .values(is_delivered=True, delivered_at=utcnow())
+            )
+        if group_ids:
+            await session.execute(
+                delete(PendingDelivery)
+                .where(PendingDelivery.user_id == user_id, PendingDelivery.message_id.in_(group_ids))
+            )
+        await session.commit()
+
+    @staticmethod
+    # сообщения, не дошедшие до клиента, возвращаются в офлайн-хранилище
+    async def mark_undelivered(session: AsyncSession, user_id: int, message_ids):
+        await session.execute(
+            update(Message)
+            .where(Message.id.in_(message_ids), Message.receiver_id == user_id)
+            .values(is_delivered=False, delivered_at=None)
+        )
+        await session.execute(
+            insert(PendingDelivery).from_select(
+                ["user_id", "message_id"],
+                select(literal(user_id), Message.id).where(
+                    Message.id.in_(message_ids),
+                    Message.group_id.is_not(None),
+                    ~exists().where(
+                        PendingDelivery.user_id == user_id, PendingDelivery.message_id == Message.id
+                    ),
+                )
+            )
+        )
         await session.commit()
-        return message
\ No newline at end of file
+
+    @staticmethod
+    # запрос истории переписки, упорядоченный по id: по убыванию (назад от before_id)
+    # или по возрастанию (вперёд от after_id). Без limit - вся переписка в заданных границах
+    def history_query(user_id: int, peer_id: int = None, group_id: int = None,
+                      before_id: int = None, after_id: int = None,
+                      limit: int = None, descending: bool = False):
+        order = Message.id.desc() if descending else Message.id.asc()
+        bounds = []
+        if after_id is not None:
+            bounds.append(Message.id > after_id)
+        if before_id is not None:
+            bounds.append(Message.id < before_id)
+
+        def page(*conditions):
+            stmt = select(Message).where(*conditions, *bounds).order_by(order)
+            return stmt.limit(limit) if limit is not None else stmt
+
+        if group_id is not None:
+            return page(Message.group_id == group_id)
+
+        # два направления переписки - два диапазона индекса (sender_id, receiver_id, id),
+        # упорядоченные ветки сливаются без сортировки всей переписки
+        outgoing = page(Message.sender_id == user_id, Message.receiver_id == peer_id).subquery()
+        incoming = page(Message.sender_id == peer_id, Message.receiver_id == user_id).subquery()
+        merged = union_all(select(outgoing), select(incoming)).subquery()
+        stmt = select(merged).order_by(merged.c.id.desc() if descending else merged.c.id.asc())
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return select(Message).from_statement(stmt)
+
+    @staticmethod
+    # страница истории по ключу (id), а не OFFSET: время не зависит от длины переписки.
+    # Возвращает сообщения по возрастанию id
+    async def get_history(session: AsyncSession, user_id: int, limit: int,
+                          peer_id: int = None, group_id: int = None,
+                          before_id: int = None, after_id: int = None) -> list[Message]:
+        stmt = MessageCRUD.history_query(
+            user_id, peer_id, group_id,
+            before_id=before_id if after_id is None else None, after_id=after_id,
+            limit=limit, descending=after_id is None,
+        )
+
+        messages = list((await session.execute(stmt)).scalars())
+        if after_id is None:
+            messages.reverse()
+        return messages
+
+    @staticmethod
+    # пачка выгрузки переписки: до limit сообщений по возрастанию id строго между after_id и before_id.
+    # Следующая пачка - с after_id = id последнего сообщения, поэтому между пачками
+    # не нужно держать ни сессию, ни курсор
+    async def get_history_range(session: AsyncSession, user_id: int, limit: int,
+                                peer_id: int = None, group_id: int = None,
+                                before_id: int = None, after_id: int = None) -> list[Message]:
+        stmt = MessageCRUD.history_query(
+            user_id, peer_id, group_id, before_id=before_id, after_id=after_id, limit=limit,
+        )
+        return list((await session.execute(stmt)).scalars())
+
+    @staticmethod
+    # переписки пользователя: одна личная (peer_id), одна группа (group_id) или все сразу
+    def conversation_scope(user_id: int, peer_id: int = None, group_id: int = None):
+        if group_id is not None:
+            return Message.group_id == group_id
+        if peer_id is not None:
+            return or_(
+                and_(Message.sender_id == user_id, Message.receiver_id == peer_id),
+                and_(Message.sender_id == peer_id, Message.receiver_id == user_id),
+            )
+        groups = select(GroupMember.group_id).where(GroupMember.user_id == user_id)
+        return or_(
+            Message.receiver_id == user_id,
+            and_(Message.sender_id == user_id, Message.receiver_id.is_not(None)),
+            Message.group_id.in_(groups),
+        )
+
+    @staticmethod
+    # полнотекстовый поиск в переписках пользователя через индекс БД (GIN по tsvector в Postgres,
+    # FTS5 в SQLite). Результаты по убыванию релевантности, страницы по ключу (rank, id):
+    # after_rank/after_id - последний результат предыдущей страницы.
+    # Возвращает список (сообщение, rank, snippet)
+    async def search_messages(session: AsyncSession, user_id: int, query: str, limit: int,
+                              peer_id: int = None, group_id: int = None,
+                              after_rank: float = None, after_id: int = None) -> list[tuple]:
+        dialect = session.get_bind().dialect.name
+        if dialect == "postgresql":
+            ts_query = func.websearch_to_tsquery(cast(SEARCH_TS_CONFIG, REGCONFIG), query)
+            vector = literal_column("messages.search_vector")
+            rank = func.ts_rank_cd(vector, ts_query)
+            snippet = func.ts_headline(
+                cast(SEARCH_TS_CONFIG, REGCONFIG), Message.content, ts_query,
+                "StartSel=[, StopSel=], MaxFragments=1, MaxWords=12, MinWords=4",
+            )
+            stmt = select(Message, rank.label("rank"), snippet.label("snippet")).where(vector.op("@@")(ts_query))
+        elif dialect == "sqlite":
+            fts = table("messages_fts", column("rowid"))
+            match = MessageCRUD.fts5_query(query)
+            if match is None:
+                return []
+            # bm25 тем меньше, чем релевантнее; знак меняем, чтобы порядок был общий с Postgres
+            rank = -func.bm25(literal_column("messages_fts"))
+            snippet = func.snippet(literal_column("messages_fts"), 0, "[", "]", "…", 12)
+            stmt = (
+                select(Message, rank.label("rank"), snippet.label("snippet"))
+                .select_from(fts)
+                .join(Message, Message.id == fts.c.rowid)
+                .where(literal_column("messages_fts").op("MATCH")(match))
+            )
+        else:
+            raise NotImplementedError(f"Full-text search is not supported on {dialect}")
+
+        stmt = stmt.where(MessageCRUD.conversation_scope(user_id, peer_id, group_id))
+        if after_rank is not None and after_id is not None:
+            # REAL: ts_rank_cd возвращает real, граница должна сравниваться в том же типе
+            bound = cast(after_rank, REAL)
+            stmt = stmt.where(or_(rank < bound, and_(rank == bound, Message.id < after_id)))
+        stmt = stmt.order_by(rank.desc(), Message.id.desc()).limit(limit)
+        return [tuple(row) for row in await session.execute(stmt)]
+
+    @staticmethod
+    # запрос пользователя -> выражение FTS5: каждое слово в кавычках (без операторов FTS5), все слова обязательны
+    def fts5_query(query: str) -> str | None:
+        words = ['"' + word.replace('"', '""') + '"' for word in query.split()]
+        return " ".join(words) if words else None
@@ -0,0 +1,74 @@
+# Таблица маршрутизации входящих сообщений сервера
+from .connections import ConnectionState
+from .metrics import registry
+
+# принятые кадры и время обработчиков по типам сообщений
+MESSAGES_RECEIVED = registry.counter("messenger_messages_received_total",
+                                     "Frames received, by message type", ("type",))
+HANDLER_SECONDS = registry.histogram("messenger_handler_seconds",
+                                     "Handler latency, by message type", ("type",))
+
+
+class Route:
+    """Маршрут: тип сообщения -> схема, обработчик и требуемое состояние соединения"""
+
+    __slots__ = ("message_type", "schema", "handler", "requires", "calls", "received", "latency")
+
+    def __init__(self, message_type: str, schema, handler, requires):
+        self.message_type = message_type
+        # экземпляр схемы создаётся один раз и переиспользуется
+        self.schema = schema
+        self.handler = handler
+        # None - обработчик доступен в любом состоянии
+        self.requires: ConnectionState.ConnectionStateEnum | None = requires
+        # счётчик вызовов обработчика
+        self.calls: int = 0
+        # метрики с уже привязанной меткой типа: на кадр только inc() и observe()
+        self.received = MESSAGES_RECEIVED.labels(message_type)
+        self.latency = HANDLER_SECONDS.labels(message_type)
+
+
+class MessageDispatcher:
+    """
+    Реестр обработчиков. Обработчики регистрируются декоратором в теле класса
+    сервера, а при запуске таблица привязывается к экземпляру через bind(),
+    так что на каждое сообщение остаётся один поиск в словаре.
+    """
+
+    def __init__(self):
+        self._routes: dict[str, Route] = {}
+
+    def handler(self, message_type: str, schema,
+                requires=ConnectionState.ConnectionStateEnum.Authorized):
+        """Декоратор регистрации обработчика сообщения message_type"""
+        def decorator(func):
+            if message_type in self._routes:
+                raise ValueError(f"Handler for '{message_type}' already registered")
+            self._routes[message_type] = Route(message_type, schema(), func, requires)
+            return func
+        return decorator
+
+    def bind(self, instance) -> "MessageDispatcher":
+        """Таблица с обработчиками, привязанными к экземпляру, и своими счётчиками"""
+        bound = MessageDispatcher()
+        for message_type, route in self._routes.items():
+            bound._routes[message_type] = Route(
+                message_type,
+                route.schema,
+                route.handler.__get__(instance, type(instance)),
+                route.requires,
+            )
+        return bound
+
+    def get(self, message_type) -> Route | None:
+        return self._routes.get(message_type)
+
+    def counters(self) -> dict[str, int]:
+        """Количество вызовов по типам сообщений"""
+        return {message_type: route.calls for message_type, route in self._routes.items()}
+
+    def __contains__(self, message_type):
+        return message_type in self._routes
+
+    def __iter__(self):
+        return iter(self._routes.values())
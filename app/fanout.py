@@ -0,0 +1,44 @@
+# Рассылка одного кадра многим получателям (групповые сообщения)
+
+
+class FanoutEngine:
+    """
+    Кадр сериализуется один раз, и та же строка кладётся в исходящие очереди
+    всех устройств получателей, как в websockets.broadcast: без ожидания сети,
+    медленный получатель не задерживает остальных. Стоимость рассылки -
+    min(число получателей, число пользователей в сети) поисков в словаре.
+    """
+
+    def __init__(self, registry):
+        # ConnectionRegistry сервера
+        self.registry = registry
+
+    def online_members(self, user_ids) -> list[int]:
+        """Получатели в сети; перебирается меньшее из двух множеств"""
+        registry = self.registry
+        if len(user_ids) > registry.user_count:
+            return [uid for uid in registry.online_users() if uid in user_ids]
+        return [uid for uid in user_ids if registry.is_online(uid)]
+
+    def broadcast(self, frame: str, user_ids, message_id: int = None, exclude=None) -> int:
+        """
+        Кладёт кадр в очереди всех устройств пользователей user_ids
+        (кроме сессии exclude). Возвращает число принятых кадров.
+        """
+        sessions = self.registry.sessions
+        queued = 0
+        for uid in user_ids:
+            for session in sessions(uid):
+                if session is not exclude and session.outbound.put(frame, message_id):
+                    queued += 1
+        return queued
+
+    def offer(self, frame: str, user_ids) -> int:
+        """Эфемерный кадр всем устройствам пользователей; перегруженные очереди его не берут"""
+        sessions = self.registry.sessions
+        queued = 0
+        for uid in user_ids:
+            for session in sessions(uid):
+                if session.outbound.offer(frame):
+                    queued += 1
+        return queued
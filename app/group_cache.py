@@ -0,0 +1,76 @@
+# Кеш состава групп: group_id -> frozenset номеров участников
+import os
+from collections import OrderedDict
+
+# сколько групп держать в кеше (самые давно не использованные вытесняются)
+GROUP_CACHE_SIZE = int(os.getenv("GROUP_CACHE_SIZE", "10000"))
+
+
+class GroupMembershipCache:
+    """
+    LRU-кеш участников групп. Загружается лениво при первом обращении,
+    а GroupCRUD обновляет его сразу после изменения состава (write-through),
+    поэтому для активных групп рассылка не читает group_members.
+    Кеш свой у каждого процесса: другие узлы сбрасывают его по
+    RelayBackend.invalidate_groups.
+    """
+
+    def __init__(self, max_groups: int = GROUP_CACHE_SIZE):
+        self.max_groups = max_groups
+        self._groups: OrderedDict[int, frozenset[int]] = OrderedDict()
+        # растёт при каждом изменении состава; загрузка, во время которой
+        # состав менялся, в кеш не кладётся
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def get(self, group_id: int) -> frozenset[int] | None:
+        members = self._groups.get(group_id)
+        if members is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._groups.move_to_end(group_id)
+        return members
+
+    def put(self, group_id: int, member_ids, version: int = None) -> frozenset[int]:
+        """Кладёт состав группы; version - значение self.version до начала загрузки из БД"""
+        members = frozenset(member_ids)
+        if version is not None and version != self._version:
+            return members
+        self._groups[group_id] = members
+        self._groups.move_to_end(group_id)
+        while len(self._groups) > self.max_groups:
+            self._groups.popitem(last=False)
+        return members
+
+    def add_member(self, group_id: int, user_id: int):
+        self._version += 1
+        members = self._groups.get(group_id)
+        if members is not None:
+            self._groups[group_id] = members | {user_id}
+
+    def remove_member(self, group_id: int, user_id: int):
+        self._version += 1
+        members = self._groups.get(group_id)
+        if members is not None:
+            self._groups[group_id] = members - {user_id}
+
+    def invalidate(self, *group_ids: int):
+        self._version += 1
+        for group_id in group_ids:
+            self._groups.pop(group_id, None)
+
+    def stats(self) -> dict:
+        return {"groups": len(self._groups), "hits": self.hits, "misses": self.misses}
+
+    def __len__(self):
+        return len(self._groups)
+
+
+# общий кеш процесса, его обновляет GroupCRUD
+group_members_cache = GroupMembershipCache()
@@ -0,0 +1,206 @@
+"""
+Пульс соединений и отключение простаивающих.
+
+Вместо таймера asyncio на каждый сокет - одно хешированное колесо таймеров:
+WHEEL_SLOTS корзин по HEARTBEAT_TICK секунд, одна задача раз в тик забирает
+корзину с наступившими сроками. Поставить или снять срок - O(1), сколько бы
+соединений ни было.
+
+Входящий кадр срок не переносит: он только запоминает время активности
+(грубые часы монитора). Когда срок наступает, монитор смотрит на это время
+и либо откладывает проверку, либо действует по состоянию соединения:
+- не авторизовано через HEARTBEAT_CONNECTED_TIMEOUT после подключения - закрывается,
+  сколько бы кадров ни прислало;
+- авторизовано и молчит HEARTBEAT_AUTHORIZED_TIMEOUT - получает ping;
+  если за HEARTBEAT_PONG_TIMEOUT не пришёл ни pong, ни кадр - соединение мёртвое,
+  транспорт обрывается без закрывающего рукопожатия.
+"""
+import asyncio
+import os
+import time
+
+import websockets
+
+from .connections import ConnectionState
+from .log import get_logger
+
+# разрешение колеса (и точность сроков), секунды
+HEARTBEAT_TICK = float(os.getenv("HEARTBEAT_TICK", "1"))
+# число корзин колеса; сроки дальше WHEEL_SLOTS тиков ждут лишние обороты
+WHEEL_SLOTS = int(os.getenv("HEARTBEAT_WHEEL_SLOTS", "512"))
+# сколько ждать входа после подключения
+HEARTBEAT_CONNECTED_TIMEOUT = float(os.getenv("HEARTBEAT_CONNECTED_TIMEOUT", "10"))
+# сколько тишины от авторизованного клиента до ping
+HEARTBEAT_AUTHORIZED_TIMEOUT = float(os.getenv("HEARTBEAT_AUTHORIZED_TIMEOUT", "15"))
+# сколько ждать ответа на ping
+HEARTBEAT_PONG_TIMEOUT = float(os.getenv("HEARTBEAT_PONG_TIMEOUT", "5"))
+
+Connected = ConnectionState.ConnectionStateEnum.Connected
+Authorized = ConnectionState.ConnectionStateEnum.Authorized
+
+log = get_logger("heartbeat")
+
+
+class TimerWheel:
+    """Хешированное колесо таймеров: ключ -> срок в тиках, корзина = срок % числа корзин"""
+
+    def __init__(self, tick: float = HEARTBEAT_TICK, slots: int = WHEEL_SLOTS, now: float = 0.0):
+        self.tick = tick
+        self._slots: list[dict[object, int]] = [{} for _ in range(max(1, slots))]
+        # ключ -> корзина, чтобы снимать срок без поиска
+        self._where: dict[object, int] = {}
+        self._origin = now
+        # последний обработанный тик
+        self._current = 0
+
+    def schedule(self, key, deadline: float):
+        """Ставит (или переносит) срок ключа; срок в прошлом сработает на следующем тике"""
+        due = max(self._current + 1, int((deadline - self._origin) / self.tick) + 1)
+        self.cancel(key)
+        slot = due % len(self._slots)
+        self._slots[slot][key] = due
+        self._where[key] = slot
+
+    def cancel(self, key):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def advance(self, now: float) -> list:
+        """Прокручивает колесо до now, возвращает ключи с наступившим сроком"""
+        target = int((now - self._origin) / self.tick)
+        expired = []
+        while self._current < target:
+            self._current += 1
+            bucket = self._slots[self._current % len(self._slots)]
+            if not bucket:
+                continue
+            for key in [key for key, due in bucket.items() if due <= self._current]:
+                del bucket[key]
+                del self._where[key]
+                expired.append(key)
+        return expired
+
+    def __len__(self):
+        return len(self._where)
+
+
+class HeartbeatMonitor:
+    """Сроки всех соединений сервера в одном колесе и одна задача, которая его крутит"""
+
+    def __init__(self, connected_timeout: float = HEARTBEAT_CONNECTED_TIMEOUT,
+                 authorized_timeout: float = HEARTBEAT_AUTHORIZED_TIMEOUT,
+                 pong_timeout: float = HEARTBEAT_PONG_TIMEOUT,
+                 tick: float = HEARTBEAT_TICK, clock=time.monotonic):
+        # срок тишины по состоянию соединения; ping - только авторизованным
+        self.timeouts = {Connected: connected_timeout, Authorized: authorized_timeout}
+        self.pong_timeout = pong_timeout
+        self.clock = clock
+        # грубые часы: обновляются раз в тик, их читает touch()
+        self.now = clock()
+        self.wheel = TimerWheel(tick, now=self.now)
+        # короткие задачи отправки ping и закрытия
+        self._pings: set[asyncio.Task] = set()
+        self._closed = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        # статистика: отправленные ping, закрытые без входа, оборванные мёртвые
+        self.pings = 0
+        self.reaped_idle = 0
+        self.reaped_dead = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self._closed.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        for task in list(self._pings):
+            task.cancel()
+
+    # region Соединения
+    def track(self, state: ConnectionState):
+        """Новое соединение"""
+        state.connected_at = self.now
+        state.last_activity = self.now
+        state.ping_sent = None
+        self.wheel.schedule(state, self.now + self.timeouts[state.state])
+
+    def touch(self, state: ConnectionState):
+        """Входящий кадр: только отметка времени, срок пересчитается, когда наступит"""
+        state.last_activity = self.now
+
+    def forget(self, state: ConnectionState):
+        self.wheel.cancel(state)
+    # endregion
+
+    async def _run(self):
+        tick = self.wheel.tick
+        while not self._closed.is_set():
+            try:
+                await asyncio.wait_for(self._closed.wait(), tick)
+            except asyncio.TimeoutError:
+                pass
+            self.now = self.clock()
+            for state in self.wheel.advance(self.now):
+                try:
+                    self._check(state)
+                except Exception:
+                    log.exception("Heartbeat error", extra={"user_id": state.userId})
+
+    def _check(self, state: ConnectionState):
+        now = self.now
+        if state.ping_sent is not None:
+            if state.last_activity >= state.ping_sent:
+                # ответ (pong или любой кадр) пришёл
+                state.ping_sent = None
+            else:
+                self.reaped_dead += 1
+                self._abort(state)
+                return
+
+        if state.state is not Authorized:
+            # срок входа считается от подключения: кадры без входа его не продлевают
+            login_until = state.connected_at + self.timeouts[Connected]
+            if login_until > now:
+                self.wheel.schedule(state, login_until)
+                return
+            self.reaped_idle += 1
+            self._spawn(state.websocket.close(1008, "authentication timeout"))
+            return
+
+        idle_until = state.last_activity + self.timeouts[Authorized]
+        if idle_until > now:
+            self.wheel.schedule(state, idle_until)
+            return
+        state.ping_sent = now
+        self.wheel.schedule(state, now + self.pong_timeout)
+        self.pings += 1
+        self._spawn(self._ping(state))
+
+    def _abort(self, state: ConnectionState):
+        """Мёртвое соединение: рвём транспорт, обработчик соединения увидит закрытие"""
+        transport = getattr(state.websocket, "transport", None)
+        if transport is not None:
+            transport.abort()
+
+    async def _ping(self, state: ConnectionState):
+        try:
+            pong = await state.websocket.ping()
+        except (websockets.ConnectionClosed, RuntimeError):
+            return
+        pong.add_done_callback(lambda f: f.cancelled() or f.exception() or self.touch(state))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._pings.add(task)
+        task.add_done_callback(self._pings.discard)
+
+    def stats(self) -> dict:
+        return {
+            "tracked": len(self.wheel),
+            "pings": self.pings,
+            "reaped_idle": self.reaped_idle,
+            "reaped_dead": self.reaped_dead,
+        }
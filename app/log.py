@@ -0,0 +1,159 @@
+"""
+Журнал сервера: JSON-строки, запись в отдельном потоке.
+
+Цикл событий не пишет в stdout сам: QueueHandler только кладёт запись в очередь
+(put_nowait), а QueueListener в фоновом потоке форматирует и пишет её. Если вывод
+не успевает (медленный pipe) и очередь заполнилась, новые записи отбрасываются и
+считаются в messenger_log_dropped_total - цикл событий не ждёт никогда.
+
+Логгеры подсистем - messenger.<подсистема> (connections, presence, relay, ...),
+уровень каждой задаётся отдельно: LOG_LEVELS="relay=DEBUG,heartbeat=WARNING".
+Частые отладочные события прореживаются: LOG_DEBUG_SAMPLE="connections=0.01" -
+из записей DEBUG подсистемы проходит примерно каждая сотая.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+from .metrics import registry
+
+# общий уровень и уровни подсистем
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# доля отладочных записей, которая попадает в журнал, по подсистемам
+LOG_DEBUG_SAMPLE = os.getenv("LOG_DEBUG_SAMPLE", "")
+# json - по объекту на строку, text - для чтения глазами при разработке
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# сколько записей может ждать записи; сверх этого записи теряются
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+ROOT = "messenger"
+
+LOG_DROPPED = registry.counter("messenger_log_dropped_total", "Log records dropped because the log queue was full")
+
+# поля LogRecord, которые не считаются пользовательскими (extra=...)
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    """Логгер подсистемы: messenger.<subsystem>"""
+    return logging.getLogger(f"{ROOT}.{subsystem}")
+
+
+def _parse_pairs(text: str) -> dict[str, str]:
+    pairs = {}
+    for part in text.split(","):
+        name, sep, value = part.partition("=")
+        if sep and name.strip():
+            pairs[name.strip()] = value.strip()
+    return pairs
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись - один JSON-объект: время, уровень, логгер, сообщение и поля из extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает каждую N-ю запись ниже INFO подсистемы; INFO и выше - всегда"""
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        # логгер -> [каждая N-я, счётчик]
+        self._every = {}
+        for name, rate in rates.items():
+            rate = float(rate)
+            self._every[f"{ROOT}.{name}"] = [max(1, round(1 / rate)) if rate > 0 else 0, 0]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.INFO:
+            return True
+        sample = self._every.get(record.name)
+        if sample is None:
+            return True
+        every, seen = sample
+        if every == 0:
+            return False
+        sample[1] = (seen + 1) % every
+        return seen == 0
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при полной очереди теряет запись, а не ждёт и не пишет ошибку в stderr"""
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # текст сообщения собирается сейчас (аргументы могут измениться),
+        # а форматирование и трассировка исключения - в потоке записи
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+# настройка процесса: после fork поток записи не наследуется, поэтому запоминаем pid
+_listener: logging.handlers.QueueListener | None = None
+_listener_pid: int | None = None
+
+
+def setup_logging(level: str = LOG_LEVEL, levels: str = LOG_LEVELS, sample: str = LOG_DEBUG_SAMPLE,
+                  fmt: str = LOG_FORMAT, stream=None):
+    """Подключает очередь и поток записи к логгеру messenger; повторный вызов в том же процессе ничего не делает"""
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        return
+    root = logging.getLogger(ROOT)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    if fmt == "text":
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    else:
+        output.setFormatter(JsonFormatter())
+
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(records)
+    handler.addFilter(SamplingFilter(_parse_pairs(sample)))
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    # записи не уходят в корневой логгер (и в его обработчики по умолчанию)
+    root.propagate = False
+    for subsystem, subsystem_level in _parse_pairs(levels).items():
+        get_logger(subsystem).setLevel(subsystem_level.upper())
+
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+    _listener_pid = os.getpid()
+
+
+def stop_logging():
+    """Дописывает очередь и останавливает поток записи"""
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = None
+    _listener_pid = None
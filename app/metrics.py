@@ -0,0 +1,278 @@
+"""
+Метрики процесса в текстовом формате Prometheus.
+
+Реестр общий для процесса, как pool_metrics в app.database. Счётчики и гистограммы
+с метками создаются заранее: labels() возвращает дочерний объект, который
+вызывающий код запоминает (в маршруте, в модуле) и дальше только вызывает
+inc()/observe() - без поиска по меткам и без создания словарей на каждый вызов.
+Всё, что и так известно серверу (число соединений, глубина очередей, stats() служб),
+не считается на каждое событие, а собирается функциями-сборщиками в момент запроса
+/metrics.
+
+Отдаются по HTTP на отдельном порту (METRICS_PORT), чтобы опрос метрик не делил
+порт и цикл приёма с клиентами мессенджера.
+"""
+import asyncio
+import logging
+import math
+import os
+from bisect import bisect_left
+
+# порт HTTP для /metrics; 0 - не поднимать
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+
+# границы корзин по умолчанию, секунды: от долей миллисекунды (разбор кадра) до секунд (PBKDF2, БД)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# app.log сам регистрирует счётчик в этом реестре, поэтому логгер берётся напрямую, без get_logger
+log = logging.getLogger("messenger.metrics")
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# region Метрики
+class _Metric:
+    """Семейство метрик с общим именем; дочерние объекты - по одному на набор значений меток"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple, object] = {}
+        # метрика без меток - сама себе единственный дочерний объект
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        """Дочерний объект для значений меток; вызывается при настройке, а не на каждое событие"""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {values}")
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(_format_labels(self.labelnames, values), values, child))
+        return lines
+
+    def _render_child(self, labels: str, values: tuple, child) -> list[str]:
+        return [f"{self.name}{labels} {_format_value(child.value)}"]
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.value = value
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        # counts[i] - наблюдения в корзине i (не накопительно), последняя - +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def _render_child(self, labels: str, values: tuple, child) -> list[str]:
+        lines = []
+        total = 0
+        counts = list(child.counts)
+        for bound, count in zip(self.bounds + (math.inf,), counts):
+            total += count
+            le = _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{le} {total}")
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+# endregion
+
+
+class MetricsRegistry:
+    """Метрики и сборщики процесса; render() - текст для Prometheus"""
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        # имя -> функция, возвращающая строки; значения, которые дешевле прочитать при опросе
+        self._collectors: dict[str, object] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            # модуль мог быть импортирован повторно: те же метрики, те же дочерние объекты
+            if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                raise ValueError(f"Metric {metric.name} already registered with another type or labels")
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def collector(self, name: str, collect):
+        """
+        collect() -> [(имя метрики, тип, справка, [(метки-словарь, значение), ...]), ...];
+        вызывается при опросе. Повторная регистрация под тем же именем заменяет сборщик
+        (новый экземпляр сервера в том же процессе)
+        """
+        self._collectors[name] = collect
+
+    def unregister_collector(self, name: str):
+        self._collectors.pop(name, None)
+
+    def stats_collector(self, prefix: str, stats, documentation: str):
+        """Числовые поля словаря stats() службы - по метрике-gauge на поле"""
+        def collect():
+            return [(f"{prefix}_{key}", "gauge", f"{documentation}: {key}", [({}, value)])
+                    for key, value in stats().items()
+                    if isinstance(value, (int, float)) and not isinstance(value, bool)]
+        self.collector(prefix, collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        for name, collect in list(self._collectors.items()):
+            try:
+                families = collect()
+            except Exception:
+                log.exception("Metrics collector failed", extra={"collector": name})
+                continue
+            for metric_name, kind, documentation, samples in families:
+                lines.append(f"# HELP {metric_name} {documentation}")
+                lines.append(f"# TYPE {metric_name} {kind}")
+                for labels, value in samples:
+                    names = tuple(labels)
+                    lines.append(f"{metric_name}{_format_labels(names, tuple(labels[n] for n in names))} "
+                                 f"{_format_value(value)}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+registry = MetricsRegistry()
+
+
+# region HTTP
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, target: MetricsRegistry):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # заголовки запроса не нужны, дочитываем до пустой строки
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] in ("GET", "HEAD") and parts[1].split("?")[0] in ("/metrics", "/"):
+            status, body = "200 OK", target.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        head = (f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode()
+        writer.write(head if parts and parts[0] == "HEAD" else head + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT,
+                               target: MetricsRegistry = registry) -> asyncio.AbstractServer:
+    """HTTP-сервер с одним адресом /metrics; закрывается вызывающим (close() и wait_closed())"""
+    return await asyncio.start_server(lambda r, w: _handle_http(r, w, target), host, port)
+# endregion
@@ -1,7 +1,8 @@
 # Это надо для работы с БД и только с БД
+import os
 from datetime import datetime, timezone
-from sqlalchemy import  Boolean, text
-from .database import Base
+from sqlalchemy import  Boolean, text, false, Index, DDL, event, inspect, update
+from .database import Base, utcnow
 from enum import Enum
 
 from sqlalchemy import (
@@ -22,8 +23,10 @@ class User(Base):
     password_hash: Mapped[str] = mapped_column(String(128))
     salt: Mapped[str] = mapped_column(String(64))  # Новое поле для salt
     created_at: Mapped[datetime] = mapped_column(
-        server_default=text("TIMEZONE('utc', now())")
+        server_default=utcnow()
     )
+    # когда закрылась последняя сессия (UTC); пишется пачками сервисом присутствия
+    last_seen: Mapped[datetime] = mapped_column(nullable=True)
 
     sent_messages: Mapped[list["Message"]] = relationship(back_populates="sender")
     memberships: Mapped[list["GroupMember"]] = relationship(back_populates="user")
@@ -83,7 +86,7 @@ class Group(Base):
     name: Mapped[str] = mapped_column(String(50))
     creator_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
     created_at: Mapped[datetime] = mapped_column(
-        server_default=text("TIMEZONE('utc', now())")
+        server_default=utcnow()
     )
 
     members: Mapped[list["GroupMember"]] = relationship(back_populates="group")
@@ -97,7 +100,7 @@ class GroupMember(Base):
     group_id: Mapped[int] = mapped_column(ForeignKey("groups.id"))
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
     joined_at: Mapped[datetime] = mapped_column(
-        server_default=text("TIMEZONE('utc', now())")
+        server_default=utcnow()
     )
 
     group: Mapped["Group"] = relationship(back_populates="members")
@@ -114,8 +117,129 @@ class Message(Base):
     receiver_id: Mapped[int | None] = mapped_column(nullable=True)
     group_id: Mapped[int | None] = mapped_column(ForeignKey("groups.id"), nullable=True)
     created_at: Mapped[datetime] = mapped_column(
-        server_default=text("TIMEZONE('utc', now())")
+        server_default=utcnow()
     )
+    # личное сообщение передано получателю (для групповых см. PendingDelivery)
+    is_delivered: Mapped[bool] = mapped_column(Boolean, default=False, server_default=false())
+    delivered_at: Mapped[datetime | None] = mapped_column(nullable=True)
 
     sender: Mapped["User"] = relationship(back_populates="sent_messages")
-    group: Mapped["Group | None"] = relationship(back_populates="messages")
\ No newline at end of file
+    group: Mapped["Group | None"] = relationship(back_populates="messages")
+
+    __table_args__ = (
+        # частичный индекс: только недоставленные личные сообщения, по получателю
+        Index(
+            "ix_messages_undelivered", "receiver_id", "id",
+            postgresql_where=text("NOT is_delivered AND receiver_id IS NOT NULL"),
+            sqlite_where=text("NOT is_delivered AND receiver_id IS NOT NULL"),
+        ),
+        # история личной переписки и группы: постраничная выборка по id без сортировки
+        Index("ix_messages_private_history", "sender_id", "receiver_id", "id"),
+        Index("ix_messages_group_history", "group_id", "id"),
+    )
+
+
+# Сообщения группы, которые ждут доставки участнику, бывшему не в сети
+class PendingDelivery(Base):
+    __tablename__ = "pending_deliveries"
+
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key=True)
+    message_id: Mapped[int] = mapped_column(ForeignKey("messages.id"), primary_key=True)
+
+
+# region Полнотекстовый поиск по сообщениям
+# конфигурация разбора текста Postgres; 'simple' - без стемминга, подходит для смеси языков
+SEARCH_TS_CONFIG = os.getenv("SEARCH_TS_CONFIG", "simple")
+
+# Postgres: генерируемая колонка tsvector (пересчитывается самой БД при записи) и GIN-индекс по ней.
+# Колонка не отображена в модели, запросы обращаются к ней по имени (см. MessageCRUD.search_messages).
+# Для существующей таблицы колонка STORED заполняется самой БД при ALTER TABLE
+POSTGRES_SEARCH_DDL = (
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector "
+    f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_TS_CONFIG}'::regconfig, coalesce(content, ''))) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_messages_search ON messages USING GIN (search_vector)",
+)
+
+# SQLite: внешняя FTS5-таблица над messages.content, синхронизируется триггерами
+SQLITE_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+)
+
+for statement in POSTGRES_SEARCH_DDL:
+    event.listen(Message.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+for statement in SQLITE_SEARCH_DDL:
+    event.listen(Message.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(Message.__table__, "before_drop", DDL(
+    "DROP TABLE IF EXISTS messages_fts"
+).execute_if(dialect="sqlite"))
+# endregion
+
+
+# region Обновление существующей БД
+# колонки, добавленные к уже существующим таблицам; тип и значение по умолчанию - из модели
+ADDED_COLUMNS = (
+    (User.__table__, "last_seen"),
+    (Message.__table__, "is_delivered"),
+    (Message.__table__, "delivered_at"),
+)
+
+
+def _add_columns(connection) -> set[str]:
+    """Добавляет недостающие колонки из ADDED_COLUMNS, возвращает добавленные ("таблица.колонка")"""
+    dialect = connection.dialect
+    inspector = inspect(connection)
+    added = set()
+    for table, name in ADDED_COLUMNS:
+        if any(column["name"] == name for column in inspector.get_columns(table.name)):
+            continue
+        column = table.c[name]
+        ddl = f"{name} {column.type.compile(dialect=dialect)}"
+        if column.server_default is not None:
+            ddl += f" DEFAULT {column.server_default.arg.compile(dialect=dialect)}"
+            if not column.nullable:
+                ddl += " NOT NULL"
+        # Postgres: IF NOT EXISTS - на случай, если колонку успел добавить другой процесс
+        exists_clause = "IF NOT EXISTS " if dialect.name == "postgresql" else ""
+        connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {exists_clause}{ddl}"))
+        added.add(f"{table.name}.{name}")
+    return added
+
+
+def upgrade_schema(connection):
+    """
+    create_all создаёт только недостающие таблицы и не трогает существующие. Здесь -
+    то, что добавлялось к уже существующим таблицам: колонки, индексы и поисковый индекс.
+    Идемпотентно, вызывается при каждом запуске после create_all (connection.run_sync)
+    """
+    added = _add_columns(connection)
+    if "messages.is_delivered" in added:
+        # сообщения до учёта доставки считаем доставленными, иначе при первом входе
+        # получатели получили бы всю старую переписку как офлайн-сообщения
+        connection.execute(update(Message.__table__).values(is_delivered=True))
+
+    for table in (Message.__table__,):
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        for statement in POSTGRES_SEARCH_DDL:
+            connection.execute(text(statement))
+    elif dialect == "sqlite":
+        existed = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        )).first() is not None
+        for statement in SQLITE_SEARCH_DDL:
+            connection.execute(text(statement))
+        if not existed:
+            # FTS5-таблица над уже заполненной messages: индексируем старые сообщения
+            connection.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+# endregion
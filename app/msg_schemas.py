@@ -1,5 +1,5 @@
 #Здесь лежат схемы JSON
-from marshmallow import Schema, fields, validate, EXCLUDE
+from marshmallow import Schema, fields, validate, validates_schema, ValidationError, EXCLUDE
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
 from datetime import datetime
 
@@ -25,6 +25,14 @@ class AuthSchema(Schema):
     class Meta:
         unknown = EXCLUDE  # Игнорировать лишние поля
 
+# повторная авторизация по токену сессии (без пароля)
+class ResumeSchema(Schema):
+    type = fields.Str(required=True, validate=validate.Equal("resume"))
+    token = fields.Str(required=True, validate=validate.Length(min=1, max=256))
+
+    class Meta:
+        unknown = EXCLUDE
+
 class CreateGroupSchema(Schema):
     type = fields.Str(required=True, validate=validate.Equal("create_group"))  # Пример для других схем
     name = fields.Str(required=True, validate=validate.Length(min=3, max=50))
@@ -33,6 +41,15 @@ class CreateGroupSchema(Schema):
     class Meta:
         unknown = EXCLUDE
 
+# добавление участника в группу и исключение (или выход) из неё
+class GroupMemberSchema(Schema):
+    type = fields.Str(required=True, validate=validate.OneOf(["add_group_member", "remove_group_member"]))
+    group_id = fields.Int(required=True)
+    user_id = fields.Int(required=True)
+
+    class Meta:
+        unknown = EXCLUDE
+
 
 class UserSchema(SQLAlchemyAutoSchema):
     id = fields.Int(dump_only=True)
@@ -56,13 +73,15 @@ class GroupSchema(Schema):
         unknown = EXCLUDE
 
 class GroupMessageSchema(Schema):
-    id = fields.Int(dump_only=True)
+    type = fields.Str(required=True, validate=validate.Equal("group_message"))
+    # id, sender_id, is_group и created_at заполняет сервер при рассылке
+    id = fields.Int(required=False)
     content = fields.Str(required=True, validate=validate.Length(min=1, max=500))
-    is_group = fields.Bool(dump_only=True)
-    sender_id = fields.Int(dump_only=True)
+    is_group = fields.Bool(required=False)
+    sender_id = fields.Int(required=False)
     receiver_id = fields.Int(allow_none=True)
-    group_id = fields.Int(allow_none=True)
-    created_at = fields.DateTime(format="iso", dump_only=True)
+    group_id = fields.Int(required=True)
+    created_at = fields.DateTime(format="iso", required=False)
 
     class Meta:
         unknown = EXCLUDE
@@ -79,6 +98,146 @@ class PrivateMessageSchema(Schema):
         unknown = EXCLUDE
 
 
+# история переписки: личной (peer_id) или группы (group_id), постранично по id сообщений
+class GetHistorySchema(Schema):
+    type = fields.Str(required=True, validate=validate.Equal("get_history"))
+    peer_id = fields.Int(required=False)
+    group_id = fields.Int(required=False)
+    # сообщения старше before_id или новее after_id; без них - последние
+    before_id = fields.Int(required=False, validate=validate.Range(min=1))
+    after_id = fields.Int(required=False, validate=validate.Range(min=0))
+    limit = fields.Int(load_default=50, validate=validate.Range(min=1))
+
+    class Meta:
+        unknown = EXCLUDE
+
+    @validates_schema
+    def validate_target(self, data, **kwargs):
+        if ('peer_id' in data) == ('group_id' in data):
+            raise ValidationError("Exactly one of peer_id or group_id is required")
+        if 'before_id' in data and 'after_id' in data:
+            raise ValidationError("Use either before_id or after_id")
+
+
+# страница истории
+class HistorySchema(Schema):
+    type = fields.Str(required=True, validate=validate.Equal("history"))
+    peer_id = fields.Int(required=False)
+    group_id = fields.Int(required=False)
+    messages = fields.List(fields.Dict(), required=True)
+    has_more = fields.Bool(required=True)
+
+    class Meta:
+        unknown = EXCLUDE
+
+
+# выгрузка всей переписки (или диапазона id) кадрами history_chunk
+class ExportHistorySchema(Schema):
+    type = fields.Str(required=True, validate=validate.Equal("export_history"))
+    peer_id = fields.Int(required=False)
+    group_id = fields.Int(required=False)
+    # границы диапазона, обе необязательны
+    after_id = fields.Int(required=False, validate=validate.Range(min=0))
+    before_id = fields.Int(required=False, validate=validate.Range(min=1))
+
+    class Meta:
+        unknown = EXCLUDE
+
+    @validates_schema
+    def validate_target(self, data, **kwargs):
+        if ('peer_id' in data) == ('group_id' in data):
+            raise ValidationError("Exactly one of peer_id or group_id is required")
+
+
+# очередная часть выгрузки; done=True - последний кадр, count - сколько сообщений отправлено
+class HistoryChunkSchema(Schema):
+    type = fields.Str(required=True, validate=validate.Equal("history_chunk"))
+    peer_id = fields.Int(required=False)
+    group_id = fields.Int(required=False)
+    seq = fields.Int(required=True)
+    messages = fields.List(fields.Dict(), required=True)
+    done = fields.Bool(required=True)
+    count = fields.Int(required=False)
+
+    class Meta:
+        unknown = EXCLUDE
+
+
+# полнотекстовый поиск по своим перепискам; без peer_id/group_id - по всем
+class SearchMessagesSchema(Schema):
+    type = fields.Str(required=True, validate=validate.Equal("search_messages"))
+    query = fields.Str(required=True, validate=validate.Length(min=1, max=200))
+    peer_id = fields.Int(required=False)
+    group_id = fields.Int(required=False)
+    # ключ последнего результата предыдущей страницы
+    after_rank = fields.Float(required=False)
+    after_id = fields.Int(required=False, validate=validate.Range(min=1))
+    limit = fields.Int(load_default=20, validate=validate.Range(min=1))
+
+    class Meta:
+        unknown = EXCLUDE
+
+    @validates_schema
+    def validate_target(self, data, **kwargs):
+        if 'peer_id' in data and 'group_id' in data:
+            raise ValidationError("Use either peer_id or group_id")
+        if ('after_rank' in data) != ('after_id' in data):
+            raise ValidationError("after_rank and after_id go together")
+        if not data['query'].strip():
+            raise ValidationError("Empty search query")
+
+
+# страница результатов поиска; next_rank/next_id - ключ для следующей страницы
+class SearchResultsSchema(Schema):
+    type = fields.Str(required=True, validate=validate.Equal("search_results"))
+    query = fields.Str(required=True)
+    results = fields.List(fields.Dict(), required=True)
+    has_more = fields.Bool(required=True)
+    next_rank = fields.Float(required=False)
+    next_id = fields.Int(required=False)
+
+    class Meta:
+        unknown = EXCLUDE
+
+
+# индикатор набора текста: от клиента - peer_id или group_id, серверу отвечать не нужно;
+# получателям - тот же кадр с sender_id. active=False - перестал печатать
+class TypingSchema(Schema):
+    type = fields.Str(required=True, validate=validate.Equal("typing"))
+    peer_id = fields.Int(required=False)
+    group_id = fields.Int(required=False)
+    sender_id = fields.Int(required=False)
+    active = fields.Bool(load_default=True)
+
+    class Meta:
+        unknown = EXCLUDE
+
+    @validates_schema
+    def validate_target(self, data, **kwargs):
+        if ('peer_id' in data) == ('group_id' in data):
+            raise ValidationError("Exactly one of peer_id or group_id is required")
+
+
+# полное состояние присутствия одобренных контактов (ответ - кадр presence с full=True)
+class GetPresenceSchema(Schema):
+    type = fields.Str(required=True, validate=validate.Equal("get_presence"))
+
+    class Meta:
+        unknown = EXCLUDE
+
+
+# присутствие контактов: online - вошедшие, offline - вышедшие с временем last_seen;
+# без full - только изменения за интервал рассылки
+class PresenceSchema(Schema):
+    type = fields.Str(required=True, validate=validate.Equal("presence"))
+    online = fields.List(fields.Int(), required=True)
+    offline = fields.List(fields.Dict(), required=True)
+    full = fields.Bool(load_default=False)
+
+    class Meta:
+        unknown = EXCLUDE
+
+
 # получение списка контактов
 
 # Команда Для получения списка контактов и групп
@@ -88,6 +247,15 @@ class GetUserContactsSchema(Schema):
     class Meta:
         unknown = EXCLUDE
 
+# запрос в контакты, подтверждение запроса и удаление контакта
+class ContactRequestSchema(Schema):
+    type = fields.Str(required=True, validate=validate.OneOf(["add_contact", "approve_contact", "delete_contact"]))
+    contact_id = fields.Int(required=True)
+    custom_nickname = fields.Str(required=False, validate=validate.Length(max=50))
+
+    class Meta:
+        unknown = EXCLUDE
+
 
 class OneContactSchema(Schema):
     user_id = fields.Int(required=True)
@@ -0,0 +1,190 @@
+# Исходящая очередь соединения: отправка идёт в отдельной задаче, а не в обработчике отправителя
+import asyncio
+import os
+import time
+from collections import deque
+from enum import Enum
+
+import websockets
+
+from .tracing import current_span
+
+# при такой глубине очереди соединение считается перегруженным
+OUTBOUND_HIGH_WATERMARK = int(os.getenv("OUTBOUND_HIGH_WATERMARK", "1000"))
+# перегрузка снимается, когда очередь опустится до этой глубины
+OUTBOUND_LOW_WATERMARK = int(os.getenv("OUTBOUND_LOW_WATERMARK", "250"))
+# сколько ожидающих кадров склеивать в один batch
+OUTBOUND_COALESCE_MAX = int(os.getenv("OUTBOUND_COALESCE_MAX", "64"))
+
+
+# что делать с кадрами, пока соединение перегружено.
+# Кадр сообщения не теряется ни при какой политике: статус доставки уже записан,
+# поэтому сообщение возвращается в офлайн-хранилище (on_spill); теряются только кадры без message_id
+class OverflowPolicy(Enum):
+    DROP = "drop"               # новые кадры отбрасываются, сообщения - в офлайн-хранилище (как spill)
+    DISCONNECT = "disconnect"   # медленный клиент отключается
+    SPILL = "spill"             # сообщения возвращаются в офлайн-хранилище
+
+
+OUTBOUND_OVERFLOW_POLICY = OverflowPolicy(os.getenv("OUTBOUND_OVERFLOW_POLICY", "spill"))
+
+
+class OutboundQueue:
+    """
+    Очередь кадров одного соединения. put() не ждёт сеть: кадр кладётся в очередь,
+    а отдельная задача-писатель отправляет их по порядку. Если в очереди накопилось
+    несколько кадров, они уходят одним кадром {"type": "batch", "messages": [...]}.
+    Кадры с message_id при отбрасывании или закрытии соединения передаются в on_spill,
+    чтобы сообщение было доставлено позже. Эфемерные кадры (offer) отбрасываются первыми:
+    уже с низкой отметки, задолго до того, как перегрузка коснётся сообщений.
+    """
+
+    __slots__ = ("websocket", "high", "low", "coalesce_max", "policy", "on_spill",
+                 "dropped", "shed", "_frames", "_wakeup", "_drained", "_congested", "_closed", "_task")
+
+    def __init__(self, websocket, on_spill=None,
+                 high: int = OUTBOUND_HIGH_WATERMARK,
+                 low: int = OUTBOUND_LOW_WATERMARK,
+                 coalesce_max: int = OUTBOUND_COALESCE_MAX,
+                 policy: OverflowPolicy = OUTBOUND_OVERFLOW_POLICY):
+        self.websocket = websocket
+        self.high = high
+        self.low = min(low, high)
+        self.coalesce_max = max(1, coalesce_max)
+        self.policy = policy
+        # on_spill(message_ids) - сообщения, которые не ушли клиенту
+        self.on_spill = on_spill
+        # сколько кадров отброшено из-за перегрузки
+        self.dropped = 0
+        # сколько эфемерных кадров не принято из-за глубины очереди
+        self.shed = 0
+        # (кадр, message_id или None, интервал трассы и время постановки или None)
+        self._frames: deque[tuple[str, int | None, tuple | None]] = deque()
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._congested = False
+        self._closed = False
+        self._task: asyncio.Task | None = None
+
+    @property
+    def depth(self) -> int:
+        """Текущая глубина очереди"""
+        return len(self._frames)
+
+    @property
+    def congested(self) -> bool:
+        return self._congested
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def start(self):
+        self._task = asyncio.create_task(self._writer())
+
+    def put(self, frame: str, message_id: int = None) -> bool:
+        """Ставит кадр в очередь; False - кадр не принят (перегрузка или соединение закрыто)"""
+        if self._closed:
+            self._spill(message_id)
+            return False
+        if self._congested or len(self._frames) >= self.high:
+            self._congested = True
+            return self._overflow(message_id)
+        span = current_span.get()
+        self._frames.append((frame, message_id, None if span is None else (span, time.time_ns())))
+        self._drained.clear()
+        self._wakeup.set()
+        return True
+
+    def offer(self, frame: str) -> bool:
+        """
+        Эфемерный кадр (typing): принимается, только пока очередь ниже низкой отметки,
+        при нехватке места просто теряется, в офлайн-хранилище не попадает
+        """
+        if self._closed or self._congested or len(self._frames) >= self.low:
+            self.shed += 1
+            return False
+        self._frames.append((frame, None, None))
+        self._drained.clear()
+        self._wakeup.set()
+        return True
+
+    def _overflow(self, message_id) -> bool:
+        self.dropped += 1
+        if self.policy is OverflowPolicy.DISCONNECT:
+            self._spill(message_id)
+            self.close()
+            asyncio.ensure_future(self.websocket.close(code=1013, reason="slow consumer"))
+        else:
+            self._spill(message_id)
+        return False
+
+    def _spill(self, message_id):
+        if message_id is not None and self.on_spill is not None:
+            self.on_spill((message_id,))
+
+    async def drained(self):
+        """Ждёт, пока все кадры очереди уйдут в сокет"""
+        await self._drained.wait()
+
+    async def _writer(self):
+        frames = self._frames
+        websocket = self.websocket
+        in_flight = ()
+        try:
+            while True:
+                if not frames:
+                    self._drained.set()
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                if len(frames) == 1:
+                    in_flight = (frames.popleft(),)
+                    sending = time.time_ns()
+                    await websocket.send(in_flight[0][0])
+                else:
+                    # склеиваем накопившиеся кадры в один, без повторной сериализации
+                    in_flight = tuple(frames.popleft() for _ in range(min(len(frames), self.coalesce_max)))
+                    sending = time.time_ns()
+                    await websocket.send(
+                        '{"type": "batch", "messages": [' + ','.join(f for f, *_ in in_flight) + ']}'
+                    )
+                for _, message_id, traced in in_flight:
+                    if traced is not None:
+                        self._trace_send(traced, message_id, sending, len(in_flight))
+                in_flight = ()
+                if self._congested and len(frames) <= self.low:
+                    self._congested = False
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self._closed = True
+            self._release(in_flight)
+
+    @staticmethod
+    def _trace_send(traced, message_id, sending: int, frames: int):
+        """Ожидание в очереди и websocket.send получателя - в трассу кадра, который поставил этот кадр"""
+        span, queued = traced
+        span.record("outbound.queue", queued, sending, message_id=message_id)
+        span.record("outbound.send", sending, frames=frames, message_id=message_id)
+
+    def _release(self, in_flight=()):
+        """Отдаёт в on_spill сообщения, которые так и не ушли клиенту"""
+        if self.on_spill is not None:
+            message_ids = [mid for _, mid, _ in in_flight if mid is not None]
+            message_ids.extend(mid for _, mid, _ in self._frames if mid is not None)
+            if message_ids:
+                self.on_spill(message_ids)
+        self._frames.clear()
+        self._drained.set()
+
+    def close(self):
+        """Останавливает писателя; неотправленные сообщения уходят в on_spill"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._task is not None and not self._task.done():
+            # кадр, который писатель отправлял в этот момент, отдаст его finally
+            self._task.cancel()
+        self._release()
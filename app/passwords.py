@@ -0,0 +1,108 @@
+# Хеширование паролей (PBKDF2) вне цикла событий
+import asyncio
+import hashlib
+import hmac
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .metrics import registry
+
+PBKDF2_ITERATIONS = 100000
+
+# сколько процессов считают PBKDF2 одновременно
+KDF_WORKERS = int(os.getenv("KDF_WORKERS", os.cpu_count() or 1))
+# сколько запросов может ждать свободный процесс, остальные сразу отклоняются
+KDF_MAX_QUEUE = int(os.getenv("KDF_MAX_QUEUE", "64"))
+
+# ожидание свободного процесса, само хеширование и отказы при переполнении очереди
+KDF_QUEUE_SECONDS = registry.histogram("messenger_kdf_queue_wait_seconds",
+                                       "Time a PBKDF2 request waits for a free worker")
+KDF_HASH_SECONDS = registry.histogram("messenger_kdf_hash_seconds", "PBKDF2 computation time in the worker pool")
+KDF_REJECTED = registry.counter("messenger_kdf_rejected_total", "PBKDF2 requests rejected as busy")
+
+
+def hash_password(password: str, salt: bytes) -> str:
+    """Генерация хеша пароля с использованием предоставленного salt"""
+    key = hashlib.pbkdf2_hmac(
+        'sha256',
+        password.encode('utf-8'),
+        salt,
+        PBKDF2_ITERATIONS
+    )
+    return key.hex()
+
+
+class HasherBusy(Exception):
+    """Очередь на хеширование переполнена, клиенту стоит повторить позже"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Server busy, retry after {retry_after} s")
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    """
+    Пул процессов для PBKDF2. Цикл событий только ждёт результат,
+    поэтому вход пользователей не задерживает уже подключённых.
+    Одновременно считается не больше workers хешей, ещё max_queue ждут,
+    а запросы сверх этого отклоняются с подсказкой retry_after.
+    """
+
+    def __init__(self, workers: int = KDF_WORKERS, max_queue: int = KDF_MAX_QUEUE):
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self._executor: ProcessPoolExecutor | None = None
+        self._slots = asyncio.Semaphore(self.workers)
+        # запросы в работе и в очереди
+        self._pending = 0
+        # скользящее среднее времени одного хеша, секунды
+        self._avg_time = 0.05
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def queued(self) -> int:
+        return max(0, self._pending - self.workers)
+
+    def retry_after(self) -> float:
+        """Оценка времени, через которое очередь освободится"""
+        waves = math.ceil((self._pending + 1) / self.workers)
+        return round(waves * self._avg_time, 2)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def hash(self, password: str, salt: bytes) -> str:
+        if self._pending >= self.workers + self.max_queue:
+            KDF_REJECTED.inc()
+            raise HasherBusy(self.retry_after())
+        self._pending += 1
+        try:
+            queued = time.perf_counter()
+            async with self._slots:
+                started = time.perf_counter()
+                KDF_QUEUE_SECONDS.observe(started - queued)
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self._get_executor(), hash_password, password, salt
+                )
+                elapsed = time.perf_counter() - started
+                KDF_HASH_SECONDS.observe(elapsed)
+                self._avg_time = 0.9 * self._avg_time + 0.1 * elapsed
+                return result
+        finally:
+            self._pending -= 1
+
+    async def verify(self, password: str, salt: bytes, expected_hash: str) -> bool:
+        """Проверка пароля за постоянное время сравнения"""
+        return hmac.compare_digest(await self.hash(password, salt), expected_hash)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,150 @@
+"""
+Конвейер записи сообщений (group commit).
+
+Обработчики не пишут в БД сами: submit() ставит сообщение в общую очередь,
+а одна задача-писатель раз в MESSAGE_FLUSH_INTERVAL_MS миллисекунд или при
+накоплении MESSAGE_BATCH_SIZE сообщений (что наступит раньше) сохраняет
+всю пачку одним INSERT ... RETURNING и одним COMMIT.
+
+Гарантии:
+- долговечность: future отправителя разрешается только после COMMIT пачки,
+  поэтому рассылка и ответ message_sent уходят только для сохранённых сообщений;
+  при падении процесса теряются лишь сообщения, отправитель которых ещё не получил
+  подтверждения;
+- порядок: пачки пишутся последовательно одной задачей, внутри пачки строки
+  вставляются в порядке submit() (sort_by_parameter_order), поэтому id растут
+  в порядке поступления и сообщения одного отправителя не переставляются;
+- ошибки: если пачку отвергли данные (нарушение ограничения, неверное значение),
+  она делится пополам, пока не останутся строки, которые записать нельзя, - исключение
+  получают только их future. Если недоступна сама БД (соединение, пул, таймаут),
+  повторы бессмысленны: исключение сразу получают все future пачки, и писатель
+  не тратит batch_size таймаутов на повторы по одной строке.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+
+from sqlalchemy.exc import InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+
+from .crud import MessageCRUD
+from .msg_models import Message
+from .tracing import current_span
+
+# максимальный размер пачки
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "256"))
+# сколько ждать наполнения пачки, миллисекунды
+MESSAGE_FLUSH_INTERVAL_MS = float(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "5"))
+
+# ошибки доступа к БД, а не к данным пачки: повтор по частям упрётся в то же самое
+UNAVAILABLE_ERRORS = (OperationalError, InterfaceError, PoolTimeoutError, asyncio.TimeoutError, OSError)
+
+
+class MessageWriter:
+    """Накопитель вставок сообщений от всех соединений"""
+
+    def __init__(self, session_maker, batch_size: int = MESSAGE_BATCH_SIZE,
+                 flush_interval_ms: float = MESSAGE_FLUSH_INTERVAL_MS):
+        self.session_maker = session_maker
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval_ms / 1000
+        # (сообщение, участники группы не в сети, future, интервал трассы и время постановки или None)
+        self._queue: deque[tuple[Message, tuple, asyncio.Future, tuple | None]] = deque()
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._closing = False
+        # статистика: записанные пачки и сообщения
+        self.batches = 0
+        self.messages = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, message: Message, offline_ids=()) -> asyncio.Future:
+        """
+        Ставит сообщение в очередь записи. Future разрешается тем же объектом
+        message с заполненными id и created_at после COMMIT
+        """
+        future = asyncio.get_running_loop().create_future()
+        span = current_span.get()
+        self._queue.append((message, tuple(offline_ids), future,
+                            None if span is None else (span, time.time_ns())))
+        self._wakeup.set()
+        if len(self._queue) >= self.batch_size:
+            self._full.set()
+        return future
+
+    async def _run(self):
+        queue = self._queue
+        while True:
+            if not queue:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # ждём наполнения пачки, но не дольше flush_interval
+            if len(queue) < self.batch_size and not self._closing:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            batch = [queue.popleft() for _ in range(min(len(queue), self.batch_size))]
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        started = time.time_ns()
+        try:
+            async with self.session_maker() as session:
+                await MessageCRUD.insert_messages(
+                    session, [message for message, *_ in batch], [offline for _, offline, *_ in batch],
+                    commit=False
+                )
+                inserted = time.time_ns()
+                await session.commit()
+        except Exception as e:
+            if len(batch) > 1 and not self.is_unavailable(e):
+                # ищем сообщения, из-за которых не записалась пачка: половины пишутся по порядку
+                middle = len(batch) // 2
+                await self._flush(batch[:middle])
+                await self._flush(batch[middle:])
+                return
+            for _, _, future, traced in batch:
+                if traced is not None:
+                    traced[0].record("db.write", started, error=f"{type(e).__name__}: {e}")
+                if not future.done():
+                    future.set_exception(e)
+            return
+        committed = time.time_ns()
+        self.batches += 1
+        self.messages += len(batch)
+        for message, _, future, traced in batch:
+            if traced is not None:
+                # этапы записи - в трассу кадра, из которого пришло сообщение
+                span, queued = traced
+                span.set("message.id", message.id)
+                span.record("db.queue", queued, started)
+                span.record("db.insert", started, inserted, batch_size=len(batch))
+                span.record("db.commit", inserted, committed, batch_size=len(batch))
+            if not future.done():
+                future.set_result(message)
+
+    @staticmethod
+    def is_unavailable(error: Exception) -> bool:
+        """БД недоступна (а не отвергла данные пачки)"""
+        return isinstance(error, UNAVAILABLE_ERRORS) or getattr(error, "connection_invalidated", False)
+
+    async def close(self):
+        """Дописывает очередь и останавливает писателя"""
+        self._closing = True
+        self._wakeup.set()
+        self._full.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
@@ -0,0 +1,212 @@
+"""
+Присутствие: кто из контактов в сети и когда был в последний раз.
+
+Переходы в сеть и из сети не рассылаются сразу, а копятся PRESENCE_FLUSH_INTERVAL_MS
+миллисекунд. В конце интервала состояние пользователя сравнивается с тем, что было
+до первого перехода: кто успел выйти и вернуться, в рассылку не попадает вовсе.
+Каждый наблюдатель (у кого пользователь в одобренных контактах) получает за интервал
+не больше одного кадра presence со всеми изменениями своих контактов, одинаковые
+кадры сериализуются один раз. Наблюдатели не в сети ничего не получают.
+
+last_seen не пишется на каждый выход: время копится в памяти и раз в
+LAST_SEEN_FLUSH_INTERVAL секунд уходит в БД одним UPDATE.
+"""
+import asyncio
+import json
+import os
+from datetime import datetime
+
+from .contacts_cache import contact_watchers_cache
+from .crud import ContactCRUD, UserCRUD, utcnow
+from .log import get_logger
+
+# как часто рассылать накопленные переходы, миллисекунды
+PRESENCE_FLUSH_INTERVAL_MS = float(os.getenv("PRESENCE_FLUSH_INTERVAL_MS", "1000"))
+# как часто записывать last_seen в БД, секунды
+LAST_SEEN_FLUSH_INTERVAL = float(os.getenv("LAST_SEEN_FLUSH_INTERVAL", "30"))
+
+log = get_logger("presence")
+
+
+class PresenceService:
+    """Переходы в сеть/из сети для одобренных контактов и пачечная запись last_seen"""
+
+    def __init__(self, session_maker, connections, relay=None,
+                 flush_interval_ms: float = PRESENCE_FLUSH_INTERVAL_MS,
+                 last_seen_interval: float = LAST_SEEN_FLUSH_INTERVAL):
+        self.session_maker = session_maker
+        # локальные сессии (ConnectionRegistry) и шина к другим узлам
+        self.connections = connections
+        self.relay = relay
+        self.flush_interval = flush_interval_ms / 1000
+        self.last_seen_interval = last_seen_interval
+        # user_id -> был ли пользователь в сети до первого перехода в текущем интервале
+        self._changed: dict[int, bool] = {}
+        # user_id -> время выхода, ещё не записанное в БД
+        self._last_seen: dict[int, datetime] = {}
+        self._closed = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        # статистика: рассылки, отправленные кадры, записи last_seen
+        self.flushes = 0
+        self.frames = 0
+        self.last_seen_writes = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Останавливает рассылку и дописывает last_seen"""
+        self._closed.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self._flush_last_seen()
+
+    def is_online(self, user_id: int) -> bool:
+        if self.connections.is_online(user_id):
+            return True
+        return self.relay is not None and self.relay.directory.is_online(user_id)
+
+    async def watchers(self, user_id: int) -> frozenset:
+        """Кто держит пользователя в одобренных контактах (видит его присутствие)"""
+        return (await self._watchers([user_id]))[user_id]
+
+    # region Переходы
+    def online(self, user_id: int):
+        """Первая сессия пользователя на этом узле"""
+        # уже в сети на другом узле - для контактов ничего не меняется
+        remote = self.relay is not None and self.relay.directory.is_online(user_id)
+        self._changed.setdefault(user_id, remote)
+
+    def offline(self, user_id: int):
+        """Последняя сессия пользователя на этом узле закрыта"""
+        self._changed.setdefault(user_id, True)
+        if not self.is_online(user_id):
+            self._last_seen[user_id] = utcnow()
+    # endregion
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_last_seen = loop.time() + self.last_seen_interval
+        while not self._closed.is_set():
+            try:
+                await asyncio.wait_for(self._closed.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self._flush_changes()
+                if loop.time() >= next_last_seen:
+                    next_last_seen = loop.time() + self.last_seen_interval
+                    await self._flush_last_seen()
+            except Exception:
+                log.exception("Error flushing presence")
+
+    async def _flush_changes(self):
+        changed, self._changed = self._changed, {}
+        came, left = [], []
+        for user_id, was_online in changed.items():
+            now_online = self.is_online(user_id)
+            if now_online != was_online:
+                (came if now_online else left).append(user_id)
+        if not came and not left:
+            return
+        self.flushes += 1
+        watchers = await self._watchers(came + left)
+
+        # наблюдатель -> (вошедшие, вышедшие)
+        diffs: dict[int, tuple[list, list]] = {}
+        for user_id in came:
+            for watcher in watchers[user_id]:
+                diffs.setdefault(watcher, ([], []))[0].append(user_id)
+        for user_id in left:
+            for watcher in watchers[user_id]:
+                diffs.setdefault(watcher, ([], []))[1].append(user_id)
+
+        # (вошедшие, вышедшие) -> кадр и наблюдатели на других узлах
+        frames: dict[tuple, tuple[str, list]] = {}
+        sessions = self.connections.sessions
+        for watcher, (watcher_came, watcher_left) in diffs.items():
+            if not self.is_online(watcher):
+                continue
+            key = (tuple(watcher_came), tuple(watcher_left))
+            entry = frames.get(key)
+            if entry is None:
+                entry = frames[key] = (self.encode(watcher_came, watcher_left), [])
+            receivers = sessions(watcher)
+            for receiver in receivers:
+                receiver.outbound.put(entry[0])
+            if not receivers:
+                entry[1].append(watcher)
+            self.frames += 1
+        if self.relay is not None:
+            for frame, remote in frames.values():
+                if remote:
+                    self.relay.route(remote, frame)
+
+    async def _watchers(self, user_ids: list[int]) -> dict[int, frozenset]:
+        """Наблюдатели из кеша; промахи - одним запросом"""
+        result, missing = {}, []
+        for user_id in user_ids:
+            watchers = contact_watchers_cache.get(user_id)
+            if watchers is None:
+                missing.append(user_id)
+            else:
+                result[user_id] = watchers
+        if missing:
+            version = contact_watchers_cache.version
+            async with self.session_maker() as session:
+                loaded = await ContactCRUD.get_watchers(session, missing)
+            for user_id in missing:
+                watchers = frozenset(loaded.get(user_id, ()))
+                contact_watchers_cache.put(user_id, watchers, version)
+                result[user_id] = watchers
+        return result
+
+    async def _flush_last_seen(self):
+        if not self._last_seen:
+            return
+        seen, self._last_seen = self._last_seen, {}
+        try:
+            async with self.session_maker() as session:
+                await UserCRUD.set_last_seen(session, seen)
+            self.last_seen_writes += 1
+        except Exception:
+            log.exception("Error storing last_seen", extra={"users": len(seen)})
+            # не записанное попробуем в следующий раз, более свежие значения важнее
+            for user_id, moment in seen.items():
+                self._last_seen.setdefault(user_id, moment)
+
+    def encode(self, came: list[int], left: list[int]) -> str:
+        return json.dumps({
+            "type": "presence",
+            "online": came,
+            "offline": [{"id": user_id, "last_seen": self._format(self._last_seen.get(user_id))}
+                        for user_id in left],
+        })
+
+    @staticmethod
+    def _format(moment: datetime | None) -> str | None:
+        return moment.isoformat() if moment is not None else None
+
+    async def snapshot(self, user_id: int) -> dict:
+        """Полное состояние одобренных контактов пользователя (ответ на get_presence)"""
+        async with self.session_maker() as session:
+            contacts = await ContactCRUD.get_presence_list(session, user_id)
+        online, offline = [], []
+        for contact_id, last_seen in contacts:
+            if self.is_online(contact_id):
+                online.append(contact_id)
+            else:
+                # ещё не записанное в БД время свежее
+                last_seen = self._last_seen.get(contact_id, last_seen)
+                offline.append({"id": contact_id, "last_seen": self._format(last_seen)})
+        return {"type": "presence", "full": True, "online": online, "offline": offline}
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._changed),
+            "flushes": self.flushes,
+            "frames": self.frames,
+            "last_seen_pending": len(self._last_seen),
+            "last_seen_writes": self.last_seen_writes,
+        }
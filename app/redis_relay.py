@@ -0,0 +1,385 @@
+# Шина между узлами через Redis (протокол RESP) и простой заменитель Redis для разработки
+import asyncio
+import json
+import os
+from collections import deque
+from urllib.parse import urlsplit
+
+from .log import get_logger
+from .relay import RelayBackend
+
+# ключи и каналы шины в Redis
+RELAY_PREFIX = os.getenv("RELAY_PREFIX", "relay")
+# пауза перед повторным подключением к Redis после обрыва, секунды; растёт вдвое до RELAY_RECONNECT_MAX
+RELAY_RECONNECT_DELAY = float(os.getenv("RELAY_RECONNECT_DELAY", "0.5"))
+RELAY_RECONNECT_MAX = float(os.getenv("RELAY_RECONNECT_MAX", "10"))
+
+log = get_logger("relay")
+
+
+class RespError(Exception):
+    """Ответ-ошибка сервера Redis"""
+
+
+# region Протокол RESP
+def encode_command(*args) -> bytes:
+    """Команда как массив bulk-строк"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        return RespError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        size = int(rest)
+        if size < 0:
+            return None
+        return (await reader.readexactly(size + 2))[:-2]
+    if kind == b"*":
+        size = int(rest)
+        if size < 0:
+            return None
+        return [await read_reply(reader) for _ in range(size)]
+    raise RespError(f"Unknown reply type: {line!r}")
+
+
+def encode_reply(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, RespError):
+        return b"-%s\r\n" % str(value).encode()
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        return b"+%s\r\n" % value.encode()
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    return b"*%d\r\n" % len(value) + b"".join(encode_reply(item) for item in value)
+# endregion
+
+
+class RespClient:
+    """
+    Минимальный клиент Redis: команды отправляются без ожидания друг друга
+    (конвейер), ответы сопоставляются с запросами по порядку.
+    В режиме подписки входящие сообщения передаются в on_message(channel, data)
+    """
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.on_message = None
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._waiting: deque[asyncio.Future] = deque()
+        # подписка в процессе: (future, сколько каналов должно подтвердиться)
+        self._subscribing: tuple[asyncio.Future, int] | None = None
+        self._task: asyncio.Task | None = None
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._task = asyncio.create_task(self._read_replies())
+
+    def send(self, *args) -> asyncio.Future:
+        """Отправляет команду, возвращает future ответа (ждать не обязательно)"""
+        future = asyncio.get_running_loop().create_future()
+        if self._writer is None or self._writer.is_closing():
+            future.set_exception(ConnectionError("Not connected"))
+            return future
+        self._waiting.append(future)
+        self._writer.write(encode_command(*args))
+        return future
+
+    async def command(self, *args):
+        reply = await self.send(*args)
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    async def subscribe(self, *channels):
+        """Подписка; после неё соединение только принимает сообщения"""
+        confirmed = asyncio.get_running_loop().create_future()
+        # подтверждения приходят по одному на канал, в каждом - число подписок соединения
+        self._subscribing = (confirmed, len(channels))
+        self._writer.write(encode_command("SUBSCRIBE", *channels))
+        await confirmed
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._task is not None:
+            self._task.cancel()
+        self._fail_waiting(ConnectionError("Connection closed"))
+
+    async def wait_lost(self):
+        """Ждёт обрыва соединения (чтение ответов закончилось)"""
+        if self._task is not None:
+            await asyncio.shield(self._task)
+
+    def _fail_waiting(self, error: Exception):
+        while self._waiting:
+            future = self._waiting.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    async def _read_replies(self):
+        try:
+            while True:
+                reply = await read_reply(self._reader)
+                if isinstance(reply, list) and reply and reply[0] in (b"message", b"subscribe"):
+                    if reply[0] == b"message":
+                        if self.on_message is not None:
+                            self.on_message(reply[1].decode(), reply[2])
+                        continue
+                    # подтверждение подписки: ждущий subscribe() завершается на последнем канале
+                    if self._subscribing is not None and reply[2] >= self._subscribing[1]:
+                        self._subscribing[0].set_result(None)
+                        self._subscribing = None
+                    continue
+                if self._waiting:
+                    future = self._waiting.popleft()
+                    if not future.done():
+                        future.set_result(reply)
+        except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+            if self._subscribing is not None:
+                self._subscribing[0].set_exception(ConnectionError(str(e)))
+                self._subscribing = None
+            self._fail_waiting(ConnectionError(str(e)))
+
+
+class RedisRelay(RelayBackend):
+    """
+    Шина между узлами через Redis. Кто где в сети - множество {prefix}:users:{node}
+    и события в канале {prefix}:presence (локальная копия каталога обновляется по ним);
+    пачки доставок - PUBLISH в канал узла {prefix}:node:{node}.
+    PUBLISH, который никто не принял, означает, что узла больше нет.
+    Оба соединения держит одна задача: при обрыве любого она переподключается
+    с растущей паузой, заново подписывается и объявляет снимок своих пользователей.
+    Пока связи нет, доставки другим узлам возвращаются серверу как недоставленные
+    """
+
+    def __init__(self, node_id: str, url: str):
+        super().__init__(str(node_id))
+        self.url = url
+        self._commands = RespClient(url)
+        self._subscription = RespClient(url)
+        self._task: asyncio.Task | None = None
+        self._closing = False
+        # статистика: переподключения после обрыва
+        self.reconnects = 0
+
+    def _key(self, *parts) -> str:
+        return ":".join((RELAY_PREFIX, *map(str, parts)))
+
+    async def start(self):
+        # первое подключение - при запуске сервера: без Redis узел не стартует
+        await self._connect()
+        self._task = asyncio.create_task(self._keep_connected())
+
+    async def _connect(self):
+        self._commands = RespClient(self.url)
+        self._subscription = RespClient(self.url)
+        await self._commands.connect()
+        await self._subscription.connect()
+        self._subscription.on_message = self._on_message
+        # сначала подписка, потом снимок: изменения, случившиеся между ними, не потеряются
+        await self._subscription.subscribe(self._key("presence"), self._key("node", self.node_id))
+        users_key = self._key("users", self.node_id)
+        await self._commands.command("DEL", users_key)
+        users = list(self.local_users())
+        if users:
+            await self._commands.command("SADD", users_key, *users)
+        await self._commands.command("SADD", self._key("nodes"), self.node_id)
+        # каталог собирается заново: за время обрыва узлы могли уйти или появиться
+        self.directory.clear()
+        for node in await self._commands.command("SMEMBERS", self._key("nodes")):
+            node = node.decode()
+            if node != self.node_id:
+                members = await self._commands.command("SMEMBERS", self._key("users", node))
+                self.directory.replace(node, [int(uid) for uid in members])
+        # узлы, которые сочли этот узел пропавшим (PUBLISH без подписчика), узнают о нём снова
+        await self._commands.command("PUBLISH", self._key("presence"), json.dumps(self._snapshot()))
+
+    async def _keep_connected(self):
+        while not self._closing:
+            lost = [asyncio.ensure_future(client.wait_lost()) for client in (self._commands, self._subscription)]
+            try:
+                await asyncio.wait(lost, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for waiter in lost:
+                    waiter.cancel()
+            if self._closing:
+                return
+            log.warning("Relay connection lost, reconnecting", extra={"node": self.node_id})
+            delay = RELAY_RECONNECT_DELAY
+            while not self._closing:
+                await self._subscription.close()
+                await self._commands.close()
+                try:
+                    await self._connect()
+                except (ConnectionError, OSError, RespError, asyncio.IncompleteReadError) as e:
+                    log.debug("Relay reconnect failed: %s", e, extra={"node": self.node_id})
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RELAY_RECONNECT_MAX)
+                    continue
+                self.reconnects += 1
+                log.info("Relay reconnected", extra={"node": self.node_id})
+                break
+
+    async def close(self):
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await super().close()
+        try:
+            await self._commands.command("SREM", self._key("nodes"), self.node_id)
+            await self._commands.command("DEL", self._key("users", self.node_id))
+            await self._commands.command("PUBLISH", self._key("presence"),
+                                         json.dumps({"op": "bye", "node": self.node_id}))
+        except (ConnectionError, RespError):
+            pass
+        await self._subscription.close()
+        await self._commands.close()
+
+    # команда без ожидания ответа; ошибку связи сообщать некому
+    def _send_command(self, *args) -> asyncio.Future:
+        future = self._commands.send(*args)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return future
+
+    def user_online(self, user_id: int):
+        self._send_command("SADD", self._key("users", self.node_id), user_id)
+        super().user_online(user_id)
+
+    def user_offline(self, user_id: int):
+        self._send_command("SREM", self._key("users", self.node_id), user_id)
+        super().user_offline(user_id)
+
+    def _publish(self, data: dict):
+        self._send_command("PUBLISH", self._key("presence"), json.dumps(data))
+
+    def _send(self, node, data: dict, items: list):
+        future = self._send_command("PUBLISH", self._key("node", node), json.dumps(data))
+        future.add_done_callback(lambda f: self._published(f, node, items))
+
+    def _published(self, future: asyncio.Future, node, items: list):
+        if future.cancelled() or future.exception() is not None or future.result() == 0:
+            # узел не подписан на свой канал - его больше нет
+            self.directory.drop_node(node)
+            self._fail(items)
+
+    def _on_message(self, channel: str, payload: bytes):
+        self._receive(json.loads(payload))
+
+
+class RespStandIn:
+    """
+    Заменитель Redis для разработки и тестов: команды, которые нужны шине
+    (PING, SADD, SREM, SMEMBERS, DEL, PUBLISH, SUBSCRIBE), данные в памяти
+    """
+
+    def __init__(self):
+        self._sets: dict[bytes, set[bytes]] = {}
+        self._subscribers: dict[bytes, set[asyncio.StreamWriter]] = {}
+        # соединения клиентов и задачи, которые их обслуживают
+        self._clients: dict[asyncio.StreamWriter, asyncio.Task] = {}
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self, host: str = "localhost", port: int = 6379):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return self._server
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            clients = list(self._clients.items())
+            for writer, _ in clients:
+                writer.close()
+            # обслуживание соединений заканчивается само, увидев конец потока
+            await asyncio.gather(*(task for _, task in clients), return_exceptions=True)
+            await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        channels = set()
+        self._clients[writer] = asyncio.current_task()
+        try:
+            while True:
+                request = await read_reply(reader)
+                if not isinstance(request, list) or not request:
+                    writer.write(encode_reply(RespError("ERR protocol error")))
+                    continue
+                name, args = request[0].upper(), request[1:]
+                if name == b"SUBSCRIBE":
+                    for channel in args:
+                        channels.add(channel)
+                        self._subscribers.setdefault(channel, set()).add(writer)
+                        writer.write(encode_reply([b"subscribe", channel, len(channels)]))
+                    continue
+                writer.write(encode_reply(self._execute(name, args)))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._clients.pop(writer, None)
+            for channel in channels:
+                self._subscribers.get(channel, set()).discard(writer)
+            writer.close()
+
+    def _execute(self, name: bytes, args: list):
+        if name == b"PING":
+            return "PONG"
+        if name == b"SADD":
+            members = self._sets.setdefault(args[0], set())
+            before = len(members)
+            members.update(args[1:])
+            return len(members) - before
+        if name == b"SREM":
+            members = self._sets.get(args[0], set())
+            before = len(members)
+            members.difference_update(args[1:])
+            return before - len(members)
+        if name == b"SMEMBERS":
+            return list(self._sets.get(args[0], ()))
+        if name == b"DEL":
+            return sum(self._sets.pop(key, None) is not None for key in args)
+        if name == b"PUBLISH":
+            message = encode_reply([b"message", args[0], args[1]])
+            subscribers = self._subscribers.get(args[0], ())
+            for subscriber in subscribers:
+                subscriber.write(message)
+            return len(subscribers)
+        return RespError(f"ERR unknown command '{name.decode()}'")
+
+
+# заменитель Redis отдельным процессом: python -m app.redis_relay [порт]
+if __name__ == "__main__":
+    import sys
+
+    async def run_stand_in(port: int):
+        server = await RespStandIn().start("localhost", port)
+        print(f"RESP stand-in running on redis://localhost:{port}")
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run_stand_in(int(sys.argv[1]) if len(sys.argv) > 1 else 6379))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,270 @@
+# Присутствие и пересылка кадров между узлами (процессами или машинами)
+import asyncio
+import json
+import os
+
+# сколько доставок отправлять одним сообщением на узел
+RELAY_BATCH_MAX = int(os.getenv("RELAY_BATCH_MAX", "512"))
+# сколько копить доставки перед отправкой; 0 - до конца текущей итерации цикла событий
+RELAY_FLUSH_INTERVAL_MS = float(os.getenv("RELAY_FLUSH_INTERVAL_MS", "0"))
+
+
+class PresenceDirectory:
+    """
+    Каталог присутствия: на каких других узлах у пользователя есть сессии.
+    У каждого узла своя копия, она пополняется сообщениями шины
+    (снимок при подключении, дальше изменения)
+    """
+
+    _EMPTY = frozenset()
+
+    def __init__(self):
+        # user_id -> узлы, где у пользователя есть сессии
+        self._by_user: dict[int, set] = {}
+        # узел -> его пользователи, чтобы разом убрать пропавший узел
+        self._by_node: dict[object, set[int]] = {}
+
+    def add(self, node, user_id: int):
+        self._by_user.setdefault(user_id, set()).add(node)
+        self._by_node.setdefault(node, set()).add(user_id)
+
+    def discard(self, node, user_id: int):
+        nodes = self._by_user.get(user_id)
+        if nodes is not None:
+            nodes.discard(node)
+            if not nodes:
+                del self._by_user[user_id]
+        users = self._by_node.get(node)
+        if users is not None:
+            users.discard(user_id)
+
+    def drop_node(self, node):
+        """Убирает все записи узла (связь с ним потеряна)"""
+        for user_id in self._by_node.pop(node, ()):
+            nodes = self._by_user.get(user_id)
+            if nodes is not None:
+                nodes.discard(node)
+                if not nodes:
+                    del self._by_user[user_id]
+
+    def clear(self):
+        """Забывает все узлы (каталог будет собран заново)"""
+        self._by_user.clear()
+        self._by_node.clear()
+
+    def replace(self, node, user_ids):
+        """Снимок пользователей узла вместо прежних записей"""
+        self.drop_node(node)
+        for user_id in user_ids:
+            self.add(node, user_id)
+
+    def nodes(self, user_id: int):
+        return self._by_user.get(user_id, self._EMPTY)
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self._by_user
+
+    def online_members(self, user_ids) -> list[int]:
+        """Пользователи из user_ids, которые в сети на других узлах"""
+        if len(user_ids) > len(self._by_user):
+            return [uid for uid in self._by_user if uid in user_ids]
+        return [uid for uid in user_ids if uid in self._by_user]
+
+    def __len__(self):
+        return len(self._by_user)
+
+
+class RelayBackend:
+    """
+    Общая часть шины между узлами. Узел объявляет, какие пользователи у него в сети,
+    и пересылает кадры узлам, где в сети получатели. Доставки копятся по узлу назначения
+    (до конца итерации цикла событий или RELAY_FLUSH_INTERVAL_MS) и уходят одним сообщением на узел.
+    Транспорт (Unix-сокеты, Redis, память процесса) реализует _publish и _send
+    """
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.directory = PresenceDirectory()
+        # обратные вызовы сервера
+        # on_deliver(user_ids, frame, message_id, ephemeral) - кадр для локальных сессий
+        self.on_deliver = None
+        # on_undelivered(user_id, message_ids) - кадр не дошёл до другого узла
+        self.on_undelivered = None
+        # on_invalidate_contacts(user_ids) - сбросить кеш списков контактов
+        self.on_invalidate_contacts = None
+        # on_invalidate_groups(group_ids) - сбросить кеш состава групп
+        self.on_invalidate_groups = None
+        # local_users() - пользователи в сети на этом узле, для снимка соседям
+        self.local_users = lambda: ()
+        # узел -> доставки [получатели, кадр, id сообщения(, эфемерный)], ждущие отправки
+        self._outbox: dict[object, list[list]] = {}
+        self._flush_handle: asyncio.Handle | None = None
+        # статистика: отправленные пачки и доставки в них
+        self.batches = 0
+        self.routed = 0
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush()
+
+    # region Исходящие сообщения
+    def user_online(self, user_id: int):
+        """Первая сессия пользователя на этом узле"""
+        self._publish({"op": "online", "node": self.node_id, "user": user_id})
+
+    def user_offline(self, user_id: int):
+        """Последняя сессия пользователя на этом узле закрыта"""
+        self._publish({"op": "offline", "node": self.node_id, "user": user_id})
+
+    def invalidate_contacts(self, user_ids):
+        """Изменились контакты пользователей: их списки и наблюдатели за ними"""
+        self._publish({"op": "invalidate_contacts", "node": self.node_id, "users": list(user_ids)})
+
+    def invalidate_groups(self, group_ids):
+        """Состав групп изменился: другие узлы перечитают его из БД"""
+        self._publish({"op": "invalidate_groups", "node": self.node_id, "groups": list(group_ids)})
+
+    def route(self, user_ids, frame: str, message_id: int = None, ephemeral: bool = False) -> int:
+        """
+        Ставит кадр в пачки узлов, где в сети пользователи из user_ids.
+        ephemeral - кадр можно потерять (typing), узел-получатель не держит его в перегруженных очередях.
+        Возвращает число таких узлов
+        """
+        by_node: dict[object, list[int]] = {}
+        nodes_of = self.directory.nodes
+        for user_id in user_ids:
+            for node in nodes_of(user_id):
+                by_node.setdefault(node, []).append(user_id)
+        for node, users in by_node.items():
+            item = [users, frame, message_id, True] if ephemeral else [users, frame, message_id]
+            self._outbox.setdefault(node, []).append(item)
+        if by_node and self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            if RELAY_FLUSH_INTERVAL_MS > 0:
+                self._flush_handle = loop.call_later(RELAY_FLUSH_INTERVAL_MS / 1000, self._flush)
+            else:
+                self._flush_handle = loop.call_soon(self._flush)
+        return len(by_node)
+
+    def _flush(self):
+        self._flush_handle = None
+        outbox, self._outbox = self._outbox, {}
+        for node, items in outbox.items():
+            for start in range(0, len(items), RELAY_BATCH_MAX):
+                batch = items[start:start + RELAY_BATCH_MAX]
+                self.batches += 1
+                self.routed += len(batch)
+                self._send(node, {"op": "deliver", "node": self.node_id, "items": batch}, batch)
+
+    def _fail(self, items):
+        """Доставки, которые не дошли до узла, возвращаются серверу"""
+        if self.on_undelivered is None:
+            return
+        for user_ids, _, message_id, *_ in items:
+            if message_id is not None:
+                for user_id in user_ids:
+                    self.on_undelivered(user_id, (message_id,))
+
+    def _snapshot(self) -> dict:
+        return {"op": "hello", "node": self.node_id, "users": list(self.local_users())}
+
+    # транспорт: сообщение всем остальным узлам
+    def _publish(self, data: dict):
+        raise NotImplementedError
+
+    # транспорт: сообщение одному узлу; items - доставки в нём (для _fail)
+    def _send(self, node, data: dict, items: list):
+        raise NotImplementedError
+    # endregion
+
+    # region Входящие сообщения
+    def _receive(self, data: dict):
+        op = data["op"]
+        node = data["node"]
+        if node == self.node_id:
+            return
+        if op == "deliver":
+            if self.on_deliver is not None:
+                for user_ids, frame, message_id, *ephemeral in data["items"]:
+                    self.on_deliver(user_ids, frame, message_id, bool(ephemeral))
+        elif op == "online":
+            self.directory.add(node, data["user"])
+        elif op == "offline":
+            self.directory.discard(node, data["user"])
+        elif op == "hello":
+            self.directory.replace(node, data["users"])
+        elif op == "bye":
+            self.directory.drop_node(node)
+        elif op == "invalidate_contacts":
+            if self.on_invalidate_contacts is not None:
+                self.on_invalidate_contacts(data["users"])
+        elif op == "invalidate_groups":
+            if self.on_invalidate_groups is not None:
+                self.on_invalidate_groups(data["groups"])
+    # endregion
+
+
+class MemoryRelayHub:
+    """Общая «сеть» для узлов MemoryRelay одного процесса"""
+
+    def __init__(self):
+        self.nodes: dict[object, "MemoryRelay"] = {}
+
+
+class MemoryRelay(RelayBackend):
+    """
+    Шина внутри одного процесса: несколько серверов в тестах.
+    Сообщения проходят через JSON и доставляются в следующей итерации цикла, как по сети
+    """
+
+    def __init__(self, node_id, hub: MemoryRelayHub):
+        super().__init__(node_id)
+        self.hub = hub
+
+    async def start(self):
+        for other in self.hub.nodes.values():
+            self._receive(other._snapshot())
+        self.hub.nodes[self.node_id] = self
+        self._publish(self._snapshot())
+
+    async def close(self):
+        await super().close()
+        self.hub.nodes.pop(self.node_id, None)
+        self._publish({"op": "bye", "node": self.node_id})
+
+    def _deliver(self, target: "MemoryRelay", data: dict):
+        asyncio.get_running_loop().call_soon(target._receive, json.loads(json.dumps(data)))
+
+    def _publish(self, data: dict):
+        for node, target in self.hub.nodes.items():
+            if node != self.node_id:
+                self._deliver(target, data)
+
+    def _send(self, node, data: dict, items: list):
+        target = self.hub.nodes.get(node)
+        if target is None:
+            self.directory.drop_node(node)
+            self._fail(items)
+            return
+        self._deliver(target, data)
+
+
+# общая сеть для relay-адреса memory:// (все серверы процесса)
+memory_hub = MemoryRelayHub()
+
+
+def create_relay(url: str, node_id) -> RelayBackend:
+    """
+    Шина по адресу: memory:// - внутри процесса, redis://host:port - через Redis
+    (или совместимый сервер)
+    """
+    if url.startswith("memory://"):
+        return MemoryRelay(node_id, memory_hub)
+    if url.startswith("redis://"):
+        from .redis_relay import RedisRelay
+        return RedisRelay(node_id, url)
+    raise ValueError(f"Unsupported relay url: {url}")
@@ -0,0 +1,58 @@
+# Подписанные токены сессии: переподключение без пароля и без запроса к БД
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+# секрет подписи; если не задан, генерируется при запуске (токены не переживут рестарт)
+SESSION_SECRET = os.getenv("SESSION_SECRET")
+# срок жизни токена, секунды
+SESSION_TOKEN_TTL = int(os.getenv("SESSION_TOKEN_TTL", str(7 * 24 * 3600)))
+
+
+def session_secret() -> bytes:
+    """
+    Секрет из SESSION_SECRET или случайный. Процессы, которые проверяют токены друг друга
+    (рабочие процессы --workers), должны получить один секрет: случайный генерируется
+    один раз до fork и передаётся в SessionTokens(secret=...)
+    """
+    return SESSION_SECRET.encode('utf-8') if SESSION_SECRET else os.urandom(32)
+
+
+class SessionTokens:
+    """
+    Токен вида "<user_id>.<expires>.<hmac-sha256>".
+    Проверка - одна HMAC без обращения к БД; отозвать токен до истечения срока нельзя,
+    только сменой SESSION_SECRET.
+    """
+
+    def __init__(self, secret: bytes = None, ttl: int = SESSION_TOKEN_TTL):
+        if secret is None:
+            secret = session_secret()
+        self._secret = secret
+        self.ttl = ttl
+
+    def _sign(self, payload: bytes) -> str:
+        digest = hmac.new(self._secret, payload, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+    def issue(self, user_id: int) -> tuple[str, int]:
+        """Выдаёт токен для пользователя, возвращает (токен, время истечения unix)"""
+        expires = int(time.time()) + self.ttl
+        payload = f"{user_id}.{expires}"
+        return f"{payload}.{self._sign(payload.encode('ascii'))}", expires
+
+    def verify(self, token: str) -> int | None:
+        """user_id из действительного токена или None"""
+        try:
+            payload, signature = token.rsplit('.', 1)
+            user_id, expires = payload.split('.')
+            user_id, expires = int(user_id), int(expires)
+        except (AttributeError, ValueError):
+            return None
+        if expires < time.time():
+            return None
+        if not hmac.compare_digest(signature.encode('utf-8'), self._sign(payload.encode('utf-8')).encode('ascii')):
+            return None
+        return user_id
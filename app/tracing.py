@@ -0,0 +1,351 @@
+"""
+Трассировка кадров: интервалы (spans) этапов от приёма кадра до отправки получателю.
+
+Решение о записи принимается один раз, при приёме кадра (head-based sampling):
+route_message вызывает tracer.start_trace(), и только для выбранных кадров
+(TRACE_SAMPLE_RATE, доля от 0 до 1) создаются интервалы. Для остальных кадров
+вся цена - одно сравнение и проверки "is not None" на этапах.
+
+Выбранный кадр - одна трасса с собственным trace_id. Её корневой интервал лежит
+в current_span, пока работает обработчик; код, который принимает работу для
+другой задачи (MessageWriter.submit, OutboundQueue.put), запоминает интервал
+вместе с работой, и задачи-писатели добавляют к той же трассе интервалы
+ожидания в очереди, INSERT, COMMIT и websocket.send у получателя.
+
+Завершённые интервалы уходят в экспортёр (TRACE_EXPORTER):
+- ring - кольцевой буфер в памяти, для тестов и отладки;
+- file:<путь> - JSON по интервалу на строку;
+- otlp или otlp:<url> - OTLP/HTTP JSON в локальный коллектор
+  (по умолчанию http://localhost:4318/v1/traces).
+Файл и коллектор пишутся из фонового потока через ограниченную очередь: цикл
+событий не ждёт ни диск, ни сеть, а лишние интервалы отбрасываются и считаются
+в messenger_trace_spans_dropped_total.
+"""
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from collections import deque
+from contextvars import ContextVar
+
+from .log import get_logger
+from .metrics import registry
+
+# доля кадров, которые трассируются; 0 - трассировка выключена
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# куда отдавать интервалы: ring | file:<путь> | otlp[:<url>]
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "ring")
+# сколько последних интервалов держит кольцевой буфер
+TRACE_RING_SIZE = int(os.getenv("TRACE_RING_SIZE", "4096"))
+# сколько интервалов может ждать фонового потока; сверх этого они теряются
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+# сколько интервалов записывать за раз (строк файла, интервалов в одном запросе OTLP)
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "512"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "messenger")
+OTLP_DEFAULT_URL = "http://localhost:4318/v1/traces"
+
+SPANS_SAMPLED = registry.counter("messenger_trace_sampled_total", "Frames selected for tracing")
+SPANS_DROPPED = registry.counter("messenger_trace_spans_dropped_total",
+                                 "Spans dropped because the exporter queue was full or the export failed")
+
+log = get_logger("tracing")
+
+# интервал, к которому присоединяются этапы текущей задачи
+current_span: ContextVar["Span | None"] = ContextVar("current_span", default=None)
+
+_getrandbits = random.getrandbits
+_random = random.random
+_now = time.time_ns
+
+
+class Span:
+    """Интервал трассы; время - наносекунды Unix (как в OTLP)"""
+
+    __slots__ = ("tracer", "trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns",
+                 "attributes", "error")
+
+    def __init__(self, tracer: "Tracer", trace_id: int, parent_id: int | None, name: str,
+                 attributes: dict = None, start_ns: int = None):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = _getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = _now() if start_ns is None else start_ns
+        self.end_ns: int | None = None
+        self.attributes = attributes or {}
+        self.error: str | None = None
+
+    def child(self, name: str, start_ns: int = None, **attributes) -> "Span":
+        """Начатый дочерний интервал; завершается вызовом end()"""
+        return Span(self.tracer, self.trace_id, self.span_id, name, attributes, start_ns)
+
+    def record(self, name: str, start_ns: int, end_ns: int = None, **attributes) -> int:
+        """Завершённый дочерний интервал [start_ns, end_ns]; возвращает end_ns - начало следующего этапа"""
+        span = Span(self.tracer, self.trace_id, self.span_id, name, attributes, start_ns)
+        span.end(end_ns)
+        return span.end_ns
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def fail(self, error: BaseException):
+        self.error = f"{type(error).__name__}: {error}"
+
+    def end(self, end_ns: int = None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = _now() if end_ns is None else end_ns
+        self.tracer.export(self)
+
+    @property
+    def duration_ns(self) -> int | None:
+        return None if self.end_ns is None else self.end_ns - self.start_ns
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": f"{self.trace_id:032x}",
+            "span_id": f"{self.span_id:016x}",
+            "parent_id": None if self.parent_id is None else f"{self.parent_id:016x}",
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_us": None if self.end_ns is None else (self.end_ns - self.start_ns) / 1000,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+# region Экспортёры
+class RingBufferExporter:
+    """Последние size интервалов в памяти; запись без блокировок, прямо из цикла событий"""
+
+    def __init__(self, size: int = TRACE_RING_SIZE):
+        self._spans: deque[Span] = deque(maxlen=max(1, size))
+
+    def export(self, span: Span):
+        self._spans.append(span)
+
+    def spans(self, trace_id: int = None) -> list[Span]:
+        """Интервалы в порядке завершения; trace_id - только одной трассы"""
+        if trace_id is None:
+            return list(self._spans)
+        return [span for span in self._spans if span.trace_id == trace_id]
+
+    def clear(self):
+        self._spans.clear()
+
+    def shutdown(self):
+        pass
+
+
+class BackgroundExporter:
+    """
+    Основа для экспортёров с медленной записью: export() кладёт интервал в очередь
+    (put_nowait), поток пишет пачками. Поток запускается при первом интервале
+    в процессе, поэтому рабочие процессы после fork заводят свой
+    """
+
+    def __init__(self, queue_size: int = TRACE_QUEUE_SIZE, batch_size: int = TRACE_BATCH_SIZE):
+        self.queue_size = queue_size
+        self.batch_size = max(1, batch_size)
+        self._queue: queue.Queue | None = None
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+        # статистика: записанные интервалы и неудачные записи
+        self.exported = 0
+        self.failures = 0
+
+    def export(self, span: Span):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            SPANS_DROPPED.inc()
+
+    def _start(self):
+        self._queue = queue.Queue(self.queue_size)
+        self._thread = threading.Thread(target=self._run, args=(self._queue,),
+                                        name=f"{type(self).__name__}", daemon=True)
+        self._thread.start()
+        self._pid = os.getpid()
+
+    def _run(self, spans: queue.Queue):
+        running = True
+        try:
+            while running:
+                batch = [spans.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(spans.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:
+                    # остановка: дописываем то, что пришло до неё
+                    running = False
+                    batch = [span for span in batch if span is not None]
+                if not batch:
+                    continue
+                try:
+                    self._write(batch)
+                    self.exported += len(batch)
+                except Exception as e:
+                    # коллектор недоступен - обычная ситуация, трассировка ошибки не нужна
+                    self.failures += 1
+                    SPANS_DROPPED.inc(len(batch))
+                    log.warning("Span export failed: %s", e, extra={"exporter": type(self).__name__,
+                                                                     "spans": len(batch)})
+        finally:
+            self._close()
+
+    def _write(self, batch: list[Span]):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+    def shutdown(self, timeout: float = 5):
+        """Дописывает очередь и останавливает поток"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+        self._pid = None
+
+
+class FileExporter(BackgroundExporter):
+    """Интервалы - JSON-строки в файле (дописываются в конец)"""
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._file = None
+
+    def _write(self, batch: list[Span]):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write("".join(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n"
+                                 for span in batch))
+        self._file.flush()
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # int64 в JSON-отображении protobuf - строка
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict) -> list[dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+class OtlpHttpExporter(BackgroundExporter):
+    """OTLP/HTTP с телом JSON (ExportTraceServiceRequest) - коллектор OpenTelemetry, Jaeger, Tempo"""
+
+    # SPAN_KIND_SERVER для корня трассы (приём кадра), INTERNAL для этапов
+    KIND_SERVER = 2
+    KIND_INTERNAL = 1
+
+    def __init__(self, url: str = OTLP_DEFAULT_URL, timeout: float = 5, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+        self.timeout = timeout
+
+    def _span(self, span: Span) -> dict:
+        entry = {
+            "traceId": f"{span.trace_id:032x}",
+            "spanId": f"{span.span_id:016x}",
+            "name": span.name,
+            "kind": self.KIND_SERVER if span.parent_id is None else self.KIND_INTERNAL,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": _otlp_attributes(span.attributes),
+        }
+        if span.parent_id is not None:
+            entry["parentSpanId"] = f"{span.parent_id:016x}"
+        if span.error is not None:
+            # STATUS_CODE_ERROR
+            entry["status"] = {"code": 2, "message": span.error}
+        return entry
+
+    def _write(self, batch: list[Span]):
+        # pid - при запросе: рабочие процессы после fork отдают свой
+        resource = {"attributes": _otlp_attributes({"service.name": TRACE_SERVICE_NAME, "process.pid": os.getpid()})}
+        body = json.dumps({"resourceSpans": [{
+            "resource": resource,
+            "scopeSpans": [{"scope": {"name": TRACE_SERVICE_NAME},
+                            "spans": [self._span(span) for span in batch]}],
+        }]}).encode()
+        request = urllib.request.Request(self.url, body, {"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+def create_exporter(spec: str):
+    """Экспортёр по строке: ring[:размер], file:<путь>, otlp[:<url>]"""
+    kind, _, argument = spec.partition(":")
+    if kind == "ring":
+        return RingBufferExporter(int(argument) if argument else TRACE_RING_SIZE)
+    if kind == "file" and argument:
+        return FileExporter(argument)
+    if kind == "otlp":
+        return OtlpHttpExporter(argument or OTLP_DEFAULT_URL)
+    raise ValueError(f"Unsupported trace exporter: {spec}")
+# endregion
+
+
+class Tracer:
+    """Выборка трасс и передача завершённых интервалов экспортёру"""
+
+    def __init__(self, sample_rate: float = 0.0, exporter=None):
+        self.sample_rate = 0.0
+        self.exporter = None
+        self.configure(sample_rate, exporter)
+
+    def configure(self, sample_rate: float, exporter=None):
+        """Меняет долю и экспортёр; прежний экспортёр дописывает свою очередь"""
+        if self.exporter is not None and exporter is not self.exporter:
+            self.exporter.shutdown()
+        self.sample_rate = min(1.0, max(0.0, sample_rate))
+        if exporter is None and self.sample_rate > 0:
+            exporter = RingBufferExporter()
+        self.exporter = exporter
+
+    def start_trace(self, name: str, **attributes) -> Span | None:
+        """Корневой интервал новой трассы или None, если кадр не выбран"""
+        rate = self.sample_rate
+        if rate <= 0.0 or (rate < 1.0 and _random() >= rate):
+            return None
+        SPANS_SAMPLED.inc()
+        return Span(self, _getrandbits(128), None, name, attributes)
+
+    def export(self, span: Span):
+        exporter = self.exporter
+        if exporter is not None:
+            exporter.export(span)
+
+    def shutdown(self):
+        if self.exporter is not None:
+            self.exporter.shutdown()
+
+
+# трассировщик процесса; настраивается из окружения или через configure()
+tracer = Tracer(TRACE_SAMPLE_RATE, create_exporter(TRACE_EXPORTER) if TRACE_SAMPLE_RATE > 0 else None)
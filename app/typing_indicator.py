@@ -0,0 +1,73 @@
+# Индикатор набора текста: эфемерные кадры без БД, с ограничением частоты на отправителя
+import os
+import time
+
+# сколько кадров typing в секунду может отправить пользователь (во все чаты вместе)
+TYPING_RATE = float(os.getenv("TYPING_RATE", "5"))
+# запас для коротких всплесков
+TYPING_BURST = float(os.getenv("TYPING_BURST", "10"))
+# повтор того же состояния в тот же чат раньше этого срока не пересылается, секунды
+TYPING_DEDUP_WINDOW = float(os.getenv("TYPING_DEDUP_WINDOW", "3"))
+
+
+class TypingLimiter:
+    """
+    Пропускает кадр typing, если он что-то меняет для получателей:
+    повтор того же состояния (active) в тот же чат внутри TYPING_DEDUP_WINDOW подавляется,
+    смена состояния проходит сразу. Сверх этого у отправителя токен-бакет
+    TYPING_RATE/TYPING_BURST на все чаты. Всё в памяти процесса
+    """
+
+    def __init__(self, rate: float = TYPING_RATE, burst: float = TYPING_BURST,
+                 window: float = TYPING_DEDUP_WINDOW, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.window = window
+        self.clock = clock
+        # user_id -> [токены, время последнего пополнения]
+        self._buckets: dict[int, list[float]] = {}
+        # user_id -> {чат: (active, когда переслано)}
+        self._last: dict[int, dict[tuple, tuple[bool, float]]] = {}
+        # статистика: пересланные, подавленные повторы, отклонённые по частоте
+        self.passed = 0
+        self.deduplicated = 0
+        self.limited = 0
+
+    def allow(self, user_id: int, chat: tuple, active: bool) -> bool:
+        """chat - ('peer', id) или ('group', id)"""
+        now = self.clock()
+        chats = self._last.get(user_id)
+        last = chats.get(chat) if chats is not None else None
+        if last is not None and last[0] == active and now - last[1] < self.window:
+            self.deduplicated += 1
+            return False
+
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            self.limited += 1
+            return False
+        bucket[0] -= 1
+
+        if chats is None:
+            chats = self._last[user_id] = {}
+        chats[chat] = (active, now)
+        self.passed += 1
+        return True
+
+    def forget(self, user_id: int):
+        """Пользователь ушёл из сети: его состояние больше не нужно"""
+        self._buckets.pop(user_id, None)
+        self._last.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "senders": len(self._buckets),
+            "passed": self.passed,
+            "deduplicated": self.deduplicated,
+            "limited": self.limited,
+        }
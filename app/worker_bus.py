@@ -0,0 +1,186 @@
+# Шина между рабочими процессами одного узла (режим --workers N)
+import asyncio
+import json
+import os
+from collections import deque
+
+from .log import get_logger
+from .relay import RelayBackend
+
+log = get_logger("relay")
+
+# пауза между попытками подключиться к соседнему процессу (он может ещё запускаться)
+BUS_RECONNECT_DELAY = float(os.getenv("BUS_RECONNECT_DELAY", "0.2"))
+# после стольких неудачных подключений подряд сосед считается упавшим:
+# его пользователи убираются из каталога, доставки ему возвращаются серверу
+BUS_CONNECT_ATTEMPTS = int(os.getenv("BUS_CONNECT_ATTEMPTS", "10"))
+# сколько строк с доставками может ждать отправки соседу; сверх этого доставки возвращаются серверу
+BUS_PENDING_MAX = int(os.getenv("BUS_PENDING_MAX", "10000"))
+# максимальная длина строки шины (пачка кадров для многих получателей)
+BUS_LINE_LIMIT = 16 * 1024 * 1024
+
+
+class _PeerLink:
+    """Исходящее соединение с соседним процессом: очередь строк и писатель"""
+
+    def __init__(self, worker: int, path: str):
+        self.worker = worker
+        self.path = path
+        # (строка, доставки в ней) - доставки нужны, чтобы вернуть недошедшее
+        self.pending: deque[tuple[bytes, list]] = deque()
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        # неудачные подключения подряд; down - сосед не поднимается, в очередь ничего не ставится
+        self.failures = 0
+        self.down = False
+
+    def send(self, line: bytes, items=()):
+        self.pending.append((line, items))
+        self.wakeup.set()
+
+    def take_undelivered(self) -> list:
+        """Забирает из очереди доставки, которые так и не ушли соседу"""
+        lost = [item for _, items in self.pending for item in items]
+        self.pending.clear()
+        return lost
+
+
+class WorkerBus(RelayBackend):
+    """
+    Шина процессов одного узла поверх Unix-сокетов: каждый процесс слушает свой сокет
+    и держит по исходящему соединению к каждому соседу. Сообщения - JSON-строки;
+    всё, что накопилось для соседа, уходит одной записью
+    """
+
+    def __init__(self, worker_id: int, workers: int, path: str):
+        super().__init__(worker_id)
+        self.worker_id = worker_id
+        self.workers = workers
+        # каталог, где лежат сокеты процессов
+        self.path = path
+        self._links: dict[int, _PeerLink] = {}
+        self._server: asyncio.AbstractServer | None = None
+        # входящие соединения от соседей
+        self._peers: set[asyncio.StreamWriter] = set()
+        self._closed = False
+
+    def socket_path(self, worker: int) -> str:
+        return os.path.join(self.path, f"worker-{worker}.sock")
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(
+            self._serve_peer, self.socket_path(self.worker_id), limit=BUS_LINE_LIMIT
+        )
+        for worker in range(self.workers):
+            if worker != self.worker_id:
+                link = _PeerLink(worker, self.socket_path(worker))
+                link.task = asyncio.create_task(self._run_link(link))
+                self._links[worker] = link
+
+    async def close(self):
+        await super().close()
+        self._closed = True
+        for link in self._links.values():
+            link.task.cancel()
+            self._fail(link.take_undelivered())
+        # закрытие транспорта завершает чтение соседа (без отмены задачи чтения)
+        for writer in list(self._peers):
+            writer.close()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    # region Исходящие сообщения
+    @staticmethod
+    def _encode(data: dict) -> bytes:
+        return json.dumps(data).encode() + b"\n"
+
+    def _publish(self, data: dict):
+        line = self._encode(data)
+        for link in self._links.values():
+            # упавший сосед после подключения получит снимок, изменения ему не нужны
+            if not link.down:
+                link.send(line)
+
+    def _send(self, node, data: dict, items: list):
+        link = self._links.get(node)
+        if link is None or link.down or len(link.pending) >= BUS_PENDING_MAX:
+            self._fail(items)
+            return
+        link.send(self._encode(data), items)
+
+    async def _run_link(self, link: _PeerLink):
+        while not self._closed:
+            try:
+                reader, writer = await asyncio.open_unix_connection(link.path)
+            except OSError:
+                # сосед ещё не поднял сокет или упал
+                link.failures += 1
+                if link.failures >= BUS_CONNECT_ATTEMPTS and not link.down:
+                    link.down = True
+                    self.directory.drop_node(link.worker)
+                    self._fail(link.take_undelivered())
+                await asyncio.sleep(BUS_RECONNECT_DELAY)
+                continue
+            link.failures = 0
+            link.down = False
+            in_flight = []
+            try:
+                # снимок своих пользователей, дальше соседу идут только изменения
+                writer.write(self._encode(self._snapshot()))
+                while True:
+                    if not link.pending:
+                        link.wakeup.clear()
+                        await link.wakeup.wait()
+                        continue
+                    # всё накопленное уходит одной записью
+                    in_flight = list(link.pending)
+                    link.pending.clear()
+                    writer.write(b"".join(line for line, _ in in_flight))
+                    await writer.drain()
+                    in_flight = []
+            except (ConnectionError, OSError):
+                # то, что не дошло до соседа, возвращается серверу как недоставленное
+                link.pending.extendleft(reversed(in_flight))
+                self._fail(link.take_undelivered())
+            finally:
+                writer.close()
+            await asyncio.sleep(BUS_RECONNECT_DELAY)
+    # endregion
+
+    # region Входящие сообщения
+    async def _serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._peers.add(writer)
+        worker = None
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # строка длиннее BUS_LINE_LIMIT: readline уже выбросил её из буфера,
+                    # хвост строки дочитается следующим readline и отбросится как битый JSON
+                    log.error("Bus line over limit dropped", extra={"node": self.node_id, "peer": worker})
+                    continue
+                if not line:
+                    break
+                # ошибка в одной строке (битый JSON, сбой обработчика) не останавливает чтение соседа
+                try:
+                    data = json.loads(line)
+                    if data["op"] == "hello":
+                        worker = data["node"]
+                    self._receive(data)
+                except Exception:
+                    log.exception("Bus line from peer failed", extra={"node": self.node_id, "peer": worker})
+        except (ConnectionError, OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._peers.discard(writer)
+            if worker is not None and not self._closed:
+                # процесс-сосед пропал: его пользователей больше нет в сети,
+                # а кадры, ещё не отправленные ему, становятся недоставленными
+                self.directory.drop_node(worker)
+                link = self._links.get(worker)
+                if link is not None:
+                    self._fail(link.take_undelivered())
+            writer.close()
+    # endregion
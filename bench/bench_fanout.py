@@ -0,0 +1,80 @@
+# Бенчмарк рассылки групповых сообщений: группы из 10, 1 000 и 10 000 участников
+# Запуск из корня репозитория: python bench/bench_fanout.py
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.connections import ConnectionState, ConnectionRegistry
+from app.fanout import FanoutEngine
+from app.outbound import OutboundQueue
+
+
+# сокет-заглушка: считает кадры, ничего не передаёт
+class NullSocket:
+    def __init__(self):
+        self.frames = 0
+
+    async def send(self, frame):
+        self.frames += 1
+
+    async def close(self, code=1000, reason=""):
+        pass
+
+
+async def run_case(members: int, online_ratio: float, rounds: int) -> dict:
+    registry = ConnectionRegistry()
+    online_count = int(members * online_ratio)
+    states = []
+    for uid in range(online_count):
+        websocket = NullSocket()
+        state = ConnectionState(websocket, OutboundQueue(websocket))
+        state.outbound.start()
+        registry.add(state)
+        registry.authorize(state, uid)
+        states.append(state)
+    member_ids = set(range(members))
+    fanout = FanoutEngine(registry)
+
+    enqueue = 0.0
+    total = 0.0
+    for i in range(rounds):
+        started = time.perf_counter()
+        frame = json.dumps({"type": "group_message", "id": i, "sender_id": 0, "group_id": 1,
+                            "content": "x" * 100, "is_group": True})
+        online = fanout.online_members(member_ids)
+        fanout.broadcast(frame, online, i)
+        enqueue += time.perf_counter() - started
+        # ждём, пока писатели отдадут кадр во все сокеты
+        for state in states:
+            await state.outbound.drained()
+        total += time.perf_counter() - started
+
+    for state in states:
+        state.outbound.close()
+    return {
+        "members": members,
+        "online": online_count,
+        "enqueue_ms": round(enqueue / rounds * 1000, 3),
+        "delivered_ms": round(total / rounds * 1000, 3),
+        "per_online_member_us": round(total / rounds / max(online_count, 1) * 1e6, 3),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Group fan-out benchmark")
+    parser.add_argument("--online-ratio", type=float, default=1.0, help="доля участников в сети")
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000])
+    args = parser.parse_args()
+
+    for members in args.sizes:
+        print(json.dumps(await run_case(members, args.online_ratio, args.rounds)))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,407 @@
+# Микробенчмарки горячего пути сервера со сравнением с сохранённой базой (bench/baseline.json)
+# Запуск из корня репозитория:
+#   python bench/bench_hotpath.py                 - замер и проверка против базы (код выхода 1 при регрессии)
+#   python bench/bench_hotpath.py --save          - записать текущие результаты как базу
+#   python bench/bench_hotpath.py --only schema   - только группы случаев, в имени которых есть подстрока
+# База зависит от машины: после смены железа или версии Python её нужно перезаписать (--save)
+import argparse
+import asyncio
+import gc
+import inspect
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# хеши строк одинаковы от запуска к запуску, иначе раскладка словарей (и время) плавает между процессами
+if os.getenv("PYTHONHASHSEED") is None:
+    os.execve(sys.executable, [sys.executable] + sys.argv, dict(os.environ, PYTHONHASHSEED="0"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# встроенная БД во временном каталоге; движок создаётся при импорте app.database
+BENCH_DIR = tempfile.mkdtemp(prefix="msg_bench_")
+os.environ["DATABASE_URL"] = os.getenv("BENCH_DATABASE_URL", f"sqlite+aiosqlite:///{BENCH_DIR}/bench.db")
+
+from marshmallow import Schema
+
+from app import msg_schemas
+from app.connections import ConnectionState
+from app.crud import MessageCRUD, UserCRUD
+from app.database import Base, async_session_maker, engine
+from app.msg_models import User
+from app.msg_schemas import OneContactClass, OneGroupClass, UserContactsClass
+from app.passwords import hash_password
+from msg_server import MessengerServer
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# во сколько раз (сверх 1) можно стать медленнее базы, прежде чем это считается регрессией
+BENCH_THRESHOLD = float(os.getenv("BENCH_THRESHOLD", "0.25"))
+
+# эталонный кадр для поправки на скорость машины
+REFERENCE_FRAME = {"type": "private_message", "sender_id": 1, "receiver_id": 2, "content": "x" * 100,
+                   "members": list(range(50))}
+
+NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+MESSAGE = {"id": 1, "sender_id": 1, "content": "x" * 100, "created_at": NOW.isoformat(), "is_group": False,
+           "receiver_id": 2}
+
+# пример кадра для каждой схемы app/msg_schemas.py: load(кадр) и dumps(кадр)
+SCHEMA_SAMPLES = {
+    "AuthSchema": {"type": "login", "username": "benchuser", "password": "benchpassword", "email": "b@x.io"},
+    "ResumeSchema": {"type": "resume", "token": "t" * 64},
+    "CreateGroupSchema": {"type": "create_group", "name": "bench group", "members": list(range(20))},
+    "UserSchema": {"username": "benchuser", "salt": "00" * 32, "password_hash": "ab" * 32, "email": "b@x.io"},
+    "GroupSchema": {"id": 1, "name": "bench group", "creator_id": 1, "created_at": NOW,
+                    "members": list(range(20))},
+    "GroupMessageSchema": {"type": "group_message", "group_id": 1, "content": "x" * 100},
+    "PrivateMessageSchema": {"type": "private_message", "sender_id": 1, "receiver_id": 2, "content": "x" * 100},
+    "GetHistorySchema": {"type": "get_history", "peer_id": 2, "before_id": 1000, "limit": 50},
+    "HistorySchema": {"type": "history", "peer_id": 2, "messages": [MESSAGE] * 50, "has_more": True},
+    "ExportHistorySchema": {"type": "export_history", "group_id": 1, "after_id": 0},
+    "HistoryChunkSchema": {"type": "history_chunk", "group_id": 1, "seq": 0, "messages": [MESSAGE] * 200,
+                           "done": False},
+    "SearchMessagesSchema": {"type": "search_messages", "query": "bench", "after_rank": 0.5, "after_id": 10},
+    "SearchResultsSchema": {"type": "search_results", "query": "bench", "results": [MESSAGE] * 20,
+                            "has_more": True, "next_rank": 0.5, "next_id": 10},
+    "TypingSchema": {"type": "typing", "peer_id": 2, "active": True},
+    "GetPresenceSchema": {"type": "get_presence"},
+    "PresenceSchema": {"type": "presence", "online": list(range(20)),
+                       "offline": [{"id": i, "last_seen": NOW.isoformat()} for i in range(20)]},
+    "GetUserContactsSchema": {"type": "get_user_contacts"},
+    "OneContactSchema": {"user_id": 2, "user_name": "contact", "custom_nickname": None, "status": "approved"},
+    "OneGroupSchema": {"group_id": 1, "group_name": "bench group", "custom_groupname": None, "status": "member"},
+    "UserContactsSchema": {"type": "user_contacts",
+                           "contacts": [{"user_id": i, "user_name": f"contact{i}", "custom_nickname": None,
+                                         "status": "approved"} for i in range(20)],
+                           "groups": [{"group_id": i, "group_name": f"group{i}", "custom_groupname": None,
+                                       "status": "member"} for i in range(5)]},
+}
+
+# кадры для route_message: разбор JSON, поиск маршрута, проверка состояния и схема
+ROUTED_FRAMES = {
+    "private_message": SCHEMA_SAMPLES["PrivateMessageSchema"],
+    "group_message": SCHEMA_SAMPLES["GroupMessageSchema"],
+    "typing": SCHEMA_SAMPLES["TypingSchema"],
+    "get_user_contacts": SCHEMA_SAMPLES["GetUserContactsSchema"],
+}
+
+
+# сокет-заглушка: ничего не передаёт
+class NullSocket:
+    async def send(self, frame):
+        pass
+
+    async def close(self, code=1000, reason=""):
+        pass
+
+
+def schema_classes() -> dict[str, type]:
+    """Все схемы модуля app.msg_schemas; схема без примера - ошибка, чтобы новые не выпадали из замеров"""
+    classes = {name: cls for name, cls in inspect.getmembers(msg_schemas, inspect.isclass)
+               if issubclass(cls, Schema) and cls.__module__ == msg_schemas.__name__}
+    missing = sorted(set(classes) - set(SCHEMA_SAMPLES))
+    if missing:
+        raise SystemExit(f"No benchmark sample for schemas: {', '.join(missing)}")
+    return classes
+
+
+# region Замер
+# сколько раз вызывать эталон после каждого прогона случая
+REFERENCE_CALLS = 100
+
+
+def reference_workload():
+    """Эталонная нагрузка: по её времени учитывается, насколько машина сейчас быстрее или медленнее"""
+    json.loads(json.dumps(REFERENCE_FRAME))
+    sum(len(str(i)) for i in range(100))
+
+
+def _reference_time() -> float:
+    started = time.perf_counter()
+    for _ in range(REFERENCE_CALLS):
+        reference_workload()
+    return (time.perf_counter() - started) / REFERENCE_CALLS
+
+
+def _summary(times: list[float], references: list[float]) -> tuple[float, float]:
+    """
+    (микросекунды на вызов, микросекунды эталона). Время - медиана прогонов, а не минимум:
+    редкий удачный прогон не должен становиться базой. Скорость машины (частота CPU,
+    соседи по хосту) за минуты меняется в разы, поэтому после каждого прогона
+    замеряется эталон, и отношение к нему - медиана отношений соседних пар
+    """
+    us = statistics.median(times) * 1e6
+    relative = statistics.median(t / r for t, r in zip(times, references))
+    return us, us / relative
+
+
+def measure(func, min_time: float, repeat: int) -> tuple[float, float]:
+    """
+    Медиана repeat прогонов, каждый не короче min_time, и эталон рядом с ними.
+    Как в timeit, сборщик мусора на время прогона выключен: иначе замер зависит
+    от мусора, оставленного предыдущими случаями
+    """
+    started = time.perf_counter()
+    func()
+    number = max(1, int(min_time / max(time.perf_counter() - started, 1e-9)))
+    times, references = [], []
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            for _ in range(number):
+                func()
+            times.append((time.perf_counter() - started) / number)
+            references.append(_reference_time())
+        finally:
+            gc.enable()
+    return _summary(times, references)
+
+
+async def measure_async(func, min_time: float, repeat: int) -> tuple[float, float]:
+    """То же для корутин"""
+    started = time.perf_counter()
+    await func()
+    number = max(1, int(min_time / max(time.perf_counter() - started, 1e-9)))
+    times, references = [], []
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            for _ in range(number):
+                await func()
+            times.append((time.perf_counter() - started) / number)
+            references.append(_reference_time())
+        finally:
+            gc.enable()
+    return _summary(times, references)
+# endregion
+
+
+# region Случаи
+async def bench_route_message(server: MessengerServer, args) -> dict:
+    async def noop(websocket, data, state):
+        pass
+
+    websocket = NullSocket()
+    state = ConnectionState(websocket)
+    state.state = ConnectionState.ConnectionStateEnum.Authorized
+    state.userId = 1
+    results = {}
+    for message_type, frame in ROUTED_FRAMES.items():
+        # обработчик заменён пустым: замеряется только диспетчеризация
+        server.dispatch.get(message_type).handler = noop
+        raw = json.dumps(frame)
+        results[f"route_message[{message_type}]"] = await measure_async(
+            lambda: server.route_message(websocket, raw, state), args.min_time, args.repeat)
+    return results
+
+
+def bench_schemas(args) -> dict:
+    results = {}
+    for name, cls in schema_classes().items():
+        schema = cls()
+        sample = SCHEMA_SAMPLES[name]
+        if name == "UserSchema":
+            # load_instance: модель User собирается без сессии БД
+            load = lambda: schema.load(sample, transient=True)
+            user = User(id=1, created_at=NOW, **sample)
+            dumps = lambda: schema.dumps(user)
+        else:
+            load = lambda: schema.load(sample)
+            dumps = lambda: schema.dumps(sample)
+        results[f"schema_load[{name}]"] = measure(load, args.min_time, args.repeat)
+        results[f"schema_dumps[{name}]"] = measure(dumps, args.min_time, args.repeat)
+    return results
+
+
+async def bench_send_success(server: MessengerServer, args) -> dict:
+    # сокет не зарегистрирован: send_frame только ищет сессию, замеряется сборка конверта
+    websocket = NullSocket()
+    data = {"id": 1, "group_id": 1}
+    return {"send_success[message_sent]": await measure_async(
+        lambda: server.send_success(websocket, "message_sent", data), args.min_time, args.repeat)}
+
+
+def bench_hash_password(args) -> dict:
+    salt = os.urandom(32)
+    return {"hash_password": measure(lambda: hash_password("benchpassword", salt), args.min_time, args.repeat)}
+
+
+async def bench_create_private_message(sender_id: int, args) -> dict:
+    data = {"receiver_id": sender_id, "content": "x" * 100}
+
+    # одно сообщение в своей транзакции тем же путём, что и пачка MessageWriter
+    async def create():
+        async with async_session_maker() as session:
+            await MessageCRUD.insert_messages(session, [MessageCRUD.build_private_message(data, sender_id)], [()])
+
+    return {"create_private_message[sqlite]": await measure_async(create, args.min_time, args.repeat)}
+
+
+def bench_contact_list(server: MessengerServer, args) -> dict:
+    results = {}
+    for contacts, groups in ((20, 5), (500, 50)):
+        cons = UserContactsClass()
+        for i in range(contacts):
+            con = OneContactClass()
+            con.user_id = i
+            con.user_name = f"contact{i}"
+            con.custom_nickname = None
+            con.status = "approved"
+            cons.contacts.append(con)
+        for i in range(groups):
+            grp = OneGroupClass()
+            grp.group_id = i
+            grp.group_name = f"group{i}"
+            grp.custom_groupname = None
+            grp.status = "member"
+            cons.groups.append(grp)
+        # та же схема, что отдаёт список контактов на сервере
+        results[f"contact_list_dumps[{contacts}+{groups}]"] = measure(
+            lambda: server.user_contacts_schema.dumps(cons), args.min_time, args.repeat)
+    return results
+# endregion
+
+
+def ratios(measured: dict, baseline: dict) -> dict[str, float]:
+    """Во сколько раз случай медленнее базы с поправкой на скорость машины по эталону"""
+    result = {}
+    for case, (us, reference) in measured.items():
+        base = baseline.get(case)
+        if base:
+            result[case] = (us / reference) / (base["us"] / base["reference_us"])
+    return result
+
+
+def regressions(measured: dict, baseline: dict, threshold: float) -> list[str]:
+    """Случаи, ставшие медленнее базы больше чем на threshold"""
+    return [case for case, ratio in ratios(measured, baseline).items() if ratio > 1 + threshold]
+
+
+def report(measured: dict, baseline: dict, threshold: float):
+    """Результаты рядом с базой, по строке JSON на случай"""
+    compared = ratios(measured, baseline)
+    for case, (us, reference) in measured.items():
+        line = {"case": case, "us": round(us, 3)}
+        if case in compared:
+            line.update(baseline_us=baseline[case]["us"], ratio=round(compared[case], 3))
+            if compared[case] > 1 + threshold:
+                line["regression"] = True
+        print(json.dumps(line))
+
+
+async def run(args, baseline: dict) -> dict[str, tuple[float, float]]:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with async_session_maker() as session:
+        sender = await UserCRUD.create_user(session, {
+            "username": "benchsender", "salt": "00" * 32, "password_hash": "ab" * 32, "email": "bench@x.io",
+        })
+    server = MessengerServer(kdf_workers=1)
+    cases = {
+        "route_message": lambda opts: bench_route_message(server, opts),
+        "schema": lambda opts: bench_schemas(opts),
+        "send_success": lambda opts: bench_send_success(server, opts),
+        "hash_password": lambda opts: bench_hash_password(opts),
+        "create_private_message": lambda opts: bench_create_private_message(sender["id"], opts),
+        "contact_list": lambda opts: bench_contact_list(server, opts),
+    }
+
+    async def collect(name: str, opts=args) -> dict[str, tuple[float, float]]:
+        result = cases[name](opts)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    selected = [name for name in cases if not args.only or any(part in name for part in args.only)]
+    # случай -> (микросекунды, эталон)
+    measured, groups = {}, {}
+    try:
+        # короткий прогон без учёта: первые вызовы в свежем процессе медленнее (кеши, аллокатор)
+        warmup = argparse.Namespace(**dict(vars(args), min_time=args.min_time / 10, repeat=1))
+        for name in selected:
+            await collect(name, warmup)
+        for name in selected:
+            for case, value in (await collect(name)).items():
+                measured[case] = value
+                groups[case] = name
+        if args.save:
+            # база - медиана нескольких раундов
+            rounds = {case: [value] for case, value in measured.items()}
+            for _ in range(args.retries):
+                for name in selected:
+                    for case, value in (await collect(name)).items():
+                        rounds[case].append(value)
+            measured = {case: (statistics.median(us for us, _ in values),
+                               statistics.median(reference for _, reference in values))
+                        for case, values in rounds.items()}
+        else:
+            # шум не должен давать ложную регрессию: группы с регрессией перемеряются,
+            # берётся лучший раунд
+            for _ in range(args.retries):
+                slow = {groups[case] for case in regressions(measured, baseline, args.threshold)}
+                for name in (name for name in selected if name in slow):
+                    for case, (us, reference) in (await collect(name)).items():
+                        if us / reference < measured[case][0] / measured[case][1]:
+                            measured[case] = (us, reference)
+    finally:
+        server.hasher.close()
+        await engine.dispose()
+    return measured
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server hot path micro-benchmarks")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="файл базы")
+    parser.add_argument("--save", action="store_true", help="записать результаты как базу")
+    parser.add_argument("--threshold", type=float, default=BENCH_THRESHOLD,
+                        help="допустимое замедление относительно базы (0.25 = на 25%%)")
+    parser.add_argument("--only", nargs="+", help="группы случаев: route_message schema send_success "
+                                                  "hash_password create_private_message contact_list")
+    parser.add_argument("--min-time", type=float, default=0.02, help="минимальная длительность прогона, с")
+    parser.add_argument("--repeat", type=int, default=7, help="число прогонов, берётся медиана")
+    parser.add_argument("--retries", type=int, default=2,
+                        help="сколько раз перемерить группы с регрессией (при --save - дополнительные раунды)")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f).get("results", {})
+    try:
+        measured = asyncio.run(run(args, baseline))
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+    report(measured, baseline, args.threshold)
+
+    if args.save:
+        # при частичном прогоне (--only) остальные случаи базы сохраняются
+        baseline.update({case: {"us": round(us, 3), "reference_us": round(reference, 3)}
+                         for case, (us, reference) in measured.items()})
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "results": dict(sorted(baseline.items())),
+            }, f, indent=2)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+    else:
+        slow = regressions(measured, baseline, args.threshold)
+        if slow:
+            print(f"Regressions over {args.threshold:.0%}: {', '.join(slow)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import asyncio
 import websockets
 import json
 import sys
+from collections import deque
 from datetime import datetime
 
 from marshmallow import ValidationError
@@ -13,7 +14,12 @@ from app.msg_schemas import (
     UserContactsClass,
     OneContactClass,
     PrivateMessageSchema,
-    GroupMessageSchema
+    GroupMessageSchema,
+    HistorySchema,
+    HistoryChunkSchema,
+    SearchResultsSchema,
+    PresenceSchema,
+    TypingSchema
 )
 
 
@@ -23,14 +29,42 @@ class MessengerClient:
         self.user_id : int = None
         self.username : str = None
         self.contacts : list[OneContactClass] = list()
+        # токен сессии от сервера, для переподключения без пароля
+        self.token : str = None
+        self.server_url : str = None
+        # сообщения из batch-кадров, ещё не переданные обработчикам
+        self.backlog : deque[dict] = deque()
+        # выгрузки истории в процессе: ('peer'|'group', id) -> полученные сообщения
+        self.exports : dict[tuple, list[dict]] = {}
+        # последний поисковый запрос и ключ его следующей страницы
+        self.search_request : dict = None
+        # присутствие контактов: user_id -> True (в сети) или last_seen (ISO-строка/None)
+        self.presence : dict[int, object] = {}
 
 
     # функция для определения схемы сообщения
 
     # соединение с сервером
     async def connect(self, server_url: str = "ws://localhost:8765"):
+        self.server_url = server_url
         self.websocket = await websockets.connect(server_url)
 
+    # следующее сообщение от сервера; batch-кадры раскладываются по одному сообщению
+    async def recv_message(self) -> dict:
+        if self.backlog:
+            return self.backlog.popleft()
+        data = json.loads(await self.websocket.recv())
+        if data.get('type') == 'batch':
+            self.backlog.extend(data['messages'])
+            return self.backlog.popleft()
+        return data
+
+    # запоминаем пользователя и токен из ответа auth_success
+    def accept_auth(self, data: dict) -> int:
+        self.user_id = data['data']['id']
+        self.token = data['data'].get('token')
+        return self.user_id
+
     # регистрация нового пользователя
     async def register(self, username: str, password: str, email: str)->int:
         auth = Auth()
@@ -42,10 +76,10 @@ class MessengerClient:
         res = sh.dumps(auth)
         await self.websocket.send(res)
         try:
-            response = await self.websocket.recv()
-            data= json.loads(response)
+            data = await self.recv_message()
             if data['type']=='auth_success':
-                self.user_id = data['data']['id']
+                self.accept_auth(data)
+                self.username = username
                 print(f"зашли как с {username} ИД {self.user_id}")
                 return self.user_id
             else:
@@ -64,10 +98,10 @@ class MessengerClient:
         res = sh.dumps(auth)
         await self.websocket.send(res)
         try:
-            response = await self.websocket.recv()
-            data= json.loads(response)
+            data = await self.recv_message()
             if data['type']=='auth_success':
-                self.user_id = data['data']['id']
+                self.accept_auth(data)
+                self.username = username
                 print(f"зашли как с {username} ИД {self.user_id}")
                 return self.user_id
             else:
@@ -76,24 +110,73 @@ class MessengerClient:
             print(e)
             return -1
 
-    # обработка сообщения
-    async def process_incoming_messages(self, msg_to_skip: int):
+    # вход по сохранённому токену сессии (без пароля)
+    async def resume(self) -> int:
+        if not self.token:
+            return -1
+        await self.websocket.send(json.dumps({'type': 'resume', 'token': self.token}))
         try:
-            i = 0
-            async for message in self.websocket:
-                i+=1
-                if  i== msg_to_skip:
-                    break
+            data = await self.recv_message()
+            if data['type'] == 'auth_success':
+                return self.accept_auth(data)
+            self.token = None
+            return -1
+        except Exception as e:
+            print(e)
+            return -1
 
-            async for message in self.websocket:
-                await self.process_server_message(self.websocket, message)
-        except websockets.ConnectionClosed:
-            print("\nСоединение с сервером разорвано")
+    # переподключение: новое соединение и вход по токену
+    async def reconnect(self) -> int:
+        if self.websocket is not None:
+            await self.websocket.close()
+        await self.connect(self.server_url or "ws://localhost:8765")
+        return await self.resume()
+
+    # обработка сообщения
+    async def process_incoming_messages(self, msg_to_skip: int):
+        while True:
+            try:
+                # пропускаем первые msg_to_skip сообщений
+                for _ in range(msg_to_skip):
+                    await self.recv_message()
+
+                # сообщения, пришедшие в одном batch с ответом на вход
+                while self.backlog:
+                    await self.process_server_data(self.websocket, self.backlog.popleft())
+
+                async for message in self.websocket:
+                    await self.process_server_message(self.websocket, message)
+                return
+            except websockets.ConnectionClosed:
+                print("\nСоединение с сервером разорвано")
+            # переподключаемся по токену сессии, пароль не нужен
+            try:
+                self.backlog.clear()
+                if await self.reconnect() < 0:
+                    return
+            except OSError as e:
+                print(e)
+                return
+            print("Переподключились")
+            msg_to_skip = 0
 
     # маршрутизация обработчика сообщения
     async def process_server_message(self, websocket, message):
         try:
             data = json.loads(message)
+        except json.JSONDecodeError:
+            print( "Invalid JSON format")
+            return
+        await self.process_server_data(websocket, data)
+
+    async def process_server_data(self, websocket, data: dict):
+        try:
+            if data.get('type') == 'batch':
+                # несколько сообщений, склеенных сервером в один кадр
+                for item in data['messages']:
+                    await self.process_server_data(websocket, item)
+                return
+
             if data.get('type') == 'error':
                 print(f"\nОшибка: {data.get('message')}")
                 return
@@ -124,8 +207,6 @@ class MessengerClient:
             else:
                 print(f"Unhandled message type: {message_type}")
 
-        except json.JSONDecodeError:
-            print( "Invalid JSON format")
         except ValidationError as e:
             print( f"Validation error: {e.messages}")
         except Exception as e:
@@ -138,7 +219,12 @@ class MessengerClient:
             'auth_success': AuthSchema(),
             'private_message' : PrivateMessageSchema(),
             'group_message' : GroupMessageSchema(),
-            'user_contacts' : UserContactsSchema()
+            'user_contacts' : UserContactsSchema(),
+            'history' : HistorySchema(),
+            'history_chunk' : HistoryChunkSchema(),
+            'search_results' : SearchResultsSchema(),
+            'presence' : PresenceSchema(),
+            'typing' : TypingSchema()
         }.get(message_type)
 
     # обработка личного сообщения
@@ -163,6 +249,47 @@ class MessengerClient:
         for gp in data['groups']:
             print(f"user_name {gp['group_name']}, user_id {gp['group_id']}")
 
+    # страница истории переписки
+    async def handle_history(self, websocket, data: dict):
+        for msg in data['messages']:
+            print(f"[{msg['id']}] {msg['sender_id']}: {msg['content']}")
+        if data['has_more']:
+            print(f"есть более ранние сообщения (до id {data['messages'][0]['id']})")
+
+    # часть выгрузки истории; done - выгрузка закончена
+    async def handle_history_chunk(self, websocket, data: dict):
+        key = ('group', data['group_id']) if 'group_id' in data else ('peer', data['peer_id'])
+        self.exports.setdefault(key, []).extend(data['messages'])
+        if data['done']:
+            messages = self.exports.pop(key, [])
+            for msg in messages:
+                print(f"[{msg['id']}] {msg['sender_id']}: {msg['content']}")
+            print(f"выгрузка завершена: {data.get('count', len(messages))} сообщений")
+
+    # страница результатов поиска
+    async def handle_search_results(self, websocket, data: dict):
+        print(f"Поиск: {data['query']}")
+        for item in data['results']:
+            where = f"группа {item['group_id']}" if item.get('group_id') is not None else f"ЛС {item['sender_id']}"
+            print(f"[{item['id']}] ({where}) {item['snippet']}")
+        if data['has_more'] and self.search_request is not None:
+            self.search_request['after_rank'] = data['next_rank']
+            self.search_request['after_id'] = data['next_id']
+            print("есть ещё результаты (/next)")
+        else:
+            self.search_request = None
+
+    # присутствие контактов: полный снимок (full) или изменения за интервал
+    async def handle_presence(self, websocket, data: dict):
+        if data['full']:
+            self.presence.clear()
+        for user_id in data['online']:
+            self.presence[user_id] = True
+            print(f"в сети: {user_id}")
+        for item in data['offline']:
+            self.presence[item['id']] = item.get('last_seen')
+            print(f"не в сети: {item['id']} (был {item.get('last_seen') or 'давно'})")
+
     #endrefion
 
     # sending private message
@@ -181,6 +308,26 @@ class MessengerClient:
         }))
 
 
+    # набор текста собеседником (в личной переписке или группе)
+    async def handle_typing(self, websocket, data: dict):
+        where = f"в группе {data['group_id']}" if 'group_id' in data else "вам"
+        print(f"{data['sender_id']} {'печатает' if data['active'] else 'перестал печатать'} {where}")
+
+    # кто из контактов в сети; дальше сервер сам присылает изменения
+    async def get_presence(self):
+        await self.websocket.send(json.dumps({
+            'type': 'get_presence',
+        }))
+
+    # индикатор набора текста; ответа сервер не присылает, лишние кадры просто отбрасывает
+    async def send_typing(self, peer_id: int = None, group_id: int = None, active: bool = True):
+        request = {'type': 'typing', 'active': active}
+        if group_id is not None:
+            request['group_id'] = group_id
+        else:
+            request['peer_id'] = peer_id
+        await self.websocket.send(json.dumps(request))
+
     # sending group message
     async def send_group_message(self, group_id: int, content: str):
         await self.websocket.send(json.dumps({
@@ -189,6 +336,77 @@ class MessengerClient:
             'content': content
         }))
 
+    # запрос в контакты; у получателя он появится после подтверждения (approve_contact)
+    async def add_contact(self, contact_id: int, custom_nickname: str = None):
+        request = {'type': 'add_contact', 'contact_id': contact_id}
+        if custom_nickname:
+            request['custom_nickname'] = custom_nickname
+        await self.websocket.send(json.dumps(request))
+
+    # подтвердить входящий запрос в контакты
+    async def approve_contact(self, contact_id: int):
+        await self.websocket.send(json.dumps({'type': 'approve_contact', 'contact_id': contact_id}))
+
+    # удалить контакт (у обоих пользователей)
+    async def delete_contact(self, contact_id: int):
+        await self.websocket.send(json.dumps({'type': 'delete_contact', 'contact_id': contact_id}))
+
+    # добавить участника в группу (может только создатель группы)
+    async def add_group_member(self, group_id: int, user_id: int):
+        await self.websocket.send(json.dumps({
+            'type': 'add_group_member',
+            'group_id': group_id,
+            'user_id': user_id
+        }))
+
+    # исключить участника из группы; свой id - выйти из группы
+    async def remove_group_member(self, group_id: int, user_id: int):
+        await self.websocket.send(json.dumps({
+            'type': 'remove_group_member',
+            'group_id': group_id,
+            'user_id': user_id
+        }))
+
+    # запрос истории: peer_id - личная переписка, group_id - группа;
+    # before_id - id самого старого уже загруженного сообщения
+    async def get_history(self, peer_id: int = None, group_id: int = None,
+                          before_id: int = None, limit: int = 50):
+        request = {'type': 'get_history', 'limit': limit}
+        if group_id is not None:
+            request['group_id'] = group_id
+        else:
+            request['peer_id'] = peer_id
+        if before_id is not None:
+            request['before_id'] = before_id
+        await self.websocket.send(json.dumps(request))
+
+    # выгрузка всей переписки; сервер присылает её частями (history_chunk)
+    async def export_history(self, peer_id: int = None, group_id: int = None, after_id: int = None):
+        request = {'type': 'export_history'}
+        if group_id is not None:
+            request['group_id'] = group_id
+        else:
+            request['peer_id'] = peer_id
+        if after_id is not None:
+            request['after_id'] = after_id
+        await self.websocket.send(json.dumps(request))
+
+    # поиск по своим перепискам (или по одной: peer_id / group_id)
+    async def search_messages(self, query: str, peer_id: int = None, group_id: int = None, limit: int = 20):
+        self.search_request = {'type': 'search_messages', 'query': query, 'limit': limit}
+        if group_id is not None:
+            self.search_request['group_id'] = group_id
+        elif peer_id is not None:
+            self.search_request['peer_id'] = peer_id
+        await self.websocket.send(json.dumps(self.search_request))
+
+    # следующая страница последнего поиска
+    async def search_next(self) -> bool:
+        if self.search_request is None or 'after_id' not in self.search_request:
+            return False
+        await self.websocket.send(json.dumps(self.search_request))
+        return True
+
 # Это основная функция системы
 async def main():
     client = MessengerClient()
@@ -220,12 +438,25 @@ async def main():
 
 
     # Запуск обработки сообщений
-    asyncio.create_task(client.process_incoming_messages(tries))
+    # ответы на попытки входа уже прочитаны в login/register, пропускать нечего:
+    # сразу после входа сервер присылает накопленные сообщения
+    asyncio.create_task(client.process_incoming_messages(0))
 
     print("Доступные команды:")
     print("/list получить список контактов пользователя")
+    print("/addcontact <id пользователя> [имя] - запрос в контакты")
+    print("/approve <id пользователя> - подтвердить запрос в контакты")
+    print("/delcontact <id пользователя> - удалить контакт")
     print("/msg <получатель> <сообщение> - личное сообщение")
     print("/group <id группы> <сообщение> - сообщение в группу")
+    print("/gadd <id группы> <id пользователя> - добавить участника в группу")
+    print("/gremove <id группы> <id пользователя> - исключить участника (свой id - выйти)")
+    print("/history <id пользователя> [до id] - история личной переписки")
+    print("/ghistory <id группы> [до id] - история группы")
+    print("/export <id пользователя> - выгрузка всей личной переписки")
+    print("/gexport <id группы> - выгрузка всей истории группы")
+    print("/search <слова> - поиск по сообщениям, /next - следующая страница")
+    print("/online - кто из контактов в сети")
     print("/exit - выход")
 
     # Основной цикл ввода команд
@@ -244,6 +475,52 @@ async def main():
                 _, group_id, *content = command.split()
                 await client.send_group_message(int(group_id), ' '.join(content))
 
+            elif command.startswith('/history'):
+                _, peer_id, *before = command.split()
+                await client.get_history(peer_id=int(peer_id), before_id=int(before[0]) if before else None)
+
+            elif command.startswith('/addcontact'):
+                _, contact_id, *nickname = command.split()
+                await client.add_contact(int(contact_id), ' '.join(nickname) or None)
+
+            elif command.startswith('/approve'):
+                _, contact_id = command.split()
+                await client.approve_contact(int(contact_id))
+
+            elif command.startswith('/delcontact'):
+                _, contact_id = command.split()
+                await client.delete_contact(int(contact_id))
+
+            elif command.startswith('/gadd'):
+                _, group_id, user_id = command.split()
+                await client.add_group_member(int(group_id), int(user_id))
+
+            elif command.startswith('/gremove'):
+                _, group_id, user_id = command.split()
+                await client.remove_group_member(int(group_id), int(user_id))
+
+            elif command.startswith('/ghistory'):
+                _, group_id, *before = command.split()
+                await client.get_history(group_id=int(group_id), before_id=int(before[0]) if before else None)
+
+            elif command.startswith('/export'):
+                _, peer_id = command.split()
+                await client.export_history(peer_id=int(peer_id))
+
+            elif command.startswith('/gexport'):
+                _, group_id = command.split()
+                await client.export_history(group_id=int(group_id))
+
+            elif command.startswith('/search'):
+                _, *words = command.split()
+                await client.search_messages(' '.join(words))
+
+            elif command == '/next':
+                if not await client.search_next():
+                    print("нет следующей страницы поиска")
+
+            elif command == '/online':
+                await client.get_presence()
 
             elif command == '/exit':
                 await client.websocket.close()
@@ -252,8 +529,19 @@ async def main():
             else:
                 print("Доступные команды:")
                 print("/list получить список контактов пользователя")
+                print("/addcontact <id пользователя> [имя] - запрос в контакты")
+                print("/approve <id пользователя> - подтвердить запрос в контакты")
+                print("/delcontact <id пользователя> - удалить контакт")
                 print("/msg <получатель> <сообщение> - личное сообщение")
                 print("/group <id группы> <сообщение> - сообщение в группу")
+                print("/gadd <id группы> <id пользователя> - добавить участника в группу")
+                print("/gremove <id группы> <id пользователя> - исключить участника (свой id - выйти)")
+                print("/history <id пользователя> [до id] - история личной переписки")
+                print("/ghistory <id группы> [до id] - история группы")
+                print("/export <id пользователя> - выгрузка всей личной переписки")
+                print("/gexport <id группы> - выгрузка всей истории группы")
+                print("/search <слова> - поиск по сообщениям, /next - следующая страница")
+                print("/online - кто из контактов в сети")
                 print("/exit - выход")
 
         except KeyboardInterrupt:
@@ -0,0 +1,399 @@
+"""
+Генератор нагрузки на сервер без интерфейса, на том же MessengerClient.
+
+Открывает из одного процесса тысячи авторизованных соединений, регистрирует
+синтетических пользователей пачками (или входит по сохранённым токенам без PBKDF2),
+создаёт группы и с заданной частотой шлёт смесь личных сообщений, сообщений
+в группы и запросов списка контактов (/list). В конце печатает JSON:
+задержку доставки от отправки до получения (p50/p95/p99), задержку ответов сервера,
+пропускную способность и ошибки.
+
+Пример:
+    python msg_loadgen.py --clients 2000 --groups 50 --group-size 20 \
+        --rate 500 --duration 60 --mix private=70,group=20,list=10 --tokens loadgen_tokens.json
+
+Тысячи соединений требуют лимита открытых файлов выше стандартного (ulimit -n).
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter, deque
+
+import websockets
+
+from msg_client import MessengerClient
+from app.msg_schemas import Auth, AuthSchema
+
+# метка в тексте сообщения: по ней получатель находит время отправки
+CONTENT_MARK = "lg"
+
+
+def percentile(sorted_values: list[float], q: float) -> float | None:
+    """Перцентиль по уже отсортированной выборке (ближайший ранг)"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples: list[float]) -> dict:
+    """Сводка по задержкам в миллисекундах"""
+    values = sorted(samples)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+        "max": round(values[-1], 3),
+        "mean": round(sum(values) / len(values), 3),
+    }
+
+
+def parse_mix(text: str) -> dict[str, float]:
+    """'private=70,group=20,list=10' -> доли операций"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ("private", "group", "list"):
+            raise argparse.ArgumentTypeError(f"Unknown operation in mix: {name}")
+        mix[name] = float(weight or 1)
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("Empty mix")
+    return mix
+
+
+class LoadStats:
+    """Общие для всех соединений счётчики и выборки задержек"""
+
+    def __init__(self):
+        self.sent = Counter()
+        # сколько доставок ожидается (получатели в сети) и сколько пришло
+        self.expected_deliveries = 0
+        self.deliveries = 0
+        self.delivery_ms: list[float] = []
+        self.ack_ms: list[float] = []
+        self.list_ms: list[float] = []
+        self.errors = Counter()
+        self.send_failures = 0
+        self.disconnects = 0
+        # запланированные операции, которые не успели отправить вовремя
+        self.late = 0
+
+
+class LoadClient(MessengerClient):
+    """
+    MessengerClient без консоли: входящие кадры не печатаются,
+    а превращаются в измерения. Ответы сервер шлёт в порядке запросов одного
+    соединения, поэтому время запроса берётся из очереди FIFO
+    """
+
+    def __init__(self, stats: LoadStats, index: int):
+        super().__init__()
+        self.stats = stats
+        self.index = index
+        self.group_ids: list[int] = []
+        # время отправки сообщений, ждущих message_sent
+        self.pending_acks: deque[float] = deque()
+        # время отправки запросов get_user_contacts
+        self.pending_lists: deque[float] = deque()
+        self.seq = 0
+        self.reader: asyncio.Task | None = None
+
+    # регистрация с повтором, пока пул PBKDF2 сервера занят (error с retry_after)
+    async def register_retry(self, username: str, password: str, attempts: int = 20) -> int:
+        auth = Auth()
+        auth.type = "register"
+        auth.username = username
+        auth.password = password
+        auth.email = f"{username}@loadgen.local"
+        request = AuthSchema().dumps(auth)
+        for _ in range(attempts):
+            await self.websocket.send(request)
+            data = await self.recv_message()
+            if data['type'] == 'auth_success':
+                self.username = username
+                return self.accept_auth(data)
+            retry_after = data.get('retry_after')
+            if retry_after is None:
+                self.stats.errors[f"register: {data.get('message')}"] += 1
+                return -1
+            await asyncio.sleep(retry_after * (1 + random.random()))
+        self.stats.errors["register: retries exhausted"] += 1
+        return -1
+
+    def start_reader(self):
+        self.reader = asyncio.create_task(self.read_frames())
+
+    async def read_frames(self):
+        stats = self.stats
+        try:
+            while True:
+                data = await self.recv_message()
+                message_type = data.get('type')
+                if message_type in ('private_message', 'group_message'):
+                    content = data.get('content', '')
+                    if content.startswith(CONTENT_MARK):
+                        sent_ns = int(content.split(":", 3)[2])
+                        stats.deliveries += 1
+                        stats.delivery_ms.append((time.perf_counter_ns() - sent_ns) / 1e6)
+                elif message_type == 'message_sent':
+                    if self.pending_acks:
+                        stats.ack_ms.append((time.perf_counter() - self.pending_acks.popleft()) * 1000)
+                elif message_type == 'user_contacts':
+                    if self.pending_lists:
+                        stats.list_ms.append((time.perf_counter() - self.pending_lists.popleft()) * 1000)
+                elif message_type == 'error':
+                    stats.errors[data.get('message', 'unknown')] += 1
+                    # ошибка - ответ на сообщение, его подтверждения уже не будет
+                    if self.pending_acks:
+                        self.pending_acks.popleft()
+        except websockets.ConnectionClosed:
+            stats.disconnects += 1
+
+    def content(self) -> str:
+        self.seq += 1
+        return f"{CONTENT_MARK}:{self.index}:{time.perf_counter_ns()}:{self.seq}"
+
+
+class LoadGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.stats = LoadStats()
+        self.clients: list[LoadClient] = []
+        # group_id -> участники (индексы клиентов)
+        self.groups: dict[int, list[int]] = {}
+        self.setup = {"registered": 0, "resumed": 0, "failed": 0}
+
+    # region Подготовка
+    async def open_clients(self):
+        args = self.args
+        tokens = self.load_tokens()
+        semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+        async def open_one(index: int) -> LoadClient | None:
+            async with semaphore:
+                client = LoadClient(self.stats, index)
+                try:
+                    await client.connect(args.url)
+                    username = f"{args.prefix}{index:06d}"
+                    token = tokens.get(username)
+                    if token:
+                        client.token = token
+                        if await client.resume() >= 0:
+                            client.username = username
+                            self.setup["resumed"] += 1
+                            return client
+                    if await client.register_retry(username, args.password) >= 0:
+                        self.setup["registered"] += 1
+                        return client
+                except (OSError, websockets.WebSocketException) as e:
+                    self.stats.errors[f"connect: {type(e).__name__}"] += 1
+                self.setup["failed"] += 1
+                if client.websocket is not None:
+                    await client.websocket.close()
+                return None
+
+        opened = await asyncio.gather(*(open_one(i) for i in range(args.clients)))
+        self.clients = [client for client in opened if client is not None]
+        self.save_tokens()
+
+    def load_tokens(self) -> dict[str, str]:
+        if not self.args.tokens or not os.path.exists(self.args.tokens):
+            return {}
+        with open(self.args.tokens) as f:
+            return json.load(f)
+
+    def save_tokens(self):
+        """Токены сессий для следующего запуска: вход без PBKDF2"""
+        if not self.args.tokens:
+            return
+        tokens = self.load_tokens()
+        tokens.update({client.username: client.token for client in self.clients if client.token})
+        with open(self.args.tokens, "w") as f:
+            json.dump(tokens, f)
+
+    async def create_groups(self):
+        args = self.args
+        if args.groups <= 0 or len(self.clients) < 2:
+            return
+        size = max(2, min(args.group_size, len(self.clients)))
+        for n in range(args.groups):
+            members = random.sample(range(len(self.clients)), size)
+            creator = self.clients[members[0]]
+            await creator.websocket.send(json.dumps({
+                'type': 'create_group',
+                'name': f"{args.prefix}group{n}",
+                'members': [self.clients[i].user_id for i in members[1:]],
+            }))
+            while True:
+                data = await creator.recv_message()
+                if data.get('type') == 'group_created':
+                    self.groups[data['data']['id']] = members
+                    for i in members:
+                        self.clients[i].group_ids.append(data['data']['id'])
+                    break
+                if data.get('type') == 'error':
+                    self.stats.errors[f"create_group: {data.get('message')}"] += 1
+                    break
+    # endregion
+
+    # region Нагрузка
+    async def operation(self, kind: str):
+        stats = self.stats
+        clients = self.clients
+        client = random.choice(clients)
+        try:
+            if kind == "private":
+                receiver = random.choice(clients)
+                while receiver is client and len(clients) > 1:
+                    receiver = random.choice(clients)
+                client.pending_acks.append(time.perf_counter())
+                stats.expected_deliveries += 1
+                await client.send_private_message(receiver.user_id, client.content())
+            elif kind == "group":
+                if not client.group_ids:
+                    # клиент не состоит в группах - пишет от участника случайной группы
+                    group_id = random.choice(list(self.groups))
+                    client = clients[random.choice(self.groups[group_id])]
+                else:
+                    group_id = random.choice(client.group_ids)
+                client.pending_acks.append(time.perf_counter())
+                stats.expected_deliveries += len(self.groups[group_id]) - 1
+                await client.send_group_message(group_id, client.content())
+            else:
+                client.pending_lists.append(time.perf_counter())
+                await client.get_contacts()
+            stats.sent[kind] += 1
+        except websockets.ConnectionClosed:
+            stats.send_failures += 1
+
+    async def drive(self):
+        """Открытый цикл: операции планируются по часам, а не по ответам сервера"""
+        args = self.args
+        mix = dict(args.mix)
+        if not self.groups:
+            mix.pop("group", None)
+        kinds, weights = list(mix), list(mix.values())
+        tick = args.tick
+        started = time.perf_counter()
+        issued = 0
+        while True:
+            elapsed = time.perf_counter() - started
+            if elapsed >= args.duration:
+                break
+            due = int(elapsed * args.rate) - issued
+            if due > 0:
+                # за тик не успели больше запланированного - отставание генератора
+                if due > max(1, int(args.rate * tick * 2)):
+                    self.stats.late += due
+                await asyncio.gather(*(self.operation(kind) for kind in random.choices(kinds, weights, k=due)))
+                issued += due
+            await asyncio.sleep(tick)
+        return time.perf_counter() - started
+
+    async def run(self) -> dict:
+        args = self.args
+        setup_started = time.perf_counter()
+        await self.open_clients()
+        await self.create_groups()
+        for client in self.clients:
+            client.start_reader()
+        setup_seconds = time.perf_counter() - setup_started
+
+        duration = await self.drive() if self.clients else 0.0
+        # ждём доставки отправленного
+        await asyncio.sleep(args.drain)
+
+        for client in self.clients:
+            client.reader.cancel()
+        await asyncio.gather(*(client.websocket.close() for client in self.clients), return_exceptions=True)
+        return self.report(setup_seconds, duration)
+    # endregion
+
+    def report(self, setup_seconds: float, duration: float) -> dict:
+        stats = self.stats
+        sent = sum(stats.sent.values())
+        errors = sum(stats.errors.values()) + stats.send_failures
+        return {
+            "config": {
+                "url": self.args.url,
+                "clients": self.args.clients,
+                "groups": self.args.groups,
+                "group_size": self.args.group_size,
+                "rate": self.args.rate,
+                "duration": self.args.duration,
+                "mix": self.args.mix,
+            },
+            "setup": dict(self.setup, connected=len(self.clients), groups=len(self.groups),
+                          seconds=round(setup_seconds, 3)),
+            "duration_s": round(duration, 3),
+            "sent": dict(stats.sent, total=sent),
+            "throughput": {
+                "sent_per_s": round(sent / duration, 1) if duration else 0.0,
+                "delivered_per_s": round(stats.deliveries / duration, 1) if duration else 0.0,
+            },
+            "latency_ms": {
+                "delivery": summarize(stats.delivery_ms),
+                "ack": summarize(stats.ack_ms),
+                "list": summarize(stats.list_ms),
+            },
+            "deliveries": {
+                "expected": stats.expected_deliveries,
+                "received": stats.deliveries,
+                "missing": max(0, stats.expected_deliveries - stats.deliveries),
+            },
+            "errors": {
+                "total": errors,
+                "rate": round(errors / sent, 4) if sent else 0.0,
+                "send_failures": stats.send_failures,
+                "disconnects": stats.disconnects,
+                "late_operations": stats.late,
+                "by_message": dict(stats.errors),
+            },
+        }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the messenger server")
+    parser.add_argument("--url", default=os.getenv("LOADGEN_URL", "ws://localhost:8765"))
+    parser.add_argument("--clients", type=int, default=100, help="authenticated connections")
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--group-size", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=100, help="operations per second, all clients together")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("private=70,group=20,list=10"))
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for in-flight deliveries")
+    parser.add_argument("--tick", type=float, default=0.01, help="scheduler tick, seconds")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--prefix", default=f"lg{uuid.uuid4().hex[:6]}_",
+                        help="username prefix; keep it fixed together with --tokens to reuse users")
+    parser.add_argument("--password", default="loadgen-password")
+    parser.add_argument("--tokens", help="JSON file with session tokens, read and updated")
+    parser.add_argument("--output", help="write the JSON report to a file instead of stdout")
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    # MessengerClient печатает в stdout, там должен остаться только отчёт
+    with contextlib.redirect_stdout(sys.stderr):
+        result = await LoadGenerator(args).run()
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,129 +1,365 @@
 import asyncio
 import websockets
 import json
-import hashlib
 import os
+import sys
+import time
+import socket
+import signal
+import shutil
+import tempfile
+import argparse
+import logging
+import multiprocessing
+from functools import partial
+from urllib.parse import urlsplit, parse_qs
 from datetime import datetime, timezone
 from marshmallow import ValidationError
 from sqlalchemy import select
-from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
-from app.crud import UserCRUD, GroupCRUD, MessageCRUD
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.crud import UserCRUD, GroupCRUD, MessageCRUD, ContactCRUD
 from app.msg_schemas import (
     AuthSchema,
+    ResumeSchema,
     CreateGroupSchema,
+    GroupMemberSchema,
     PrivateMessageSchema,
     UserSchema,
     GroupSchema,
     GroupMessageSchema,
     GetUserContactsSchema,
+    ContactRequestSchema,
+    GetHistorySchema,
+    ExportHistorySchema,
+    SearchMessagesSchema,
+    GetPresenceSchema,
+    TypingSchema,
     UserContactsSchema, UserContactsClass, OneContactClass, UserContactsClass,
 )
-from app.database import engine, Base
-from app.msg_models import Message,UserContact,User, RelationshipStatus
-from enum import Enum
-
-
-# Для хранения состояния соединения
-class ConnectionState:
-
-    class ConnectionStateEnum(Enum):
-        Connected = 1
-        Authorized = 2
-    def __init__(self):
-        self.state: ConnectionState = self.ConnectionStateEnum.Connected
-        self.userId: int = -1
-
-# асинхронная сессия
-GetSession = async_sessionmaker(engine, expire_on_commit=False)
+from app.database import engine, Base, async_session_maker, pool_stats
+from app.msg_models import Message,UserContact,User, RelationshipStatus, upgrade_schema
+from app.connections import ConnectionState, ConnectionRegistry
+from app.dispatch import MessageDispatcher
+from app.passwords import PasswordHasher, HasherBusy, hash_password, KDF_WORKERS
+from app.tokens import SessionTokens, session_secret, SESSION_SECRET
+from app.outbound import OutboundQueue
+from app.fanout import FanoutEngine
+from app.contacts_cache import contact_lists_cache, contact_watchers_cache
+from app.persistence import MessageWriter
+from app.presence import PresenceService
+from app.typing_indicator import TypingLimiter
+from app.group_cache import group_members_cache
+from app.heartbeat import HeartbeatMonitor
+from app.relay import RelayBackend, create_relay
+from app.worker_bus import WorkerBus
+from app.metrics import registry as metrics, start_metrics_server, METRICS_PORT, METRICS_HOST
+from app.log import get_logger, setup_logging, stop_logging
+from app.tracing import tracer, current_span, create_exporter, TRACE_SAMPLE_RATE, TRACE_EXPORTER
+
+Connected = ConnectionState.ConnectionStateEnum.Connected
+Authorized = ConnectionState.ConnectionStateEnum.Authorized
+
+# сколько недоставленных сообщений отдавать за одну страницу при входе
+OFFLINE_PAGE_SIZE = int(os.getenv("OFFLINE_PAGE_SIZE", "500"))
+# максимальный размер страницы истории
+HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", "200"))
+# сколько сообщений в одном кадре выгрузки истории (и в одной пачке из курсора БД)
+HISTORY_CHUNK_SIZE = int(os.getenv("HISTORY_CHUNK_SIZE", "200"))
+# максимальный размер страницы результатов поиска
+SEARCH_PAGE_MAX = int(os.getenv("SEARCH_PAGE_MAX", "50"))
+
+# отклонённые до обработчика кадры; метки привязаны заранее
+MESSAGES_REJECTED = metrics.counter("messenger_messages_rejected_total",
+                                    "Frames rejected before reaching a handler, by reason", ("reason",))
+REJECTED_JSON = MESSAGES_REJECTED.labels("invalid_json")
+REJECTED_FORMAT = MESSAGES_REJECTED.labels("invalid_format")
+REJECTED_TYPE = MESSAGES_REJECTED.labels("unknown_type")
+REJECTED_STATE = MESSAGES_REJECTED.labels("wrong_state")
+REJECTED_VALIDATION = MESSAGES_REJECTED.labels("validation")
+# исключение, вылетевшее из обработчика
+HANDLER_ERRORS = metrics.counter("messenger_handler_errors_total", "Unhandled errors in handlers")
+
+log = get_logger("server")
+# подключения и отключения - частые отладочные события (LOG_DEBUG_SAMPLE=connections=...)
+connections_log = get_logger("connections")
 
 class MessengerServer:
-    def __init__(self):
-        # список активных соединений вместе с номером пользователя (user_id) это словарь user-ID->websocket
-        self.active_connections = {}
-        # для работы с БД асинхронная сессия
-        self.async_session = async_sessionmaker(engine, expire_on_commit=False)
+    # таблица обработчиков, заполняется декоратором @routes.handler
+    routes = MessageDispatcher()
+
+    def __init__(self, relay: RelayBackend = None, kdf_workers: int = KDF_WORKERS, secret: bytes = None):
+        # реестр активных соединений: user_id -> сессии (устройства), websocket -> сессия
+        self.active_connections = ConnectionRegistry()
+        # для работы с БД асинхронная сессия (общая фабрика из app.database)
+        self.async_session = async_session_maker
+        # пул процессов для PBKDF2, чтобы хеширование не блокировало цикл событий
+        self.hasher = PasswordHasher(kdf_workers)
+        # подписанные токены сессии для переподключения без пароля;
+        # secret - общий для всех рабочих процессов, иначе токен одного не примет другой
+        self.tokens = SessionTokens(secret)
+        # рассылка групповых сообщений по очередям участников в сети
+        self.fanout = FanoutEngine(self.active_connections)
+        # схема ответа со списком контактов
+        self.user_contacts_schema = UserContactsSchema()
+        # пачечная запись сообщений в БД (group commit)
+        self.message_writer = MessageWriter(self.async_session)
+        # фоновые задачи (доставка накопленных сообщений и т.п.)
+        self.background_tasks = set()
+        # таблица маршрутизации с обработчиками этого экземпляра
+        self.dispatch = self.routes.bind(self)
+        # шина между узлами: рабочими процессами или серверами (None - один процесс)
+        self.relay = relay
+        if relay is not None:
+            relay.on_deliver = self.deliver_routed
+            relay.on_undelivered = self.store_undelivered
+            relay.on_invalidate_contacts = self.invalidate_contact_caches
+            relay.on_invalidate_groups = lambda group_ids: group_members_cache.invalidate(*group_ids)
+            relay.local_users = self.active_connections.online_users
+        # рассылка присутствия контактам и пачечная запись last_seen
+        self.presence = PresenceService(self.async_session, self.active_connections, relay)
+        # частота и повторы кадров typing по отправителям
+        self.typing = TypingLimiter()
+        # ping и отключение простаивающих соединений (одно колесо таймеров на все сокеты)
+        self.heartbeat = HeartbeatMonitor()
+
+    # запуск и остановка фоновых служб сервера
+    async def start(self):
+        self.message_writer.start()
+        self.presence.start()
+        self.heartbeat.start()
+        if self.relay is not None:
+            await self.relay.start()
+        self.register_metrics()
+
+    async def stop(self):
+        metrics.unregister_collector("messenger_server")
+        await self.heartbeat.close()
+        if self.relay is not None:
+            await self.relay.close()
+        # дописываем сообщения, уже принятые от клиентов, и last_seen
+        await self.message_writer.close()
+        await self.presence.close()
+        self.hasher.close()
+
+    # region Метрики
+    # значения, которые сервер и так хранит, читаются при опросе /metrics, а не на каждое событие
+    def register_metrics(self):
+        metrics.collector("messenger_server", self.collect_metrics)
+        metrics.stats_collector("messenger_presence", self.presence.stats, "Presence service")
+        metrics.stats_collector("messenger_typing", self.typing.stats, "Typing indicator limiter")
+        metrics.stats_collector("messenger_heartbeat", self.heartbeat.stats, "Heartbeat monitor")
+        metrics.stats_collector("messenger_db_pool", pool_stats, "Database connection pool")
+        metrics.stats_collector("messenger_group_cache", group_members_cache.stats, "Group members cache")
+        metrics.stats_collector("messenger_contacts_cache", contact_lists_cache.stats, "Contact list cache")
+        metrics.stats_collector("messenger_watchers_cache", contact_watchers_cache.stats, "Contact watchers cache")
+
+    def collect_metrics(self) -> list:
+        connections = authorized = depth = depth_max = congested = 0
+        for state in self.active_connections:
+            connections += 1
+            if state.userId >= 0:
+                authorized += 1
+            if state.outbound is not None:
+                queued = state.outbound.depth
+                depth += queued
+                depth_max = max(depth_max, queued)
+                congested += state.outbound.congested
+        families = [
+            ("messenger_connections", "gauge", "Open WebSocket connections", [({}, connections)]),
+            ("messenger_sessions_authorized", "gauge", "Authorized sessions (devices)", [({}, authorized)]),
+            ("messenger_users_online", "gauge", "Users with a session on this node",
+             [({}, self.active_connections.user_count)]),
+            ("messenger_outbound_queue_depth", "gauge", "Frames waiting in all outbound queues", [({}, depth)]),
+            ("messenger_outbound_queue_depth_max", "gauge", "Deepest outbound queue", [({}, depth_max)]),
+            ("messenger_outbound_congested", "gauge", "Outbound queues over the high watermark",
+             [({}, congested)]),
+            ("messenger_message_writer_queue_depth", "gauge", "Messages waiting for the batched INSERT",
+             [({}, self.message_writer.depth)]),
+            ("messenger_message_writer_batches_total", "counter", "Message INSERT batches committed",
+             [({}, self.message_writer.batches)]),
+            ("messenger_message_writer_messages_total", "counter", "Messages written in batches",
+             [({}, self.message_writer.messages)]),
+            ("messenger_kdf_pending", "gauge", "PBKDF2 requests running or queued", [({}, self.hasher.pending)]),
+            ("messenger_kdf_queued", "gauge", "PBKDF2 requests waiting for a worker", [({}, self.hasher.queued)]),
+            ("messenger_background_tasks", "gauge", "Background tasks in flight", [({}, len(self.background_tasks))]),
+        ]
+        if self.relay is not None:
+            families += [
+                ("messenger_relay_batches_total", "counter", "Relay batches sent to other nodes",
+                 [({}, self.relay.batches)]),
+                ("messenger_relay_routed_total", "counter", "Deliveries routed to other nodes",
+                 [({}, self.relay.routed)]),
+            ]
+        return families
+    # endregion
 
     # region Database Initialization
-    async def init_db(self):
+    @staticmethod
+    async def init_db():
         async with engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
-        print("Database initialized")
+            # колонки, индексы и поиск, которых нет в таблицах, созданных до их появления
+            await conn.run_sync(upgrade_schema)
+        log.info("Database initialized")
     # endregion
 
     # region Connection Handling обработка входящих подключений
     async def handle_connection(self, websocket):
+        state = ConnectionState(websocket)
+        state.outbound = OutboundQueue(websocket, on_spill=partial(self.spill_undelivered, state))
+        state.outbound.start()
+        self.active_connections.add(state)
+        self.heartbeat.track(state)
+        if connections_log.isEnabledFor(logging.DEBUG):
+            connections_log.debug("connect", extra={"remote": str(websocket.remote_address)})
         try:
-            state = ConnectionState()
-            state.ConnectionStateEnum = ConnectionState.ConnectionStateEnum.Connected;
-            print(f"connect from {websocket}")
+            # токен в запросе подключения авторизует сокет сразу
+            token = self.get_handshake_token(websocket)
+            if token:
+                await self.resume_session(websocket, token, state)
             #Получение пакета
             async for message in websocket:
+                self.heartbeat.touch(state)
                 await self.route_message(websocket, message, state)
         except websockets.ConnectionClosed:
+            pass
+        finally:
             await self.handle_disconnect(websocket)
 
+    # токен из заголовка "Authorization: Bearer <token>" или из строки запроса ?token=
+    @staticmethod
+    def get_handshake_token(websocket) -> str | None:
+        request = getattr(websocket, "request", None)
+        if request is None:
+            return None
+        authorization = request.headers.get("Authorization", "")
+        if authorization.startswith("Bearer "):
+            return authorization[7:].strip()
+        query = urlsplit(request.path).query
+        if query:
+            return parse_qs(query).get("token", [None])[0]
+        return None
+
     # обработка отключений
     async def handle_disconnect(self, websocket):
-        user_id = next((uid for uid, ws in self.active_connections.items() if ws == websocket), None)
-        if user_id:
-            del self.active_connections[user_id]
-            print(f"User {user_id} disconnected")
+        state = self.active_connections.remove(websocket)
+        if state is None:
+            return
+        self.heartbeat.forget(state)
+        # неотправленные сообщения из очереди возвращаются в офлайн-хранилище
+        state.outbound.close()
+        if state.userId >= 0:
+            connections_log.debug("disconnect", extra={"user_id": state.userId})
+            if not self.active_connections.is_online(state.userId):
+                self.on_user_offline(state.userId)
+
+    # привязка сессии к пользователю после входа
+    def authorize(self, state: ConnectionState, user_id: int):
+        previous = state.userId
+        if self.active_connections.authorize(state, user_id):
+            self.on_user_online(user_id)
+        if 0 <= previous != user_id and not self.active_connections.is_online(previous):
+            self.on_user_offline(previous)
+
+    # первая сессия пользователя на этом узле
+    def on_user_online(self, user_id: int):
+        if self.relay is not None:
+            self.relay.user_online(user_id)
+        self.presence.online(user_id)
+
+    # закрыта последняя сессия пользователя на этом узле
+    def on_user_offline(self, user_id: int):
+        if self.relay is not None:
+            self.relay.user_offline(user_id)
+        self.presence.offline(user_id)
+        self.typing.forget(user_id)
+
+    # пользователь в сети на этом или на другом узле
+    def is_online(self, user_id: int) -> bool:
+        if self.active_connections.is_online(user_id):
+            return True
+        return self.relay is not None and self.relay.directory.is_online(user_id)
 
     # endregion
 
     # region определение обработчика сообщения
     async def route_message(self, websocket, raw_data: dict, state :ConnectionState):
+        # трасса кадра: выбор делается здесь, один раз на кадр; None - кадр не трассируется
+        trace = tracer.start_trace("receive")
+        if trace is not None:
+            trace.set("user.id", state.userId)
+            trace_token = current_span.set(trace)
         try:
             data = json.loads(raw_data)
-            message_type: str = data.get('type')
-
-            schema = self.get_schema_for_type(message_type)
-            if not schema:
-                await self.send_error(websocket, f"Invalid message type: {message_type}")
+            if trace is not None:
+                mark = trace.record("decode", trace.start_ns, bytes=len(raw_data))
+            if not isinstance(data, dict):
+                REJECTED_FORMAT.inc()
+                await self.send_error(websocket, "Invalid message format")
                 return
 
-            print(f"получили сообщение типа {message_type}")
-            # разобранный по правилам схемы dict из JSON
-            validated = schema.load(data)
-
-            # получение обработка по имени
-            handler = getattr(self, f"handle_{validated['type']}", None)
+            # маршрут (схема, обработчик, требуемое состояние) из таблицы, собранной при старте
+            route = self.dispatch.get(data.get('type'))
+            if route is None:
+                REJECTED_TYPE.inc()
+                await self.send_error(websocket, f"Invalid message type: {data.get('type')}")
+                return
+            route.received.inc()
 
-            if state.state == ConnectionState.ConnectionStateEnum.Connected:
-                if message_type in {"login", "register"}:
-                    await handler(websocket, validated, state)
+            if route.requires is not None and state.state is not route.requires:
+                REJECTED_STATE.inc()
+                if route.requires is Authorized:
+                    await self.send_error(websocket, "Unauthorized")
                 else:
-                    await self.send_error(websocket, f"Unauthorized")
-                    return
+                    await self.send_error(websocket, "Already authorized")
+                return
 
+            # разобранный по правилам схемы dict из JSON
+            validated = route.schema.load(data)
+            if trace is not None:
+                trace.name = f"receive {route.message_type}"
+                mark = trace.record("validate", mark)
 
             # ВЫЗОВ Обработчика
-            if handler:
-                await handler(websocket, validated,state)
-            else:
-                await self.send_error(websocket, f"Unhandled message type: {message_type}")
-
-        except json.JSONDecodeError:
+            route.calls += 1
+            started = time.perf_counter()
+            try:
+                await route.handler(websocket, validated, state)
+            finally:
+                route.latency.observe(time.perf_counter() - started)
+                if trace is not None:
+                    trace.record("handler", mark)
+
+        except json.JSONDecodeError as e:
+            REJECTED_JSON.inc()
+            if trace is not None:
+                trace.fail(e)
             await self.send_error(websocket, "Invalid JSON format")
         except ValidationError as e:
+            REJECTED_VALIDATION.inc()
+            if trace is not None:
+                trace.fail(e)
             await self.send_error(websocket, f"Validation error: {e.messages}")
         except Exception as e:
+            HANDLER_ERRORS.inc()
+            log.exception("Handler error", extra={"user_id": state.userId})
+            if trace is not None:
+                trace.fail(e)
             await self.send_error(websocket, f"Server error: {str(e)}")
-
-    # по словарю получаем, какая схема JSON какому типу сообщения нужна
-    def get_schema_for_type(self, message_type):
-        return {
-            'register': AuthSchema(),
-            'login': AuthSchema(),
-            'create_group': CreateGroupSchema(),
-            'private_message': PrivateMessageSchema(),
-            'group_message': GroupMessageSchema(),
-            'get_user_contacts' : GetUserContactsSchema()
-        }.get(message_type)
+        finally:
+            if trace is not None:
+                current_span.reset(trace_token)
+                trace.end()
 
     # endregion
 
     # region Response Helpers
+    # ставит готовый кадр в исходящую очередь соединения, сеть не ждём
+    async def send_frame(self, websocket, frame: str):
+        state = self.active_connections.get(websocket)
+        if state is not None:
+            state.outbound.put(frame)
+
     async def send_success(self, websocket, message_type, data:dict=None):
         response = {
             "type": message_type,
@@ -132,20 +368,23 @@ class MessengerServer:
         }
         if data:
             response["data"] = data
-        await websocket.send(json.dumps(response))
+        await self.send_frame(websocket, json.dumps(response))
 
-    async def send_error(self, websocket, message):
+    async def send_error(self, websocket, message, retry_after: float = None):
         error_msg = {
             "type": "error",
             "status": "error",
             "timestamp": datetime.now(timezone.utc).isoformat(),
             "message": message
         }
-        await websocket.send(json.dumps(error_msg))
+        if retry_after is not None:
+            error_msg["retry_after"] = retry_after
+        await self.send_frame(websocket, json.dumps(error_msg))
 
     # endregion
 
     # region Обработчики
+    @routes.handler("register", AuthSchema, requires=Connected)
     async def handle_register(self, websocket, data, state : ConnectionState):
         try:
             async with self.async_session() as session:
@@ -156,24 +395,26 @@ class MessengerServer:
                 user_data = {
                     "username": data['username'],
                     "salt": salt.hex(),
-                    "password_hash": self.hash_password(data['password'], salt),
+                    "password_hash": await self.hasher.hash(data['password'], salt),
                     "email" : data['email']
                 }
 
                 user = await UserCRUD.create_user(session, user_data)
-                self.active_connections[user['id']] = websocket
+                self.authorize(state, user['id'])
 
-                user.remove('password_hash')
-                user.remove('salt')
+                del user['password_hash']
+                del user['salt']
+                user['token'], user['token_expires'] = self.tokens.issue(user['id'])
 
                 await self.send_success(websocket, "auth_success", user)
-                state.state = ConnectionState.ConnectionStateEnum.Authorized
-                state.userId = user['id']
+        except HasherBusy as e:
+            await self.send_error(websocket, "Server busy", retry_after=e.retry_after)
         except Exception as e:
             await self.send_error(websocket, str(e))
             """ типа комментарий """
 
     # Обработка входа
+    @routes.handler("login", AuthSchema, requires=Connected)
     async def handle_login(self, websocket, data:dict, state: ConnectionState):
         try:
             # правильное получени сесии асихронной работы с БД
@@ -181,34 +422,146 @@ class MessengerServer:
                 # Получаем пользователя как SQLAlchemy модель
                 user_model: User = await UserCRUD.get_user_by_username(session, data['username'])
 
+            if user_model is not None:
                 # Конвертируем модель в словарь через схему
                 user_dict = UserSchema().dump(user_model)
                 salt = bytes.fromhex(user_dict['salt'])
 
-                # Проверяем пароль
-                test_hash = self.hash_password(data['password'], salt)
-
-                if user_dict['password_hash'] == test_hash:
-                    self.active_connections[user_dict['id']] = websocket
+                # Проверяем пароль (хеш считается в пуле процессов, сессия БД уже отпущена)
+                if await self.hasher.verify(data['password'], salt, user_dict['password_hash']):
+                    self.authorize(state, user_model.id)
                     del user_dict['password_hash']
                     del user_dict['salt']
-                    state.state = ConnectionState.ConnectionStateEnum.Authorized
-                    state.userId = user_model.id
+                    user_dict['token'], user_dict['token_expires'] = self.tokens.issue(user_model.id)
 
                     await self.send_success(websocket, "auth_success", user_dict)
+                    self.run_background(self.deliver_offline(state))
                     return
 
             await self.send_error(websocket, "Invalid credentials")
 
+        except HasherBusy as e:
+            await self.send_error(websocket, "Server busy", retry_after=e.retry_after)
         except Exception as e:
             await self.send_error(websocket, str(e))
 
-    # создание группы не доделано пока и не понятно зачем
+    # Повторный вход по токену сессии: только проверка HMAC, без БД и PBKDF2
+    @routes.handler("resume", ResumeSchema, requires=Connected)
+    async def handle_resume(self, websocket, data: dict, state: ConnectionState):
+        await self.resume_session(websocket, data['token'], state)
+
+    async def resume_session(self, websocket, token: str, state: ConnectionState):
+        user_id = self.tokens.verify(token)
+        if user_id is None:
+            await self.send_error(websocket, "Invalid or expired token")
+            return
+        self.authorize(state, user_id)
+        # продлеваем сессию новым токеном
+        new_token, expires = self.tokens.issue(user_id)
+        await self.send_success(websocket, "auth_success",
+                                {"id": user_id, "token": new_token, "token_expires": expires})
+        self.run_background(self.deliver_offline(state))
+
+    # создание группы, создатель становится участником
+    @routes.handler("create_group", CreateGroupSchema)
     async def handle_create_group(self, websocket, data,state: ConnectionState):
         try:
-            async for session in self.session:
-                group = await GroupCRUD.create_group(session, data)
-                await self.send_success(websocket, "group_created", group)
+            async with self.async_session() as session:
+                group, member_ids = await GroupCRUD.create_group(
+                    session, data['name'], state.userId, data['members']
+                )
+            if self.relay is not None:
+                # списки контактов участников закешированы и на других узлах;
+                # там же мог остаться пустой состав, прочитанный до создания группы
+                self.relay.invalidate_contacts(member_ids)
+                self.relay.invalidate_groups((group.id,))
+            await self.send_success(websocket, "group_created", GroupSchema().dump({
+                "id": group.id,
+                "name": group.name,
+                "creator_id": group.creator_id,
+                "created_at": group.created_at,
+                "members": sorted(member_ids),
+            }))
+
+        except Exception as e:
+            await self.send_error(websocket, str(e))
+
+    # участников добавляет и исключает создатель группы; участник может выйти сам
+    @routes.handler("add_group_member", GroupMemberSchema)
+    async def handle_add_group_member(self, websocket, data, state: ConnectionState):
+        try:
+            group_id, user_id = data['group_id'], data['user_id']
+            async with self.async_session() as session:
+                group = await GroupCRUD.get_group(session, group_id)
+                if group is None or group.creator_id != state.userId:
+                    await self.send_error(websocket, "Only the group creator can add members")
+                    return
+                if user_id in await GroupCRUD.get_cached_member_ids(session, group_id):
+                    await self.send_error(websocket, "Already a group member")
+                    return
+                if await session.get(User, user_id) is None:
+                    await self.send_error(websocket, "User not found")
+                    return
+                await GroupCRUD.add_member(session, group_id, user_id)
+            self.group_membership_changed(group_id, user_id)
+            await self.send_success(websocket, "group_member_added", {"group_id": group_id, "user_id": user_id})
+        except Exception as e:
+            await self.send_error(websocket, str(e))
+
+    @routes.handler("remove_group_member", GroupMemberSchema)
+    async def handle_remove_group_member(self, websocket, data, state: ConnectionState):
+        try:
+            group_id, user_id = data['group_id'], data['user_id']
+            async with self.async_session() as session:
+                group = await GroupCRUD.get_group(session, group_id)
+                if group is None or (user_id != state.userId and group.creator_id != state.userId):
+                    await self.send_error(websocket, "Only the group creator can remove members")
+                    return
+                if user_id not in await GroupCRUD.get_cached_member_ids(session, group_id):
+                    await self.send_error(websocket, "Not a group member")
+                    return
+                await GroupCRUD.remove_member(session, group_id, user_id)
+            self.group_membership_changed(group_id, user_id)
+            await self.send_success(websocket, "group_member_removed", {"group_id": group_id, "user_id": user_id})
+        except Exception as e:
+            await self.send_error(websocket, str(e))
+
+    def group_membership_changed(self, group_id: int, user_id: int):
+        """Свой кеш GroupCRUD уже обновил; состав группы и список контактов участника закешированы и на других узлах"""
+        if self.relay is not None:
+            self.relay.invalidate_groups((group_id,))
+            self.relay.invalidate_contacts((user_id,))
+
+    """
+    Сообщение в группу: сохраняется один раз, кадр сериализуется один раз
+    и раздаётся всем участникам в сети; для остальных записывается ожидающая доставка
+    """
+    @routes.handler("group_message", GroupMessageSchema)
+    async def handle_group_message(self, websocket, data, state: ConnectionState):
+        try:
+            group_id = data['group_id']
+            async with self.async_session() as session:
+                # состав группы из кеша, для активных групп без обращения к БД
+                member_ids = await GroupCRUD.get_cached_member_ids(session, group_id)
+            if state.userId not in member_ids:
+                await self.send_error(websocket, "Not a group member")
+                return
+
+            online = self.fanout.online_members(member_ids)
+            # участники, чьи сессии держат другие узлы
+            remote = self.relay.directory.online_members(member_ids) if self.relay is not None else ()
+            offline = member_ids.difference(online, remote)
+            # сообщение и записи об ожидающей доставке сохраняются пачкой
+            message = await self.message_writer.submit(
+                MessageCRUD.build_group_message(data['content'], state.userId, group_id), offline
+            )
+
+            frame = self.encode_message(message)
+            # другим устройствам отправителя тоже, кроме того, с которого пришло сообщение
+            self.fanout.broadcast(frame, online, message.id, exclude=state)
+            if remote:
+                self.relay.route(remote, frame, message.id)
+            await self.send_success(websocket, "message_sent", {"id": message.id, "group_id": group_id})
 
         except Exception as e:
             await self.send_error(websocket, str(e))
@@ -216,137 +569,440 @@ class MessengerServer:
     """
     Обработка сообщения для другого получателя
     """
+    @routes.handler("private_message", PrivateMessageSchema)
     async def handle_private_message(self, websocket, data,state: ConnectionState):
         try:
-            user_id = list(self.active_connections.keys()) # Для определения текущего пользователя
-            [list(self.active_connections.values()).index(websocket)]
+            # отправитель - пользователь, авторизованный на этом соединении;
+            # статус доставки записывается сразу, без второго commit.
+            # Сообщение сохраняется пачкой вместе с сообщениями других соединений
+            message = await self.message_writer.submit(MessageCRUD.build_private_message(
+                data, state.userId,
+                delivered=self.is_online(data['receiver_id'])
+            ))
 
-            async with self.async_session() as session:
-                message = await MessageCRUD.create_private_message(session, data, user_id[0])
-
-                await self.send_private_message(message, session)
-                await self.send_success(websocket, "message_sent", data)
+            self.send_private_message(message)
+            await self.send_success(websocket, "message_sent", data)
 
         except Exception as e:
             await self.send_error(websocket, str(e))
     """
     отправляет частное сообщение
     """
-    async def send_private_message(self, message: Message, session: AsyncSession):
+    def send_private_message(self, message: Message):
+        """
+        Отправляет приватное сообщение на все устройства получателя.
+        Если получатель успел отключиться, сообщение возвращается в офлайн-хранилище
         """
-        Отправляет приватное сообщение конкретному пользователю
-        и обновляет статус доставки
+        queued = False
+        frame = self.encode_message(message)
+        for receiver in self.active_connections.sessions(message.receiver_id):
+            # кладём в очередь устройства, медленный получатель не задерживает отправителя
+            if receiver.outbound.put(frame, message.id):
+                queued = True
+        # устройства получателя на других узлах
+        if self.relay is not None and self.relay.route((message.receiver_id,), frame, message.id):
+            queued = True
+        if message.is_delivered and not queued:
+            self.store_undelivered(message.receiver_id, (message.id,))
+
+    def deliver_routed(self, user_ids, frame: str, message_id: int = None, ephemeral: bool = False):
         """
+        Кадр, пересланный другим узлом, для сессий этого узла.
+        Если получатель успел отключиться, сообщение возвращается в офлайн-хранилище
+        """
+        if ephemeral:
+            self.fanout.offer(frame, user_ids)
+            return
+        sessions = self.active_connections.sessions
+        for user_id in user_ids:
+            receivers = sessions(user_id)
+            for receiver in receivers:
+                receiver.outbound.put(frame, message_id)
+            if not receivers and message_id is not None:
+                self.store_undelivered(user_id, (message_id,))
+
+    """
+    Индикатор набора текста: без ответа отправителю, БД - только при промахе кешей.
+    Получатели - те же, кто видит присутствие отправителя: участники группы или
+    собеседник, у которого отправитель в одобренных контактах. Повторы и слишком частые
+    кадры отбрасываются, получателям кадр кладётся только в неперегруженные очереди
+    """
+    @routes.handler("typing", TypingSchema)
+    async def handle_typing(self, websocket, data, state: ConnectionState):
+        group_id = data.get('group_id')
+        if group_id is not None:
+            members = group_members_cache.get(group_id)
+            if members is None:
+                async with self.async_session() as session:
+                    members = await GroupCRUD.get_cached_member_ids(session, group_id)
+            if state.userId not in members:
+                return
+            recipients = members - {state.userId}
+            chat = ('group', group_id)
+        else:
+            # как для присутствия: кадр получает только тот, у кого отправитель в контактах
+            if data['peer_id'] not in await self.presence.watchers(state.userId):
+                return
+            recipients = (data['peer_id'],)
+            chat = ('peer', data['peer_id'])
+        if not self.typing.allow(state.userId, chat, data['active']):
+            return
+
+        frame = {"type": "typing", "sender_id": state.userId, "active": data['active']}
+        if group_id is not None:
+            frame["group_id"] = group_id
+        else:
+            frame["peer_id"] = state.userId
+        frame = json.dumps(frame)
+        self.fanout.offer(frame, self.fanout.online_members(recipients))
+        if self.relay is not None:
+            remote = self.relay.directory.online_members(recipients)
+            if remote:
+                self.relay.route(remote, frame, ephemeral=True)
+
+    # кадр сообщения для клиента (личного или группового)
+    @staticmethod
+    def encode_message(message: Message) -> str:
+        return json.dumps(MessengerServer.message_data(message))
+
+    @staticmethod
+    def message_data(message: Message) -> dict:
+        message_data = {
+            "type": "group_message" if message.group_id is not None else "private_message",
+            "id": message.id,
+            "sender_id": message.sender_id,
+            "content": message.content,
+            "created_at": message.created_at.isoformat(),
+            "is_group": message.group_id is not None
+        }
+        if message.group_id is not None:
+            message_data["group_id"] = message.group_id
+        else:
+            message_data["receiver_id"] = message.receiver_id
+        return message_data
+
+    """
+    История переписки постранично (keyset по id сообщений)
+    """
+    @routes.handler("get_history", GetHistorySchema)
+    async def handle_get_history(self, websocket, data, state: ConnectionState):
         try:
-            # Сериализация сообщения
-            message_data = {
-                "type": "private_message",
-                "id": message.id,
-                "sender_id": message.sender_id,
-                "receiver_id" : message.receiver_id,
-                "content": message.content,
-                "created_at": message.created_at.isoformat(),
-                "is_group": False
+            limit = min(data['limit'], HISTORY_PAGE_MAX)
+            group_id = data.get('group_id')
+            async with self.async_session() as session:
+                if group_id is not None:
+                    member_ids = await GroupCRUD.get_cached_member_ids(session, group_id)
+                    if state.userId not in member_ids:
+                        await self.send_error(websocket, "Not a group member")
+                        return
+                # на одно сообщение больше, чтобы узнать, есть ли следующая страница
+                messages = await MessageCRUD.get_history(
+                    session, state.userId, limit + 1,
+                    peer_id=data.get('peer_id'), group_id=group_id,
+                    before_id=data.get('before_id'), after_id=data.get('after_id'),
+                )
+
+            has_more = len(messages) > limit
+            if has_more:
+                # лишнее сообщение - самое дальнее от точки отсчёта
+                messages = messages[:limit] if 'after_id' in data else messages[1:]
+
+            response = {
+                "type": "history",
+                "messages": [self.message_data(m) for m in messages],
+                "has_more": has_more
             }
+            if group_id is not None:
+                response["group_id"] = group_id
+            else:
+                response["peer_id"] = data['peer_id']
+            await self.send_frame(websocket, json.dumps(response))
 
-            # Получаем соединение получателя
-            receiver_ws = self.active_connections.get(message.receiver_id)
-
-            if receiver_ws:
-                try:
-                    # Отправляем сообщение через WebSocket
-                    await receiver_ws.send(json.dumps(message_data))
-
-                    # Обновляем статус доставки в БД
-                    #async with self.async_session() as session:
-                    #    async with session.begin():
-                    message.is_delivered = True
-                    message.delivered_at = datetime.now(timezone.utc)
-                    #session.add(message)
-                    await session.commit()
-
-                except websockets.ConnectionClosed:
-                    # Обработка закрытого соединения
-                    #async with self.async_session() as session:
-                    #    async with session.begin():
-                    message.is_delivered = False
-                    #session.add(message)
-                    await session.commit()
-
-                    # Удаляем из активных подключений
-                    del self.active_connections[message.receiver_id]
-                    print(f"User {message.receiver_id} disconnected")
+        except Exception as e:
+            await self.send_error(websocket, str(e))
 
-            else:
-                # Помечаем сообщение как недоставленное
-                #async with self.async_session() as session:
-                    #async with session.begin():
-                message.is_delivered = False
-#                session.add(message)
-                await session.commit()
+    """
+    Выгрузка всей переписки потоком кадров history_chunk
+    """
+    @routes.handler("export_history", ExportHistorySchema)
+    async def handle_export_history(self, websocket, data, state: ConnectionState):
+        if state.exporting:
+            await self.send_error(websocket, "Export already in progress")
+            return
+        group_id = data.get('group_id')
+        if group_id is not None:
+            try:
+                async with self.async_session() as session:
+                    member_ids = await GroupCRUD.get_cached_member_ids(session, group_id)
+            except Exception as e:
+                await self.send_error(websocket, str(e))
+                return
+            if state.userId not in member_ids:
+                await self.send_error(websocket, "Not a group member")
+                return
+        # выгрузка идёт в фоне, соединение продолжает принимать команды
+        state.exporting = True
+        self.run_background(self.export_history(state, data))
 
+    async def export_history(self, state: ConnectionState, data: dict):
+        """
+        Сообщения читаются пачками по HISTORY_CHUNK_SIZE (по ключу id), каждая пачка -
+        один кадр. Следующая пачка запрашивается из БД, только когда предыдущий кадр ушёл
+        в сокет, поэтому в памяти сервера не больше одной пачки на выгрузку. Сессия БД
+        берётся на время одного запроса: медленный клиент не держит соединение пула
+        """
+        user_id = state.userId
+        target = {"group_id": data['group_id']} if 'group_id' in data else {"peer_id": data['peer_id']}
+        after_id = data.get('after_id')
+        seq = 0
+        count = 0
+        try:
+            while True:
+                async with self.async_session() as session:
+                    chunk = await MessageCRUD.get_history_range(
+                        session, user_id, HISTORY_CHUNK_SIZE, **target,
+                        before_id=data.get('before_id'), after_id=after_id,
+                    )
+                if not chunk:
+                    break
+                frame = {
+                    "type": "history_chunk",
+                    **target,
+                    "seq": seq,
+                    "messages": [self.message_data(m) for m in chunk],
+                    "done": False
+                }
+                if state.userId != user_id or not state.outbound.put(json.dumps(frame)):
+                    # соединение закрыто или перегружено живыми сообщениями
+                    return
+                seq += 1
+                count += len(chunk)
+                if len(chunk) < HISTORY_CHUNK_SIZE:
+                    break
+                after_id = chunk[-1].id
+                await state.outbound.drained()
+            state.outbound.put(json.dumps({
+                "type": "history_chunk", **target, "seq": seq, "messages": [], "done": True, "count": count
+            }))
         except Exception as e:
-            print(f"Error sending private message: {str(e)}")
-            # Логирование ошибки или повторная попытка отправки
+            log.exception("Error exporting history", extra={"user_id": state.userId})
+            await self.send_error(state.websocket, str(e))
+        finally:
+            state.exporting = False
+
+    """
+    Полнотекстовый поиск по перепискам пользователя
+    """
+    @routes.handler("search_messages", SearchMessagesSchema)
+    async def handle_search_messages(self, websocket, data, state: ConnectionState):
+        try:
+            limit = min(data['limit'], SEARCH_PAGE_MAX)
+            group_id = data.get('group_id')
+            async with self.async_session() as session:
+                if group_id is not None:
+                    member_ids = await GroupCRUD.get_cached_member_ids(session, group_id)
+                    if state.userId not in member_ids:
+                        await self.send_error(websocket, "Not a group member")
+                        return
+                rows = await MessageCRUD.search_messages(
+                    session, state.userId, data['query'], limit + 1,
+                    peer_id=data.get('peer_id'), group_id=group_id,
+                    after_rank=data.get('after_rank'), after_id=data.get('after_id'),
+                )
+
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            results = []
+            for message, rank, snippet in rows:
+                item = self.message_data(message)
+                item["rank"] = rank
+                item["snippet"] = snippet
+                results.append(item)
+            response = {
+                "type": "search_results",
+                "query": data['query'],
+                "results": results,
+                "has_more": has_more
+            }
+            if has_more:
+                response["next_rank"] = results[-1]["rank"]
+                response["next_id"] = results[-1]["id"]
+            await self.send_frame(websocket, json.dumps(response))
+
+        except Exception as e:
+            await self.send_error(websocket, str(e))
+
+    # кто из одобренных контактов в сети; дальше изменения приходят кадрами presence
+    @routes.handler("get_presence", GetPresenceSchema)
+    async def handle_get_presence(self, websocket, data, state: ConnectionState):
+        try:
+            await self.send_frame(websocket, json.dumps(await self.presence.snapshot(state.userId)))
+        except Exception as e:
+            await self.send_error(websocket, str(e))
 
     """
         получение и обоработка контактов пользователя
      """
 
+    @routes.handler("get_user_contacts", GetUserContactsSchema)
     async def handle_get_user_contacts(self, websocket, data,state: ConnectionState):
         try:
+            # готовый кадр из кеша; сбрасывается при изменении контактов или групп
+            frame = contact_lists_cache.get(state.userId)
+            if frame is None:
+                version = contact_lists_cache.version
+                async with self.async_session() as session:
+                    cons = await ContactCRUD.get_contact_list(session, state.userId)
+                frame = self.user_contacts_schema.dumps(cons)
+                contact_lists_cache.put(state.userId, frame, version)
+            await self.send_frame(websocket, frame)
+        except Exception as e:
+            await self.send_error(websocket, str(e))
+
+    """
+    Контакты: запрос (своя запись PENDING), подтверждение входящего запроса
+    (обе записи APPROVED) и удаление (обе записи DELETED, блокировка другой стороны остаётся).
+    Присутствие и typing видят пользователи, у которых отправитель в APPROVED
+    """
+    @routes.handler("add_contact", ContactRequestSchema)
+    async def handle_add_contact(self, websocket, data, state: ConnectionState):
+        try:
+            contact_id = data['contact_id']
             async with self.async_session() as session:
-                try:
-                    # Получаем контакты пользователя
-                    result = await session.execute(
-                        select(UserContact, User.username)
-                        .join(User, UserContact.contact_id == User.id)  # JOIN с таблицей пользователей
-                        .where(UserContact.user_id == state.userId)
-                    )
+                if contact_id == state.userId or await session.get(User, contact_id) is None:
+                    await self.send_error(websocket, "User not found")
+                    return
+                if await ContactCRUD.get_status(session, state.userId, contact_id) == RelationshipStatus.APPROVED:
+                    await self.send_error(websocket, "Already a contact")
+                    return
+                await ContactCRUD.set_contact(session, state.userId, contact_id, RelationshipStatus.PENDING,
+                                              data.get('custom_nickname'))
+            self.contacts_changed(state.userId, contact_id)
+            await self.send_success(websocket, "contact_updated",
+                                    {"contact_id": contact_id, "status": RelationshipStatus.PENDING.value})
+        except Exception as e:
+            await self.send_error(websocket, str(e))
 
-                    contacts=  result.all()
+    @routes.handler("approve_contact", ContactRequestSchema)
+    async def handle_approve_contact(self, websocket, data, state: ConnectionState):
+        try:
+            contact_id = data['contact_id']
+            async with self.async_session() as session:
+                if await ContactCRUD.get_status(session, contact_id, state.userId) != RelationshipStatus.PENDING:
+                    await self.send_error(websocket, "No contact request")
+                    return
+                await ContactCRUD.set_contact(session, contact_id, state.userId, RelationshipStatus.APPROVED)
+                await ContactCRUD.set_contact(session, state.userId, contact_id, RelationshipStatus.APPROVED,
+                                              data.get('custom_nickname'))
+            self.contacts_changed(state.userId, contact_id)
+            await self.send_success(websocket, "contact_updated",
+                                    {"contact_id": contact_id, "status": RelationshipStatus.APPROVED.value})
+        except Exception as e:
+            await self.send_error(websocket, str(e))
 
-                    ch = UserContactsSchema()
+    @routes.handler("delete_contact", ContactRequestSchema)
+    async def handle_delete_contact(self, websocket, data, state: ConnectionState):
+        try:
+            contact_id = data['contact_id']
+            async with self.async_session() as session:
+                if await ContactCRUD.get_status(session, state.userId, contact_id) is None:
+                    await self.send_error(websocket, "Not a contact")
+                    return
+                await ContactCRUD.set_contact(session, state.userId, contact_id, RelationshipStatus.DELETED)
+                other = await ContactCRUD.get_status(session, contact_id, state.userId)
+                if other is not None and other != RelationshipStatus.BLOCKED:
+                    await ContactCRUD.set_contact(session, contact_id, state.userId, RelationshipStatus.DELETED)
+            self.contacts_changed(state.userId, contact_id)
+            await self.send_success(websocket, "contact_updated",
+                                    {"contact_id": contact_id, "status": RelationshipStatus.DELETED.value})
+        except Exception as e:
+            await self.send_error(websocket, str(e))
 
-                    cons : UserContactsClass = UserContactsClass()
+    def contacts_changed(self, *user_ids: int):
+        """Свои кеши ContactCRUD уже сбросил; списки контактов и наблюдатели закешированы и на других узлах"""
+        if self.relay is not None:
+            self.relay.invalidate_contacts(user_ids)
 
+    @staticmethod
+    def invalidate_contact_caches(user_ids):
+        """Другой узел изменил контакты пользователей"""
+        contact_lists_cache.invalidate(*user_ids)
+        contact_watchers_cache.invalidate(*user_ids)
 
-                    for cor in contacts:
-                        con = OneContactClass()
-                        con.status = cor.UserContact.status.value
-                        con.custom_nickname = cor.UserContact.custom_nickname
-                        con.user_id = cor.UserContact.contact_id
-                        con.user_name = cor.username
+    # endregion
 
-                        cons.contacts.append(con)
-                except Exception as e:
-                    print(e)
-                data = ch.dumps(cons)
-                await websocket.send(data)
+    # region Офлайн-доставка
+    def run_background(self, coro):
+        # задача копирует контекст при создании: без сброса её операции
+        # попали бы в трассу обработчика, который давно ответил клиенту
+        trace_token = current_span.set(None)
+        try:
+            task = asyncio.create_task(coro)
+        finally:
+            current_span.reset(trace_token)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    # сообщения, которые не удалось отдать клиенту (перегрузка очереди или разрыв соединения)
+    def spill_undelivered(self, state: ConnectionState, message_ids):
+        if state.userId >= 0:
+            self.store_undelivered(state.userId, message_ids)
+
+    def store_undelivered(self, user_id: int, message_ids):
+        self.run_background(self._store_undelivered(user_id, list(message_ids)))
+
+    async def _store_undelivered(self, user_id: int, message_ids: list[int]):
+        try:
+            async with self.async_session() as session:
+                await MessageCRUD.mark_undelivered(session, user_id, message_ids)
         except Exception as e:
-            await self.send_error(websocket, str(e))
+            log.exception("Error storing undelivered messages", extra={"user_id": user_id})
 
+    async def deliver_offline(self, state: ConnectionState):
+        """
+        Доставка накопленных сообщений после входа: страница читается одним запросом,
+        отмечается доставленной одним UPDATE/DELETE и кладётся в очередь соединения
+        (писатель склеивает её в batch-кадры). Следующая страница - когда предыдущая ушла в сокет
+        """
+        user_id = state.userId
+        page_size = min(OFFLINE_PAGE_SIZE, state.outbound.high)
+        after_id = 0
+        try:
+            while state.userId == user_id and not state.outbound.closed:
+                async with self.async_session() as session:
+                    messages = await MessageCRUD.get_undelivered(session, user_id, after_id, page_size)
+                    if not messages:
+                        return
+                    await MessageCRUD.mark_delivered(
+                        session, user_id,
+                        [m.id for m in messages if m.group_id is None],
+                        [m.id for m in messages if m.group_id is not None],
+                    )
+                # не дошедшие до клиента вернутся в хранилище через spill_undelivered
+                for message in messages:
+                    state.outbound.put(self.encode_message(message), message.id)
+                if len(messages) < page_size:
+                    return
+                after_id = messages[-1].id
+                await state.outbound.drained()
+        except Exception as e:
+            log.exception("Error delivering offline messages", extra={"user_id": user_id})
 
     # endregion
 
     # region Utility Methods
     @staticmethod
     def hash_password(password: str, salt: bytes) -> str:
-        """Генерация хеша пароля с использованием предоставленного salt"""
-        key = hashlib.pbkdf2_hmac(
-            'sha256',
-            password.encode('utf-8'),
-            salt,
-            100000
-        )
-        return key.hex()
+        """Генерация хеша пароля с использованием предоставленного salt (синхронно)"""
+        return hash_password(password, salt)
     # endregion
 
 
 # инициализация данных чтобы не возиться каждый раз
-async def InitDBSampleData():
+async def InitDBSampleData(hasher: PasswordHasher):
     try:
-        async with GetSession() as session:
+        async with async_session_maker() as session:
             # Получаем контакты пользователя
             result = await session.execute(
                 select(User)
@@ -356,22 +1012,27 @@ async def InitDBSampleData():
             if not user:
                 # Генерация нового salt для каждого пользователя
                 salt = os.urandom(32)
+                salt2 = os.urandom(32)
+                # хеши считаются параллельно в пуле процессов
+                hash1, hash2 = await asyncio.gather(
+                    hasher.hash("user1user1", salt),
+                    hasher.hash("user2user2", salt2),
+                )
                 # Создание пользователя с раздельным хранением salt и хеша
                 user = User()
                 user.username="user1"
                 user.email="user1@email.com"
-                user.password_hash = MessengerServer.hash_password("user1user1", salt)
+                user.password_hash = hash1
                 user.salt= salt.hex()
 
                 session.add(user)
 
-                salt = os.urandom(32)
                 # Создание пользователя с раздельным хранением salt и хеша
                 user2 = User()
                 user2.username="user2"
                 user2.email="user2@email.com"
-                user2.password_hash = MessengerServer.hash_password("user2user2", salt)
-                user2.salt= salt.hex()
+                user2.password_hash = hash2
+                user2.salt= salt2.hex()
 
                 session.add(user2)
 
@@ -384,32 +1045,156 @@ async def InitDBSampleData():
                 session.add(contact)
                 await session.commit()
 
-                print(f"users added")
-    except Exception as e:
-        print(e)
+                log.info("Sample users added")
+    except Exception:
+        log.exception("Error adding sample users")
 
 
-## асинхронная главная процедура
-async def main():
-
-    # init db
+# подготовка БД: схема и тестовые данные (один раз, до запуска рабочих процессов)
+async def prepare_db():
+    hasher = PasswordHasher()
+    try:
+        await MessengerServer.init_db()
+        await InitDBSampleData(hasher)
+    finally:
+        hasher.close()
+        # соединения пула не должны достаться дочерним процессам
+        await engine.dispose()
 
-    await InitDBSampleData();
 
-    # создаём объект сервера
-    server = MessengerServer()
-    # инициализация БД
-    await server.init_db()
+## асинхронная главная процедура
+async def serve(host: str, port: int, relay: RelayBackend = None, workers: int = 1,
+                metrics_port: int = METRICS_PORT, secret: bytes = None):
 
-    # делаем аснхронную карутину для обработки поступающих соединений
-    async with websockets.serve(server.handle_connection, "localhost", 8765):
-        print("Messenger Server running on ws://localhost:8765")
-        await asyncio.Future()
+    # создаём объект сервера; при нескольких рабочих процессах ядра для PBKDF2 делятся между ними
+    server = MessengerServer(relay, kdf_workers=max(1, KDF_WORKERS // workers), secret=secret)
 
+    # SIGTERM - мягкая остановка: дописываем принятые сообщения и закрываемся
+    stop = asyncio.get_running_loop().create_future()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: stop.done() or stop.set_result(None))
+    except (NotImplementedError, AttributeError):
+        # Windows
+        pass
+
+    await server.start()
+    # метрики Prometheus на отдельном порту
+    metrics_server = await start_metrics_server(METRICS_HOST, metrics_port) if metrics_port else None
+    if metrics_server is not None:
+        log.info("Metrics on http://%s:%s/metrics", METRICS_HOST, metrics_port)
+    try:
+        # делаем аснхронную карутину для обработки поступающих соединений;
+        # reuse_port - несколько процессов слушают один порт, ядро распределяет подключения;
+        # ping_interval=None - пульсом управляет сервер (HeartbeatMonitor), а не задача на каждый сокет
+        async with websockets.serve(server.handle_connection, host, port,
+                                    reuse_port=workers > 1, ping_interval=None):
+            log.info("Messenger Server running on ws://%s:%s", host, port,
+                     extra={"node": relay.node_id} if relay is not None else None)
+            await stop
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+            await metrics_server.wait_closed()
+        await server.stop()
+        # фоновый экспортёр дописывает интервалы последних кадров
+        tracer.shutdown()
+
+
+# рабочий процесс: свой цикл событий, свои соединения, шина к соседям
+def run_worker(worker_id: int, workers: int, host: str, port: int,
+               bus_path: str = None, relay_url: str = None, node_id: str = None, metrics_port: int = 0,
+               secret: bytes = None):
+    # Ctrl+C получает вся группа процессов, завершение ведёт родитель
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # поток записи журнала родителя в дочерний процесс не переходит
+    setup_logging()
+    if relay_url:
+        # каждый процесс - отдельный узел общей шины
+        relay = create_relay(relay_url, f"{node_id}-{worker_id}")
+    else:
+        relay = WorkerBus(worker_id, workers, bus_path)
+    try:
+        # у каждого процесса свои метрики - и свой порт: metrics_port + номер процесса
+        asyncio.run(serve(host, port, relay, workers, metrics_port + worker_id if metrics_port else 0, secret))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_logging()
+
+
+def run_workers(workers: int, host: str, port: int, relay_url: str = None, node_id: str = None,
+                metrics_port: int = 0):
+    if not hasattr(socket, "SO_REUSEPORT"):
+        sys.exit("--workers requires SO_REUSEPORT (Linux, BSD, macOS)")
+    # без внешней шины процессы связываются Unix-сокетами в этом каталоге
+    bus_path = None if relay_url else tempfile.mkdtemp(prefix="messenger-bus-")
+    context = multiprocessing.get_context("fork")
+    # переподключение попадает в любой процесс: секрет токенов сессии у всех один
+    secret = session_secret()
+    processes = [
+        context.Process(target=run_worker,
+                        args=(worker_id, workers, host, port, bus_path, relay_url, node_id, metrics_port,
+                              secret))
+        for worker_id in range(workers)
+    ]
+    # SIGTERM родителю - мягкая остановка рабочих процессов
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # поток записи журнала дописывает очередь до fork: иначе процесс может унаследовать
+    # недописанный буфер stdout или захваченную блокировку
+    stop_logging()
+    try:
+        for process in processes:
+            process.start()
+        setup_logging()
+        for process in processes:
+            process.join()
+    except (KeyboardInterrupt, SystemExit):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+    finally:
+        if bus_path is not None:
+            shutil.rmtree(bus_path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Messenger server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="число рабочих процессов на одном порту (SO_REUSEPORT)")
+    parser.add_argument("--relay", default=os.getenv("RELAY_URL"),
+                        help="шина между серверами: redis://host:port или memory://")
+    parser.add_argument("--node-id", default=os.getenv("NODE_ID", f"{socket.gethostname()}-{os.getpid()}"),
+                        help="имя узла в шине")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="порт HTTP с метриками Prometheus (/metrics), 0 - выключено; "
+                             "при --workers процесс N слушает порт + N")
+    parser.add_argument("--trace-sample", type=float, default=TRACE_SAMPLE_RATE,
+                        help="доля кадров, для которых пишется трасса этапов (0 - выключено)")
+    parser.add_argument("--trace-exporter", default=TRACE_EXPORTER,
+                        help="куда писать трассы: ring, file:<путь> или otlp[:<url>]")
+    args = parser.parse_args()
+    setup_logging()
+    if args.relay and not SESSION_SECRET:
+        # у каждого узла будет свой случайный секрет: токен, выданный одним узлом, не примет другой
+        log.warning("SESSION_SECRET is not set: session tokens will not be accepted across relay nodes")
+    tracer.configure(args.trace_sample, create_exporter(args.trace_exporter) if args.trace_sample > 0 else None)
 
+    # инициализация БД
+    asyncio.run(prepare_db())
+    if args.workers > 1:
+        run_workers(args.workers, args.host, args.port, args.relay, args.node_id, args.metrics_port)
+    else:
+        relay = create_relay(args.relay, args.node_id) if args.relay else None
+        try:
+            asyncio.run(serve(args.host, args.port, relay, metrics_port=args.metrics_port))
+        except KeyboardInterrupt:
+            pass
+    stop_logging()
 
 
 if __name__ == "__main__":
-
-
-    asyncio.run(main())
\ No newline at end of file
+    main()
@@ -0,0 +1,30 @@
+# Общая настройка тестов: модули app импортируются из корня репозитория
+import asyncio
+import os
+import sys
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+# app.database создаёт движок при импорте; для модульных тестов хватает SQLite в памяти
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def session_maker(tmp_path):
+    """Фабрика сессий к отдельной БД SQLite в файле со всеми таблицами"""
+    from app.database import Base
+    import app.msg_models  # noqa: F401 - модели регистрируются в Base.metadata
+
+    # без пула: каждый тест идёт в своём asyncio.run, соединения между циклами не переходят
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}", poolclass=NullPool)
+
+    async def create_tables():
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+
+    asyncio.run(create_tables())
+    return async_sessionmaker(engine, expire_on_commit=False, autoflush=False)
@@ -0,0 +1,60 @@
+from app.connections import ConnectionRegistry, ConnectionState
+
+
+def connect(registry, name):
+    state = ConnectionState(name)
+    registry.add(state)
+    return state
+
+
+def test_several_devices_of_one_user():
+    registry = ConnectionRegistry()
+    phone = connect(registry, "phone")
+    laptop = connect(registry, "laptop")
+    # онлайн становится только первое устройство
+    assert registry.authorize(phone, 1)
+    assert not registry.authorize(laptop, 1)
+    assert registry.sessions(1) == {phone, laptop}
+    assert registry.user_count == 1
+    assert len(registry) == 2
+
+    assert registry.remove("phone") is phone
+    assert registry.is_online(1)
+    assert registry.remove("laptop") is laptop
+    # последнее устройство ушло - пользователя в индексе не остаётся
+    assert not registry.is_online(1)
+    assert registry.sessions(1) == frozenset()
+    assert list(registry.online_users()) == []
+    assert len(registry) == 0
+
+
+def test_unauthorized_connection_removed_from_socket_index():
+    registry = ConnectionRegistry()
+    state = connect(registry, "ws")
+    assert registry.get("ws") is state
+    assert registry.remove("ws") is state
+    assert registry.get("ws") is None
+    assert registry.user_count == 0
+    # повторное удаление ничего не ломает
+    assert registry.remove("ws") is None
+
+
+def test_reauthorize_as_other_user_detaches_old_one():
+    registry = ConnectionRegistry()
+    state = connect(registry, "ws")
+    registry.authorize(state, 1)
+    assert registry.authorize(state, 2)
+    assert not registry.is_online(1)
+    assert registry.sessions(2) == {state}
+    assert state.state is ConnectionState.ConnectionStateEnum.Authorized
+    registry.remove("ws")
+    assert registry.user_count == 0
+
+
+def test_authorize_same_user_twice_keeps_one_session():
+    registry = ConnectionRegistry()
+    state = connect(registry, "ws")
+    assert registry.authorize(state, 1)
+    assert not registry.authorize(state, 1)
+    assert registry.sessions(1) == {state}
+    assert list(registry) == [state]
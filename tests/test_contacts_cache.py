@@ -0,0 +1,42 @@
+from app.contacts_cache import ContactListCache
+
+
+def test_get_put_and_invalidate():
+    cache = ContactListCache()
+    cache.put(1, "frame-1")
+    cache.put(2, "frame-2")
+    assert cache.get(1) == "frame-1"
+    cache.invalidate(1, 2)
+    assert cache.get(1) is None
+    assert cache.get(2) is None
+
+
+def test_frame_built_during_invalidation_not_cached():
+    cache = ContactListCache()
+    # снимок собирался из БД, а в это время контакты изменились
+    version = cache.version
+    cache.invalidate(1)
+    cache.put(1, "stale", version)
+    assert cache.get(1) is None
+    cache.put(1, "fresh", cache.version)
+    assert cache.get(1) == "fresh"
+
+
+def test_invalidation_of_other_user_also_guards():
+    # версия общая: сброс любого пользователя отменяет сборку, начатую до него
+    cache = ContactListCache()
+    version = cache.version
+    cache.invalidate(2)
+    cache.put(1, "maybe stale", version)
+    assert cache.get(1) is None
+
+
+def test_least_recently_used_evicted():
+    cache = ContactListCache(max_users=2)
+    cache.put(1, "a")
+    cache.put(2, "b")
+    cache.get(1)
+    cache.put(3, "c")
+    assert cache.get(2) is None
+    assert len(cache) == 2
+    assert cache.stats() == {"users": 2, "hits": 1, "misses": 1}
@@ -0,0 +1,90 @@
+import asyncio
+import json
+
+import pytest
+from marshmallow import Schema, fields
+
+from app.connections import ConnectionState
+from app.dispatch import MessageDispatcher
+from msg_server import MessengerServer
+
+Connected = ConnectionState.ConnectionStateEnum.Connected
+Authorized = ConnectionState.ConnectionStateEnum.Authorized
+
+
+class PingSchema(Schema):
+    type = fields.Str(required=True)
+
+
+class FakeOutbound:
+    def __init__(self):
+        self.frames = []
+
+    def put(self, frame, message_id=None):
+        self.frames.append(json.loads(frame))
+        return True
+
+
+def test_duplicate_handler_rejected():
+    dispatcher = MessageDispatcher()
+    dispatcher.handler("ping", PingSchema)(lambda self: None)
+    with pytest.raises(ValueError):
+        dispatcher.handler("ping", PingSchema)(lambda self: None)
+
+
+def test_bind_gives_own_handlers_and_counters():
+    dispatcher = MessageDispatcher()
+
+    class Service:
+        def __init__(self, name):
+            self.name = name
+
+        @dispatcher.handler("ping", PingSchema, requires=None)
+        def ping(self):
+            return self.name
+
+    first = dispatcher.bind(Service("first"))
+    second = dispatcher.bind(Service("second"))
+    assert first.get("ping").handler() == "first"
+    assert second.get("ping").handler() == "second"
+    # схема общая, счётчики у каждой таблицы свои
+    assert first.get("ping").schema is second.get("ping").schema
+    first.get("ping").calls += 1
+    assert first.counters() == {"ping": 1}
+    assert second.counters() == {"ping": 0}
+    assert "ping" in first and first.get("pong") is None
+
+
+def route(raw, state_value=Connected):
+    """Прогоняет кадр через маршрутизацию сервера, возвращает ответы клиенту"""
+    server = MessengerServer()
+    state = ConnectionState("ws", FakeOutbound())
+    state.state = state_value
+    server.active_connections.add(state)
+    asyncio.run(server.route_message("ws", raw, state))
+    return [frame["message"] for frame in state.outbound.frames], server.dispatch.counters()
+
+
+@pytest.mark.parametrize("raw, error", [
+    ("{bad", "Invalid JSON format"),
+    ("[1, 2]", "Invalid message format"),
+    ('{"type": "nope"}', "Invalid message type: nope"),
+    ('{"type": "get_user_contacts"}', "Unauthorized"),
+])
+def test_rejected_frames(raw, error):
+    errors, counters = route(raw)
+    assert errors == [error]
+    assert not any(counters.values())
+
+
+def test_login_after_authorization_rejected():
+    errors, counters = route('{"type": "login", "username": "user1", "password": "user1user1"}', Authorized)
+    assert errors == ["Already authorized"]
+    assert counters["login"] == 0
+
+
+def test_schema_error_does_not_call_handler():
+    errors, counters = route('{"type": "login", "username": "user1"}')
+    assert len(errors) == 1 and errors[0].startswith("Validation error:")
+    assert "password" in errors[0]
+    assert counters["login"] == 0
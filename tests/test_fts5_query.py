@@ -0,0 +1,20 @@
+from app.crud import MessageCRUD
+
+
+def test_words_quoted_and_all_required():
+    assert MessageCRUD.fts5_query("hello world") == '"hello" "world"'
+
+
+def test_operators_are_plain_words():
+    # синтаксис FTS5 в запросе не работает: OR, NOT, * и скобки ищутся как текст
+    assert MessageCRUD.fts5_query("a OR b*") == '"a" "OR" "b*"'
+    assert MessageCRUD.fts5_query("(x) NEAR y") == '"(x)" "NEAR" "y"'
+
+
+def test_quotes_escaped():
+    assert MessageCRUD.fts5_query('say "hi"') == '"say" """hi"""'
+
+
+def test_blank_query():
+    assert MessageCRUD.fts5_query("") is None
+    assert MessageCRUD.fts5_query("  \t\n ") is None
@@ -0,0 +1,46 @@
+from app.group_cache import GroupMembershipCache
+
+
+def test_write_through_membership_changes():
+    cache = GroupMembershipCache()
+    cache.put(1, [1, 2])
+    cache.add_member(1, 3)
+    assert cache.get(1) == {1, 2, 3}
+    cache.remove_member(1, 2)
+    assert cache.get(1) == {1, 3}
+    # группы, которой нет в кеше, изменение не создаёт
+    cache.add_member(2, 5)
+    assert cache.get(2) is None
+
+
+def test_load_during_change_not_cached():
+    cache = GroupMembershipCache()
+    # загрузка из БД началась до изменения состава и вернула старый состав
+    version = cache.version
+    cache.add_member(1, 3)
+    cache.put(1, [1, 2], version)
+    assert cache.get(1) is None
+    # загрузка после изменения кладётся
+    cache.put(1, [1, 2, 3], cache.version)
+    assert cache.get(1) == {1, 2, 3}
+
+
+def test_invalidate_several_groups():
+    cache = GroupMembershipCache()
+    for group_id in (1, 2, 3):
+        cache.put(group_id, [group_id])
+    version = cache.version
+    cache.invalidate(1, 3)
+    assert cache.version != version
+    assert (cache.get(1), cache.get(2), cache.get(3)) == (None, {2}, None)
+
+
+def test_least_recently_used_evicted():
+    cache = GroupMembershipCache(max_groups=2)
+    cache.put(1, [1])
+    cache.put(2, [2])
+    cache.get(1)
+    cache.put(3, [3])
+    assert cache.get(2) is None
+    assert cache.get(1) == {1}
+    assert cache.stats() == {"groups": 2, "hits": 2, "misses": 1}
@@ -0,0 +1,126 @@
+import asyncio
+import json
+from functools import partial
+
+from sqlalchemy import select
+
+import msg_server
+from app.connections import ConnectionState
+from app.crud import MessageCRUD
+from app.msg_models import Message, PendingDelivery
+from app.outbound import OutboundQueue
+from msg_server import MessengerServer
+
+USER_ID = 2
+
+
+class FakeWebSocket:
+    """Сокет, который держит отправку, пока не открыт gate"""
+
+    def __init__(self, open_gate=True):
+        self.sent = []
+        self.gate = asyncio.Event()
+        if open_gate:
+            self.gate.set()
+
+    async def send(self, frame):
+        await self.gate.wait()
+        self.sent.append(frame)
+
+    async def close(self, code=1000, reason=""):
+        pass
+
+
+async def seed(session_maker):
+    """Пользователю 2: личные сообщения 1, 3, 5 и групповые 2, 4 (через PendingDelivery)"""
+    messages, offline = [], []
+    for i in range(5):
+        if i % 2 == 0:
+            messages.append(MessageCRUD.build_private_message({"content": f"m{i}", "receiver_id": USER_ID}, 1))
+            offline.append(())
+        else:
+            messages.append(MessageCRUD.build_group_message(f"m{i}", 1, 1))
+            offline.append((USER_ID,))
+    # чужое сообщение в выборку попасть не должно
+    messages.append(MessageCRUD.build_private_message({"content": "other", "receiver_id": 3}, 1))
+    offline.append(())
+    async with session_maker() as session:
+        await MessageCRUD.insert_messages(session, messages, offline)
+
+
+async def stored_state(session_maker):
+    async with session_maker() as session:
+        undelivered = (await session.scalars(
+            select(Message.id).where(Message.receiver_id == USER_ID, ~Message.is_delivered).order_by(Message.id)
+        )).all()
+        pending = (await session.scalars(
+            select(PendingDelivery.message_id).where(PendingDelivery.user_id == USER_ID)
+            .order_by(PendingDelivery.message_id)
+        )).all()
+    return list(undelivered), list(pending)
+
+
+def login(server, websocket, high=10):
+    state = ConnectionState(websocket)
+    state.outbound = OutboundQueue(websocket, on_spill=partial(server.spill_undelivered, state), high=high, low=1)
+    server.active_connections.add(state)
+    server.active_connections.authorize(state, USER_ID)
+    return state
+
+
+def sent_contents(websocket):
+    contents = []
+    for raw in websocket.sent:
+        frame = json.loads(raw)
+        contents.extend(message["content"] for message in frame.get("messages", [frame]))
+    return contents
+
+
+def test_offline_messages_drained_page_by_page(session_maker, monkeypatch):
+    monkeypatch.setattr(msg_server, "OFFLINE_PAGE_SIZE", 2)
+
+    async def scenario():
+        await seed(session_maker)
+        server = MessengerServer()
+        server.async_session = session_maker
+        websocket = FakeWebSocket()
+        state = login(server, websocket)
+        state.outbound.start()
+        await asyncio.wait_for(server.deliver_offline(state), 2)
+        await asyncio.wait_for(state.outbound.drained(), 2)
+        state.outbound.close()
+        return websocket, await stored_state(session_maker)
+
+    websocket, (undelivered, pending) = asyncio.run(scenario())
+    # личные и групповые вперемешку, по возрастанию id, каждое один раз
+    assert sent_contents(websocket) == ["m0", "m1", "m2", "m3", "m4"]
+    assert undelivered == [] and pending == []
+
+
+def test_spilled_messages_return_to_offline_storage(session_maker):
+    async def scenario():
+        await seed(session_maker)
+        before = await stored_state(session_maker)
+        server = MessengerServer()
+        server.async_session = session_maker
+        # клиент ничего не читает: страница остаётся в очереди
+        websocket = FakeWebSocket(open_gate=False)
+        state = login(server, websocket)
+        state.outbound.start()
+        await asyncio.wait_for(server.deliver_offline(state), 2)
+        delivered = await stored_state(session_maker)
+        # соединение рвётся - сообщения из очереди возвращаются в хранилище
+        state.outbound.close()
+
+        # отправлявшуюся пачку отдаёт уже остановленный писатель очереди, запись - фоновая задача
+        async def restored():
+            while await stored_state(session_maker) != before:
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(restored(), 2)
+        await asyncio.gather(*server.background_tasks)
+        return before, delivered
+
+    before, delivered = asyncio.run(scenario())
+    assert before == ([1, 3, 5], [2, 4])
+    assert delivered == ([], [])
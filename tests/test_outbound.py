@@ -0,0 +1,135 @@
+import asyncio
+import json
+
+from app.outbound import OutboundQueue, OverflowPolicy
+
+
+class FakeWebSocket:
+    """Сокет, который держит отправку, пока не открыт gate"""
+
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+        self.gate = asyncio.Event()
+
+    async def send(self, frame):
+        await self.gate.wait()
+        self.sent.append(frame)
+
+    async def close(self, code=1000, reason=""):
+        self.closed_with = (code, reason)
+
+
+def make_queue(policy, high=3, low=1):
+    websocket = FakeWebSocket()
+    spilled = []
+    queue = OutboundQueue(websocket, on_spill=spilled.extend, high=high, low=low, policy=policy)
+    return queue, websocket, spilled
+
+
+def test_frames_coalesced_into_batch():
+    async def scenario():
+        queue, websocket, _ = make_queue(OverflowPolicy.SPILL, high=10)
+        queue.start()
+        for i in range(3):
+            assert queue.put(json.dumps({"n": i}), i)
+        websocket.gate.set()
+        await asyncio.wait_for(queue.drained(), 1)
+        queue.close()
+        return websocket.sent
+
+    sent = asyncio.run(scenario())
+    messages = [message for frame in sent for message in json.loads(frame).get("messages", [json.loads(frame)])]
+    assert messages == [{"n": 0}, {"n": 1}, {"n": 2}]
+
+
+def test_drop_policy_discards_new_frames_but_keeps_messages():
+    async def scenario():
+        queue, websocket, spilled = make_queue(OverflowPolicy.DROP)
+        results = [queue.put("{}", i) for i in range(5)]
+        results.append(queue.put("{}"))
+        return queue, websocket, spilled, results
+
+    queue, websocket, spilled, results = asyncio.run(scenario())
+    assert results == [True, True, True, False, False, False]
+    assert queue.dropped == 3
+    assert queue.congested
+    # сообщение уже отмечено доставленным, выбросить его нельзя
+    assert spilled == [3, 4]
+    assert websocket.closed_with is None
+
+
+def test_spill_policy_returns_messages():
+    async def scenario():
+        queue, _, spilled = make_queue(OverflowPolicy.SPILL)
+        results = [queue.put("{}", i) for i in range(5)]
+        # кадр без message_id при перегрузке просто теряется
+        results.append(queue.put("{}"))
+        return queue, spilled, results
+
+    queue, spilled, results = asyncio.run(scenario())
+    assert results == [True, True, True, False, False, False]
+    assert spilled == [3, 4]
+    assert queue.dropped == 3
+    assert not queue.closed
+
+
+def test_disconnect_policy_closes_slow_consumer():
+    async def scenario():
+        queue, websocket, spilled = make_queue(OverflowPolicy.DISCONNECT)
+        queue.start()
+        await asyncio.sleep(0)
+        results = [queue.put("{}", i) for i in range(5)]
+        await asyncio.sleep(0)
+        return queue, websocket, spilled, results
+
+    queue, websocket, spilled, results = asyncio.run(scenario())
+    # переполнение закрывает очередь, следующий put уже не принимается
+    assert results == [True, True, True, False, False]
+    assert queue.closed
+    assert websocket.closed_with == (1013, "slow consumer")
+    assert sorted(spilled) == [0, 1, 2, 3, 4]
+
+
+def test_congestion_clears_at_low_watermark():
+    async def scenario():
+        queue, websocket, _ = make_queue(OverflowPolicy.DROP, high=3, low=1)
+        queue.start()
+        for i in range(4):
+            queue.put("{}", i)
+        assert queue.congested
+        websocket.gate.set()
+        await asyncio.wait_for(queue.drained(), 1)
+        congested = queue.congested
+        accepted = queue.put("{}", 9)
+        queue.close()
+        return congested, accepted
+
+    assert asyncio.run(scenario()) == (False, True)
+
+
+def test_offer_sheds_ephemeral_frames_from_low_watermark():
+    async def scenario():
+        queue, _, spilled = make_queue(OverflowPolicy.SPILL, high=3, low=1)
+        first = queue.offer('{"type": "typing"}')
+        second = queue.offer('{"type": "typing"}')
+        return queue, spilled, first, second
+
+    queue, spilled, first, second = asyncio.run(scenario())
+    assert (first, second) == (True, False)
+    assert queue.shed == 1
+    assert spilled == []
+
+
+def test_close_spills_pending_messages():
+    async def scenario():
+        queue, _, spilled = make_queue(OverflowPolicy.SPILL, high=10)
+        queue.put("{}", 1)
+        queue.put("{}")
+        queue.put("{}", 2)
+        queue.close()
+        return queue.put("{}", 3), spilled
+
+    accepted, spilled = asyncio.run(scenario())
+    assert not accepted
+    assert spilled == [1, 2, 3]
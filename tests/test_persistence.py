@@ -0,0 +1,94 @@
+import asyncio
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from app.crud import MessageCRUD
+from app.msg_models import Message
+from app.persistence import MessageWriter
+
+
+def private_message(content, receiver_id=2):
+    return MessageCRUD.build_private_message({"content": content, "receiver_id": receiver_id}, 1)
+
+
+class CountingSessions:
+    """Фабрика сессий, которая считает открытые сессии (попытки записи)"""
+
+    def __init__(self, session_maker):
+        self.session_maker = session_maker
+        self.opened = 0
+
+    def __call__(self):
+        self.opened += 1
+        return self.session_maker()
+
+
+class UnavailableSession:
+    """Сессия к упавшей БД: любой запрос - ошибка соединения"""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, *args, **kwargs):
+        raise OperationalError("INSERT INTO messages", {}, ConnectionRefusedError("connection refused"))
+
+
+async def write_all(writer, messages):
+    writer.start()
+    futures = [writer.submit(message) for message in messages]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    await writer.close()
+    return results
+
+
+def test_batch_written_in_submit_order(session_maker):
+    async def scenario():
+        writer = MessageWriter(session_maker, batch_size=10, flush_interval_ms=50)
+        results = await write_all(writer, [private_message(f"m{i}") for i in range(5)])
+        async with session_maker() as session:
+            stored = (await session.scalars(select(Message.content).order_by(Message.id))).all()
+        return writer, results, stored
+
+    writer, results, stored = asyncio.run(scenario())
+    assert [message.content for message in results] == [f"m{i}" for i in range(5)]
+    assert [message.id for message in results] == sorted(message.id for message in results)
+    assert stored == [f"m{i}" for i in range(5)]
+    assert (writer.batches, writer.messages) == (1, 5)
+
+
+def test_bad_rows_found_by_bisection(session_maker):
+    async def scenario():
+        sessions = CountingSessions(session_maker)
+        writer = MessageWriter(sessions, batch_size=8, flush_interval_ms=50)
+        # content NOT NULL: строки 2 и 5 пачку не пропустят
+        messages = [private_message(None if i in (2, 5) else f"m{i}") for i in range(8)]
+        results = await write_all(writer, messages)
+        async with session_maker() as session:
+            stored = (await session.scalars(select(Message.content).order_by(Message.id))).all()
+        return sessions.opened, results, stored
+
+    opened, results, stored = asyncio.run(scenario())
+    failed = [i for i, result in enumerate(results) if isinstance(result, Exception)]
+    assert failed == [2, 5]
+    assert all(isinstance(results[i], IntegrityError) for i in failed)
+    # остальные записаны и в исходном порядке
+    assert stored == [f"m{i}" for i in range(8) if i not in (2, 5)]
+    # деление пополам, а не повтор по одной строке: 8 -> 4 + 4 -> 2 + 2 + 2 + 2 -> 1 + 1 + 1 + 1
+    assert opened == 1 + 2 + 4 + 4
+
+
+def test_unavailable_database_fails_batch_at_once():
+    async def scenario():
+        # ошибка соединения, а не данных: делить пачку бессмысленно
+        sessions = CountingSessions(UnavailableSession)
+        writer = MessageWriter(sessions, batch_size=8, flush_interval_ms=50)
+        results = await write_all(writer, [private_message(f"m{i}") for i in range(8)])
+        return sessions.opened, results
+
+    opened, results = asyncio.run(scenario())
+    assert all(isinstance(result, OperationalError) for result in results)
+    assert opened == 1
@@ -0,0 +1,163 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import select
+
+from app.connections import ConnectionRegistry, ConnectionState
+from app.contacts_cache import contact_watchers_cache
+from app.msg_models import RelationshipStatus, User, UserContact
+from app.presence import PresenceService
+
+USERS = range(1, 8)
+# наблюдатель -> чьё присутствие он видит
+APPROVED = {3: (1, 2), 4: (1,), 5: (1, 2), 6: (1,), 7: (1,)}
+
+
+class FakeOutbound:
+    def __init__(self):
+        self.frames = []
+
+    def put(self, frame, message_id=None):
+        self.frames.append(frame)
+        return True
+
+
+class FakeRelay:
+    """Другой узел: на нём в сети пользователь 7"""
+
+    class Directory:
+        def __init__(self, users):
+            self.users = set(users)
+
+        def is_online(self, user_id):
+            return user_id in self.users
+
+    def __init__(self, remote_users=(7,)):
+        self.directory = self.Directory(remote_users)
+        self.routed = []
+
+    def route(self, user_ids, frame):
+        self.routed.append((list(user_ids), frame))
+
+
+@pytest.fixture
+def contacts(session_maker):
+    async def seed():
+        async with session_maker() as session:
+            for user_id in USERS:
+                session.add(User(id=user_id, username=f"user{user_id}", email=f"user{user_id}@example.com",
+                                 password_hash="", salt=""))
+            for watcher, user_ids in APPROVED.items():
+                for user_id in user_ids:
+                    session.add(UserContact(user_id=watcher, contact_id=user_id,
+                                            status=RelationshipStatus.APPROVED))
+            # неподтверждённый запрос присутствия не открывает
+            session.add(UserContact(user_id=4, contact_id=2, status=RelationshipStatus.PENDING))
+            await session.commit()
+
+    asyncio.run(seed())
+    # наблюдатели кешируются глобально: прочие тесты не должны влиять и получать чужое
+    contact_watchers_cache.invalidate(*USERS)
+    yield session_maker
+    contact_watchers_cache.invalidate(*USERS)
+
+
+def connect(registry, user_id):
+    state = ConnectionState(f"ws-{user_id}", FakeOutbound())
+    registry.add(state)
+    registry.authorize(state, user_id)
+    return state
+
+
+def frames(state):
+    return [json.loads(frame) for frame in state.outbound.frames]
+
+
+def test_one_frame_per_watcher_per_interval(contacts):
+    async def scenario():
+        registry, relay = ConnectionRegistry(), FakeRelay()
+        presence = PresenceService(contacts, registry, relay)
+        watchers = {user_id: connect(registry, user_id) for user_id in (3, 4, 5)}
+        for user_id in (1, 2):
+            connect(registry, user_id)
+            presence.online(user_id)
+        await presence._flush_changes()
+        return presence, relay, watchers
+
+    presence, relay, watchers = asyncio.run(scenario())
+    both = {"type": "presence", "online": [1, 2], "offline": []}
+    assert frames(watchers[3]) == [both]
+    assert frames(watchers[5]) == [both]
+    # одинаковые кадры сериализуются один раз
+    assert watchers[3].outbound.frames[0] is watchers[5].outbound.frames[0]
+    assert frames(watchers[4]) == [{"type": "presence", "online": [1], "offline": []}]
+    # наблюдатель на другом узле получает кадр через шину, наблюдатель 6 не в сети - ничего
+    assert [(user_ids, json.loads(frame)) for user_ids, frame in relay.routed] == [
+        ([7], {"type": "presence", "online": [1], "offline": []})
+    ]
+    assert (presence.flushes, presence.frames) == (1, 4)
+
+
+def test_flapping_user_not_broadcast(contacts):
+    async def scenario():
+        registry = ConnectionRegistry()
+        presence = PresenceService(contacts, registry)
+        watcher = connect(registry, 3)
+        connect(registry, 1)
+        # вышел и вернулся в пределах интервала
+        registry.remove("ws-1")
+        presence.offline(1)
+        connect(registry, 1)
+        presence.online(1)
+        await presence._flush_changes()
+        return presence, watcher
+
+    presence, watcher = asyncio.run(scenario())
+    assert watcher.outbound.frames == []
+    assert presence.flushes == 0
+
+
+def test_already_online_on_other_node_not_broadcast(contacts):
+    async def scenario():
+        registry, relay = ConnectionRegistry(), FakeRelay(remote_users=(1,))
+        presence = PresenceService(contacts, registry, relay)
+        watcher = connect(registry, 3)
+        # второе устройство пользователя подключилось к этому узлу
+        connect(registry, 1)
+        presence.online(1)
+        await presence._flush_changes()
+        return presence, watcher
+
+    presence, watcher = asyncio.run(scenario())
+    assert watcher.outbound.frames == []
+    assert presence.flushes == 0
+
+
+def test_last_seen_sent_and_written_in_one_batch(contacts):
+    async def scenario():
+        registry = ConnectionRegistry()
+        presence = PresenceService(contacts, registry)
+        watcher = connect(registry, 3)
+        for user_id in (1, 2):
+            connect(registry, user_id)
+            registry.remove(f"ws-{user_id}")
+            presence.offline(user_id)
+        await presence._flush_changes()
+        await presence.close()
+        async with contacts() as session:
+            stored = dict((await session.execute(
+                select(User.id, User.last_seen).where(User.id.in_([1, 2]))
+            )).all())
+        return presence, watcher, stored
+
+    presence, watcher, stored = asyncio.run(scenario())
+    [frame] = frames(watcher)
+    assert frame["online"] == []
+    assert [item["id"] for item in frame["offline"]] == [1, 2]
+    assert all(item["last_seen"] for item in frame["offline"])
+    # last_seen записан одним UPDATE и совпадает с разосланным
+    assert presence.last_seen_writes == 1
+    assert {item["id"]: item["last_seen"] for item in frame["offline"]} == {
+        user_id: moment.isoformat() for user_id, moment in stored.items()
+    }
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from app import redis_relay
+from app.redis_relay import RedisRelay, RespStandIn
+
+
+async def wait_for(condition, timeout=3.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            raise AssertionError("condition not reached")
+        await asyncio.sleep(0.01)
+
+
+async def start_stand_in(port=0):
+    stand_in = RespStandIn()
+    server = await stand_in.start("127.0.0.1", port)
+    return stand_in, server.sockets[0].getsockname()[1]
+
+
+def test_start_fails_without_redis():
+    async def scenario():
+        # порт освобождается сразу: подключаться некуда
+        stand_in, port = await start_stand_in()
+        await stand_in.close()
+        relay = RedisRelay("a", f"redis://127.0.0.1:{port}")
+        await relay.start()
+
+    with pytest.raises(OSError):
+        asyncio.run(scenario())
+
+
+def test_reconnect_after_redis_restart(monkeypatch):
+    monkeypatch.setattr(redis_relay, "RELAY_RECONNECT_DELAY", 0.01)
+
+    async def scenario():
+        stand_in, port = await start_stand_in()
+        url = f"redis://127.0.0.1:{port}"
+        first, second = RedisRelay("a", url), RedisRelay("b", url)
+        received, undelivered = [], []
+        second.on_deliver = lambda user_ids, frame, message_id, ephemeral: received.append((user_ids, frame))
+        second.local_users = lambda: [7]
+        first.on_undelivered = lambda user_id, message_ids: undelivered.append((user_id, message_ids))
+        await first.start()
+        await second.start()
+        await wait_for(lambda: first.directory.is_online(7))
+        first.route([7], "hi", 1)
+        await wait_for(lambda: received)
+
+        # Redis перезапустился и всё забыл
+        await stand_in.close()
+        # пока связи нет, доставка возвращается серверу
+        first.route([7], "lost", 2)
+        await wait_for(lambda: undelivered)
+        stand_in, _ = await start_stand_in(port)
+
+        # оба узла переподключаются и снова объявляют своих пользователей
+        await wait_for(lambda: first.reconnects and second.reconnects)
+        await wait_for(lambda: first.directory.is_online(7))
+        first.route([7], "again", 3)
+        await wait_for(lambda: len(received) == 2)
+        await first.close()
+        await second.close()
+        await stand_in.close()
+        return received, undelivered, first.reconnects
+
+    received, undelivered, reconnects = asyncio.run(scenario())
+    assert received == [([7], "hi"), ([7], "again")]
+    assert undelivered == [(7, (2,))]
+    assert reconnects == 1
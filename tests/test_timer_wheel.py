@@ -0,0 +1,46 @@
+from app.heartbeat import TimerWheel
+
+
+def test_key_expires_on_its_tick():
+    wheel = TimerWheel(tick=1.0, slots=8)
+    wheel.schedule("a", 3.0)
+    assert wheel.advance(3.0) == []
+    assert wheel.advance(4.0) == ["a"]
+    assert len(wheel) == 0
+
+
+def test_reschedule_and_cancel():
+    wheel = TimerWheel(tick=1.0, slots=8)
+    wheel.schedule("a", 2.0)
+    wheel.schedule("b", 2.0)
+    # перенос срока снимает прежний
+    wheel.schedule("a", 5.0)
+    wheel.cancel("b")
+    assert wheel.advance(4.0) == []
+    assert wheel.advance(6.0) == ["a"]
+    wheel.cancel("missing")
+
+
+def test_deadline_beyond_one_revolution():
+    # срок дальше числа корзин ждёт лишние обороты колеса
+    wheel = TimerWheel(tick=1.0, slots=4)
+    wheel.schedule("far", 9.5)
+    assert wheel.advance(9.0) == []
+    assert len(wheel) == 1
+    assert wheel.advance(10.0) == ["far"]
+
+
+def test_past_deadline_fires_on_next_tick():
+    wheel = TimerWheel(tick=1.0, slots=8)
+    assert wheel.advance(5.0) == []
+    wheel.schedule("late", 1.0)
+    assert wheel.advance(5.5) == []
+    assert wheel.advance(6.0) == ["late"]
+
+
+def test_origin_and_tick_size():
+    wheel = TimerWheel(tick=0.5, slots=16, now=100.0)
+    wheel.schedule("a", 101.0)
+    wheel.schedule("b", 102.0)
+    assert wheel.advance(101.5) == ["a"]
+    assert wheel.advance(102.5) == ["b"]
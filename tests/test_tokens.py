@@ -0,0 +1,43 @@
+from app import tokens
+from app.tokens import SessionTokens
+
+
+def test_issue_verify_roundtrip():
+    signer = SessionTokens(b"secret", ttl=60)
+    token, expires = signer.issue(42)
+    assert token.startswith("42.")
+    assert expires > 0
+    assert signer.verify(token) == 42
+
+
+def test_shared_secret_verifies_across_instances():
+    # рабочие процессы с одним секретом принимают токены друг друга
+    token, _ = SessionTokens(b"shared").issue(7)
+    assert SessionTokens(b"shared").verify(token) == 7
+    assert SessionTokens(b"other").verify(token) is None
+
+
+def test_tampered_token_rejected():
+    signer = SessionTokens(b"secret")
+    token, _ = signer.issue(1)
+    _, expires, signature = token.split(".")
+    assert signer.verify(f"2.{expires}.{signature}") is None
+    assert signer.verify(f"1.{int(expires) + 1}.{signature}") is None
+    assert signer.verify(token[:-1] + ("A" if token[-1] != "A" else "B")) is None
+
+
+def test_expired_token_rejected(monkeypatch):
+    signer = SessionTokens(b"secret", ttl=10)
+    now = 1_000_000
+    monkeypatch.setattr(tokens.time, "time", lambda: now)
+    token, expires = signer.issue(5)
+    assert expires == now + 10
+    assert signer.verify(token) == 5
+    now += 11
+    assert signer.verify(token) is None
+
+
+def test_malformed_tokens_rejected():
+    signer = SessionTokens(b"secret")
+    for token in ("", "abc", "1.2", "a.b.c", "1.2.3.4", None):
+        assert signer.verify(token) is None
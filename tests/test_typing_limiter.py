@@ -0,0 +1,51 @@
+from app.typing_indicator import TypingLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_repeat_within_window_suppressed():
+    clock = Clock()
+    limiter = TypingLimiter(rate=100, burst=100, window=3, clock=clock)
+    chat = ("peer", 2)
+    assert limiter.allow(1, chat, True)
+    clock.now = 1
+    assert not limiter.allow(1, chat, True)
+    # смена состояния проходит сразу
+    assert limiter.allow(1, chat, False)
+    clock.now = 5
+    assert limiter.allow(1, chat, False)
+    assert limiter.stats() == {"senders": 1, "passed": 3, "deduplicated": 1, "limited": 0}
+
+
+def test_chats_deduplicated_separately():
+    limiter = TypingLimiter(rate=100, burst=100, window=3, clock=Clock())
+    assert limiter.allow(1, ("peer", 2), True)
+    assert limiter.allow(1, ("group", 2), True)
+    assert limiter.allow(3, ("peer", 2), True)
+
+
+def test_rate_limit_per_sender():
+    clock = Clock()
+    limiter = TypingLimiter(rate=1, burst=2, window=0, clock=clock)
+    assert limiter.allow(1, ("peer", 1), True)
+    assert limiter.allow(1, ("peer", 2), True)
+    assert not limiter.allow(1, ("peer", 3), True)
+    # у другого отправителя свой бакет
+    assert limiter.allow(2, ("peer", 3), True)
+    clock.now = 1
+    assert limiter.allow(1, ("peer", 3), True)
+    assert limiter.limited == 1
+
+
+def test_forget_resets_state():
+    limiter = TypingLimiter(rate=100, burst=100, window=3, clock=Clock())
+    assert limiter.allow(1, ("peer", 2), True)
+    limiter.forget(1)
+    assert limiter.allow(1, ("peer", 2), True)
+    assert limiter.stats()["senders"] == 1
@@ -0,0 +1,123 @@
+import asyncio
+import json
+
+from app import worker_bus
+from app.worker_bus import WorkerBus
+
+
+async def wait_for(condition, timeout=2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            raise AssertionError("condition not reached")
+        await asyncio.sleep(0.01)
+
+
+def fast_reconnect(monkeypatch, attempts=1000):
+    monkeypatch.setattr(worker_bus, "BUS_RECONNECT_DELAY", 0.01)
+    monkeypatch.setattr(worker_bus, "BUS_CONNECT_ATTEMPTS", attempts)
+
+
+def test_bad_lines_do_not_stop_peer_reader(tmp_path, monkeypatch):
+    monkeypatch.setattr(worker_bus, "BUS_LINE_LIMIT", 1024)
+
+    async def scenario():
+        bus = WorkerBus(0, 1, str(tmp_path))
+        delivered = []
+
+        def on_deliver(user_ids, frame, message_id, ephemeral):
+            if frame == "boom":
+                raise RuntimeError("handler failed")
+            delivered.append((user_ids, frame, message_id))
+
+        bus.on_deliver = on_deliver
+        await bus.start()
+        reader, writer = await asyncio.open_unix_connection(bus.socket_path(0))
+        lines = [
+            {"op": "hello", "node": 1, "users": [5]},
+            {"op": "deliver", "node": 1, "items": [[[5], "boom", 1]]},
+        ]
+        writer.write(b"".join(json.dumps(line).encode() + b"\n" for line in lines))
+        # строка длиннее лимита и битый JSON
+        writer.write(b"x" * 4000 + b"\n" + b"{bad\n")
+        writer.write(json.dumps({"op": "deliver", "node": 1, "items": [[[5], "ok", 2]]}).encode() + b"\n")
+        await writer.drain()
+        await wait_for(lambda: delivered)
+        online = bus.directory.is_online(5)
+        writer.close()
+        await bus.close()
+        return delivered, online
+
+    delivered, online = asyncio.run(scenario())
+    assert delivered == [([5], "ok", 2)]
+    assert online
+
+
+def test_route_between_workers_and_peer_restart(tmp_path, monkeypatch):
+    fast_reconnect(monkeypatch)
+
+    async def scenario():
+        first = WorkerBus(0, 2, str(tmp_path))
+        second = WorkerBus(1, 2, str(tmp_path))
+        received = []
+        second.on_deliver = lambda user_ids, frame, message_id, ephemeral: received.append((user_ids, frame))
+        second.local_users = lambda: [7]
+        await first.start()
+        await second.start()
+        await wait_for(lambda: first.directory.is_online(7))
+
+        first.route([7], "hi", 1)
+        await wait_for(lambda: received)
+
+        # сосед пропал: его пользователи выходят из сети
+        await second.close()
+        await wait_for(lambda: not first.directory.is_online(7))
+
+        # сосед поднялся снова: подключение восстанавливается, снимок приходит заново
+        restarted = WorkerBus(1, 2, str(tmp_path))
+        restarted.on_deliver = second.on_deliver
+        restarted.local_users = lambda: [7]
+        await restarted.start()
+        await wait_for(lambda: first.directory.is_online(7))
+        # первая запись в старое соединение может не дойти - доставка тогда возвращается серверу
+        undelivered = []
+        first.on_undelivered = lambda user_id, message_ids: undelivered.extend(message_ids)
+        message_id = 1
+        while len(received) < 2:
+            message_id += 1
+            first.route([7], "again", message_id)
+            await wait_for(lambda: len(received) == 2 or message_id in undelivered)
+        await restarted.close()
+        await first.close()
+        return received, undelivered, message_id
+
+    received, undelivered, last_id = asyncio.run(scenario())
+    assert received == [([7], "hi"), ([7], "again")]
+    # ни одна доставка не пропала молча
+    assert undelivered == list(range(2, last_id))
+
+
+def test_dead_peer_fails_pending_deliveries(tmp_path, monkeypatch):
+    fast_reconnect(monkeypatch, attempts=3)
+
+    async def scenario():
+        bus = WorkerBus(0, 2, str(tmp_path))
+        undelivered = []
+        bus.on_undelivered = lambda user_id, message_ids: undelivered.append((user_id, message_ids))
+        await bus.start()
+        # сосед 1 так и не поднялся, но каталог считает пользователя 7 его
+        bus.directory.add(1, 7)
+        bus.route([7], "hi", 11)
+        await wait_for(lambda: bus._links[1].down)
+        # после признания соседа упавшим новые доставки сразу возвращаются
+        bus.route([8], "late", 12)
+        bus._send(1, {"op": "deliver", "node": 0, "items": [[[8], "late", 12]]}, [[[8], "late", 12]])
+        online = bus.directory.is_online(7)
+        await bus.close()
+        return undelivered, online
+
+    undelivered, online = asyncio.run(scenario())
+    assert (7, (11,)) in undelivered
+    assert (8, (12,)) in undelivered
+    assert not online